@@ -6,18 +6,29 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from collections import OrderedDict
 import os
+import threading
+import time
 import uuid
 
 from database import get_db, UserModel
 
 # Configuration
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-this-in-production")
+# typ claim of login tokens; OAuth2 access tokens carry another one
+LOGIN_TOKEN_TYPE = "login"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Resolved users are reused for this many seconds (0 disables the cache)
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+# Lets requests without an Authorization header through (get_current_user_optional)
+optional_security = HTTPBearer(auto_error=False)
 
 # Pydantic models
 class Token(BaseModel):
@@ -26,6 +37,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    issued_at: Optional[int] = None
 
 class UserCreate(BaseModel):
     username: str
@@ -105,7 +117,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc), "typ": LOGIN_TOKEN_TYPE})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -113,14 +125,55 @@ def decode_access_token(token: str) -> Optional[TokenData]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        # Login tokens issued before the typ claim have none
+        if username is None or payload.get("typ", LOGIN_TOKEN_TYPE) != LOGIN_TOKEN_TYPE:
             return None
-        return TokenData(username=username)
+        return TokenData(username=username, issued_at=payload.get("iat"))
     except JWTError:
         return None
 
+class UserCache:
+    """
+    TTL cache of active users resolved from access tokens, keyed by
+    (username, token issue time). Entries are detached copies, so they stay
+    readable after the request session that loaded them is closed.
+    """
+    def __init__(self, ttl: int = USER_CACHE_TTL, max_entries: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str, issued_at: Optional[int]) -> Optional[UserModel]:
+        with self._lock:
+            entry = self._entries.get((username, issued_at))
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                del self._entries[(username, issued_at)]
+                return None
+            return user
+
+    def put(self, username: str, issued_at: Optional[int], user: UserModel) -> None:
+        if self.ttl <= 0:
+            return
+        copy = UserModel(**{column.name: getattr(user, column.name) for column in UserModel.__table__.columns})
+        with self._lock:
+            self._entries[(username, issued_at)] = (copy, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """Drop every cached entry of a user, whatever token resolved it"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == username]:
+                del self._entries[key]
+
+user_cache = UserCache()
+
 # Dependency for protected routes
-async def get_current_user(
+def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
 ) -> UserModel:
@@ -135,22 +188,27 @@ async def get_current_user(
     if token_data is None or token_data.username is None:
         raise credentials_exception
     
+    user = user_cache.get(token_data.username, token_data.issued_at)
+    if user is not None:
+        return user
+    
     user = get_user_by_username(db, username=token_data.username)
     if user is None:
         raise credentials_exception
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
+    user_cache.put(token_data.username, token_data.issued_at, user)
     return user
 
 # Optional dependency that returns None if no auth
-async def get_current_user_optional(
-    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
+def get_current_user_optional(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
     db: Session = Depends(get_db)
 ) -> Optional[UserModel]:
     if credentials is None:
         return None
     try:
-        return await get_current_user(credentials, db)
+        return get_current_user(credentials, db)
     except:
         return None
 
@@ -163,7 +221,13 @@ def create_audit_log(
     changes: dict = None,
     ip_address: str = None
 ):
+    """
+    Record an audit entry for a change made in db. Call it before committing
+    that change: the entry is written only if the transaction commits (see
+    services.audit_writer for the write modes).
+    """
     from database import AuditLogModel
+    from services import audit_writer
     
     audit_log = AuditLogModel(
         id=str(uuid.uuid4()),
@@ -176,6 +240,5 @@ def create_audit_log(
         changes=changes,
         ip_address=ip_address
     )
-    db.add(audit_log)
-    db.commit()
+    audit_writer.record(db, audit_log)
     return audit_log
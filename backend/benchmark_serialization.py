@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of JSON serialization for large operation responses.
+
+Builds a 10k-concept CodeSystem and a ValueSet including it in a temporary
+SQLite database, then times a full $expand request and, separately, the
+expansion itself and its serialization: FastAPI's default path
+(jsonable_encoder + stdlib json) against FHIRJSONResponse. The same is done
+for a $find-matches Parameters result, comparing a Pydantic
+Parameters model_dump with the dict builder.
+
+Usage: python benchmark_serialization.py [concepts] [rounds]
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+os.environ.setdefault("AUDIT_LOG_MAINTENANCE_INTERVAL", "0")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+from database import SessionLocal, CodeSystemModel, ValueSetModel
+from models.fhir_models import Parameters
+from services import concept_store
+from services.fhir_json import FHIRJSONResponse, orjson
+from server import app, terminology_service
+
+CONCEPTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+SYSTEM = "http://example.org/fhir/CodeSystem/benchmark"
+VALUESET = "http://example.org/fhir/ValueSet/benchmark"
+
+
+def setup():
+    db = SessionLocal()
+    db.add(CodeSystemModel(id="benchmark", url=SYSTEM, name="Benchmark", status="active", content="complete"))
+    db.flush()
+    concepts = [
+        {"code": f"C{i:06d}", "display": f"Benchmark concept number {i}", "definition": f"Definition of concept {i}"}
+        for i in range(CONCEPTS)
+    ]
+    concept_store.replace_concepts(db, "benchmark", concepts)
+    db.add(ValueSetModel(id="benchmark", url=VALUESET, name="Benchmark", status="active",
+                         compose={"include": [{"system": SYSTEM}]}))
+    db.commit()
+    db.close()
+
+
+def timed(label, fn, rounds=ROUNDS):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    elapsed = (time.perf_counter() - start) / rounds * 1000
+    print(f"   {label:<48} {elapsed:8.2f} ms")
+    return elapsed
+
+
+def run_benchmark():
+    print(f"📊 Serialization benchmark ({CONCEPTS} concepts, {ROUNDS} rounds, orjson {'on' if orjson else 'off'})")
+    setup()
+    client = TestClient(app)
+    db = SessionLocal()
+
+    print(f"\n1. $expand returning {CONCEPTS} concepts")
+    request = timed("full request (FHIRJSONResponse)", lambda: client.get(
+        "/api/ValueSet/$expand", params={"url": VALUESET, "count": CONCEPTS}
+    ))
+    expansion = terminology_service.expand_valueset(db, url=VALUESET, count=CONCEPTS)
+    timed("expansion (cached, no serialization)", lambda: terminology_service.expand_valueset(db, url=VALUESET, count=CONCEPTS))
+    old = timed("jsonable_encoder + json (FastAPI default)", lambda: JSONResponse(jsonable_encoder(expansion)))
+    new = timed("FHIRJSONResponse", lambda: FHIRJSONResponse(expansion))
+    print(f"   serialization share of the request: {new / request:.0%} (FastAPI default would be {old / (request - new + old):.0%}, {old / new:.1f}x slower)")
+
+    print("\n2. $find-matches returning 1000 matches")
+    matches = terminology_service.find_matches(db, system=SYSTEM, property_value="benchmark", count=1000)
+    timed("find-matches (dict builder)", lambda: terminology_service.find_matches(
+        db, system=SYSTEM, property_value="benchmark", count=1000
+    ))
+    model = Parameters.model_validate(matches)
+    old = timed("Parameters.model_dump + jsonable_encoder + json", lambda: JSONResponse(jsonable_encoder(model.model_dump())))
+    new = timed("FHIRJSONResponse", lambda: FHIRJSONResponse(matches))
+    print(f"   serialization: {new:.2f} ms vs {old:.2f} ms ({old / new:.1f}x)")
+
+    db.close()
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Boolean, Integer, Text, DateTime, JSON
+from sqlalchemy import create_engine, Column, String, Boolean, Integer, Text, DateTime, JSON, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from datetime import datetime
@@ -6,9 +6,16 @@ import os
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///./terminology.db')
 
+# Sync routes run in a worker thread pool (THREADPOOL_SIZE in server.py);
+# size the connection pool so every worker can hold a connection
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '30'))
+
 # Create engine
 engine = create_engine(
     DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     connect_args={"check_same_thread": False} if 'sqlite' in DATABASE_URL else {}
 )
 
@@ -43,6 +50,25 @@ class CodeSystemModel(Base):
     created_by = Column(String)
     updated_by = Column(String)
     deleted_by = Column(String)
+
+class ConceptModel(Base):
+    __tablename__ = "concepts"
+    __table_args__ = (
+        UniqueConstraint("code_system_id", "code", name="uq_concepts_code_system_code"),
+        Index("idx_concepts_parent", "code_system_id", "parent_code"),
+        Index("idx_concepts_sort_order", "code_system_id", "sort_order"),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code_system_id = Column(String, ForeignKey("code_systems.id", ondelete="CASCADE"), nullable=False)
+    code = Column(String, nullable=False)
+    display = Column(String)
+    definition = Column(Text)
+    parent_code = Column(String)  # Null for top-level concepts
+    depth = Column(Integer, default=0)
+    sort_order = Column(Integer, nullable=False)  # Pre-order position in the hierarchy
+    designation = Column(JSON)
+    property = Column(JSON)
     
 class ValueSetModel(Base):
     __tablename__ = "value_sets"
@@ -159,6 +185,28 @@ class AuditLogModel(Base):
     ip_address = Column(String)
     scopes = Column(JSON)  # Scopes used for this action
 
+class JobModel(Base):
+    __tablename__ = "jobs"
+    
+    id = Column(String, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # import-csv, expand, export-csv, ...
+    status = Column(String, nullable=False, default="queued", index=True)  # queued, running, completed, failed, cancelled
+    params = Column(JSON)  # Arguments of the operation
+    progress = Column(Integer, default=0)  # Items processed so far
+    message = Column(String)  # Last progress message
+    result = Column(JSON)  # JSON result, if the job has no output file
+    output_path = Column(String)  # File holding the result
+    output_media_type = Column(String)
+    output_filename = Column(String)
+    error = Column(Text)
+    cancel_requested = Column(Boolean, default=False)
+    created_by = Column(String)
+    owner = Column(String)  # host:pid:runner of the process running the job
+    heartbeat_at = Column(DateTime)  # Refreshed by the owner while the job is queued or running
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
 # Create tables
 Base.metadata.create_all(bind=engine)
 
@@ -8,7 +8,7 @@ sys.path.append('/app/backend')
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from database import CodeSystemModel, ValueSetModel, ConceptMapModel, Base
+from database import CodeSystemModel, ConceptModel, ValueSetModel, ConceptMapModel, Base
 import json
 
 print("="*50)
@@ -90,6 +90,28 @@ try:
     postgres_session.commit()
     print(f"✓ Migrated {count} CodeSystems\n")
     
+    # Migrate concepts
+    print("Migrating concepts...")
+    count = 0
+    for cs in code_systems:
+        if postgres_session.query(ConceptModel).filter_by(code_system_id=cs.id).first():
+            continue
+        batch = []
+        for concept in sqlite_session.query(ConceptModel).filter_by(code_system_id=cs.id).yield_per(5000):
+            batch.append({
+                c.name: getattr(concept, c.name)
+                for c in ConceptModel.__table__.columns if c.name != 'id'
+            })
+            if len(batch) >= 5000:
+                postgres_session.bulk_insert_mappings(ConceptModel, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            postgres_session.bulk_insert_mappings(ConceptModel, batch)
+            count += len(batch)
+        postgres_session.commit()
+    print(f"✓ Migrated {count} concepts\n")
+    
     # Migrate ValueSets
     print("Migrating ValueSets...")
     value_sets = sqlite_session.query(ValueSetModel).all()
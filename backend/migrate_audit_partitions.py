@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Migration script to partition the audit_log table by month.
+
+PostgreSQL: converts audit_log into a natively range-partitioned table with
+one partition per month of existing data plus the current and next month.
+SQLite: moves entries older than the hot window into rolling monthly tables.
+
+Both then archive months older than AUDIT_LOG_RETENTION_DAYS. The same
+maintenance runs periodically inside the server; this script can also be
+scheduled (e.g. from cron) when that is disabled.
+"""
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Load environment
+env_path = Path(__file__).parent / '.env'
+load_dotenv(env_path)
+
+from datetime import datetime, timezone
+from sqlalchemy import text
+from database import engine
+from services import audit_partitions
+
+AUDIT_LOG_COLUMNS = "id, resource_type, resource_id, action, user_id, username, client_id, timestamp, changes, ip_address, scopes"
+
+def partition_postgres():
+    with engine.connect() as conn:
+        if audit_partitions._is_partitioned(engine):
+            print("   ✓ audit_log is already partitioned")
+            return
+
+        # Keep the old table aside; its index and constraint names must be free for the new table
+        conn.execute(text("ALTER TABLE audit_log RENAME TO audit_log_legacy"))
+        conn.execute(text("ALTER TABLE audit_log_legacy RENAME CONSTRAINT audit_log_pkey TO audit_log_legacy_pkey"))
+        for (index_name,) in conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'audit_log_legacy' AND indexname LIKE 'ix_audit_log_%'"
+        )).all():
+            conn.execute(text(f"DROP INDEX {index_name}"))
+
+        # The partition key has to be part of the primary key
+        conn.execute(text("""
+            CREATE TABLE audit_log (
+                id VARCHAR NOT NULL,
+                resource_type VARCHAR NOT NULL,
+                resource_id VARCHAR NOT NULL,
+                action VARCHAR NOT NULL,
+                user_id VARCHAR NOT NULL,
+                username VARCHAR NOT NULL,
+                client_id VARCHAR,
+                timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                changes JSON,
+                ip_address VARCHAR,
+                scopes JSON,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """))
+        for column in ("id", "resource_type", "resource_id", "user_id", "client_id", "timestamp"):
+            conn.execute(text(f"CREATE INDEX ix_audit_log_{column} ON audit_log ({column})"))
+        conn.execute(text("CREATE TABLE audit_log_default PARTITION OF audit_log DEFAULT"))
+
+        # One partition per month that has data
+        oldest = conn.execute(text("SELECT MIN(timestamp) FROM audit_log_legacy")).scalar()
+        start = audit_partitions.month_start(oldest or datetime.now(timezone.utc))
+        current = audit_partitions.month_start(datetime.now(timezone.utc))
+        while start < current:
+            end = audit_partitions.next_month(start)
+            conn.execute(text(
+                f"CREATE TABLE {audit_partitions.partition_name(start)} PARTITION OF audit_log "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            ))
+            start = end
+        conn.commit()
+
+    # Current and next month, before any row of theirs is copied
+    audit_partitions.ensure_partitions(engine)
+
+    with engine.connect() as conn:
+        copied = conn.execute(text(f"""
+            INSERT INTO audit_log ({AUDIT_LOG_COLUMNS})
+            SELECT id, resource_type, resource_id, action, user_id, username, client_id,
+                   COALESCE(timestamp, CURRENT_TIMESTAMP), changes, ip_address, scopes
+            FROM audit_log_legacy
+        """)).rowcount
+        conn.execute(text("DROP TABLE audit_log_legacy"))
+        conn.commit()
+    print(f"   ✓ Copied {copied} entries into monthly partitions")
+
+def run_migration():
+    try:
+        print("🔧 Partitioning audit_log...")
+
+        if audit_partitions.is_postgres(engine):
+            print("1. Converting audit_log to a partitioned table...")
+            partition_postgres()
+        else:
+            print("1. Rotating old entries into monthly tables...")
+            for name in audit_partitions.rotate(engine):
+                print(f"   ✓ {name}")
+
+        print("2. Archiving expired months...")
+        for path in audit_partitions.archive_expired(engine):
+            print(f"   ✓ {path}")
+
+        print("\n✅ Audit log partitioning complete")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ Migration error: {e}")
+        return False
+
+if __name__ == "__main__":
+    success = run_migration()
+    exit(0 if success else 1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Migration script to move CodeSystem concepts from the code_systems.concept
+JSON column into the normalized concepts table
+"""
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Load environment
+env_path = Path(__file__).parent / '.env'
+load_dotenv(env_path)
+
+from database import engine, SessionLocal, CodeSystemModel, ConceptModel
+from services import concept_store
+
+def run_migration():
+    db = SessionLocal()
+
+    try:
+        print("🔧 Migrating CodeSystem concepts to the concepts table...")
+
+        # Create concepts table and its indexes
+        print("1. Creating concepts table...")
+        ConceptModel.__table__.create(bind=engine, checkfirst=True)
+        print("   ✓ Created concepts table")
+
+        # Explode JSON blobs into rows, one CodeSystem per transaction
+        print("2. Exploding concept JSON...")
+        code_systems = db.query(CodeSystemModel.id, CodeSystemModel.name).filter(
+            CodeSystemModel.concept != None
+        ).all()
+
+        migrated = 0
+        for cs_id, cs_name in code_systems:
+            cs = db.query(CodeSystemModel).filter(CodeSystemModel.id == cs_id).first()
+            concepts = concept_store.parse_concepts(cs.concept)
+            if not concepts:
+                # JSON null left behind by an earlier run
+                continue
+            count = concept_store.replace_concepts(db, cs.id, concepts)
+            cs.count = count
+            cs.concept = None
+            db.commit()
+            db.expunge_all()
+            migrated += 1
+            print(f"   ✓ {cs_name}: {count} concepts")
+
+        print(f"\n✅ Migrated {migrated} CodeSystems")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ Migration error: {e}")
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    success = run_migration()
+    exit(0 if success else 1)
@@ -8,6 +8,11 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 import secrets
 import uuid
+import hmac
+import hashlib
+import os
+import threading
+import time
 from fastapi import HTTPException, status
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
@@ -15,11 +20,34 @@ from pydantic import BaseModel
 from database import OAuth2ClientModel, OAuth2TokenModel, UserModel
 
 # Configuration
-SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 REFRESH_TOKEN_EXPIRE_DAYS = 30
 
+# How long a successful client secret verification is trusted before bcrypt
+# runs again (0 disables the cache)
+CLIENT_SECRET_CACHE_TTL = int(os.environ.get("OAUTH2_CLIENT_SECRET_CACHE_TTL", "300"))
+
+# Issue access tokens as signed JWTs that validate without a database lookup.
+# Revocations reach other workers through the revocation list below, which
+# is refreshed from oauth2_tokens.revoked_at at most every
+# REVOCATION_REFRESH_SECONDS.
+JWT_ACCESS_TOKENS = os.environ.get("OAUTH2_JWT_ACCESS_TOKENS", "false").lower() in ("1", "true", "yes")
+REVOCATION_REFRESH_SECONDS = float(os.environ.get("OAUTH2_REVOCATION_REFRESH_SECONDS", "5"))
+# Signing key of JWT access tokens. It must differ from the SECRET_KEY of
+# user login tokens, so neither kind of token validates as the other, and
+# has no default, since a key in the source would let anyone mint tokens.
+JWT_SECRET = os.environ.get("OAUTH2_JWT_SECRET")
+if JWT_ACCESS_TOKENS and not JWT_SECRET:
+    raise RuntimeError("OAUTH2_JWT_ACCESS_TOKENS requires OAUTH2_JWT_SECRET to be set")
+if JWT_ACCESS_TOKENS and JWT_SECRET == os.environ.get("SECRET_KEY"):
+    raise RuntimeError("OAUTH2_JWT_SECRET must differ from SECRET_KEY")
+# typ claim of JWT access tokens; login tokens are rejected by its absence
+JWT_TOKEN_TYPE = "oauth2-access"
+# A revocation's revoked_at is set before its transaction commits, so each
+# refresh re-reads this far behind the newest revoked_at already seen
+REVOCATION_WATERMARK_OVERLAP = timedelta(seconds=60)
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # FHIR/SMART Scopes
@@ -163,13 +191,58 @@ def get_client_by_client_id(db: Session, client_id: str) -> Optional[OAuth2Clien
         OAuth2ClientModel.is_active == True
     ).first()
 
+class VerifiedSecretCache:
+    """
+    Short-lived record of successful client secret verifications, so token,
+    introspect and revoke calls do not pay for bcrypt on every request.
+
+    Entries are keyed by client_id and hold a keyed hash of the presented
+    secret (the plain secret is never stored) together with the stored bcrypt
+    hash it was verified against, so a secret changed by another process
+    misses the cache as well.
+    """
+    def __init__(self, ttl: int = CLIENT_SECRET_CACHE_TTL):
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._entries: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, client_id: str, secret: str) -> bytes:
+        return hmac.new(self._key, f"{client_id}:{secret}".encode("utf-8"), hashlib.sha256).digest()
+
+    def check(self, client_id: str, secret: str, secret_hash: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(client_id)
+        if entry is None:
+            return False
+        digest, cached_hash, expires = entry
+        if expires < time.monotonic() or cached_hash != secret_hash:
+            self.invalidate(client_id)
+            return False
+        return hmac.compare_digest(digest, self._digest(client_id, secret))
+
+    def remember(self, client_id: str, secret: str, secret_hash: str) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[client_id] = (self._digest(client_id, secret), secret_hash, time.monotonic() + self.ttl)
+
+    def invalidate(self, client_id: str) -> None:
+        with self._lock:
+            self._entries.pop(client_id, None)
+
+verified_secret_cache = VerifiedSecretCache()
+
 def authenticate_client(db: Session, client_id: str, client_secret: str) -> Optional[OAuth2ClientModel]:
     """Authenticate an OAuth2 client"""
     client = get_client_by_client_id(db, client_id)
     if not client:
         return None
+    if verified_secret_cache.check(client_id, client_secret, client.client_secret_hash):
+        return client
     if not verify_client_secret(client_secret, client.client_secret_hash):
         return None
+    verified_secret_cache.remember(client_id, client_secret, client.client_secret_hash)
     return client
 
 def create_oauth2_token(
@@ -181,16 +254,21 @@ def create_oauth2_token(
 ) -> OAuth2TokenModel:
     """Create OAuth2 access token (and optional refresh token)"""
     
-    # Generate tokens
-    access_token = secrets.token_urlsafe(32)
-    refresh_token = secrets.token_urlsafe(32) if include_refresh else None
+    token_id = str(uuid.uuid4())
     
     # Calculate expiration
     expires_at = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     refresh_expires_at = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS) if include_refresh else None
     
+    # Generate tokens
+    if JWT_ACCESS_TOKENS:
+        access_token = encode_access_token(token_id, client.client_id, scopes, user, expires_at)
+    else:
+        access_token = secrets.token_urlsafe(32)
+    refresh_token = secrets.token_urlsafe(32) if include_refresh else None
+    
     token = OAuth2TokenModel(
-        id=str(uuid.uuid4()),
+        id=token_id,
         access_token=access_token,
         refresh_token=refresh_token,
         token_type="Bearer",
@@ -213,11 +291,108 @@ def create_oauth2_token(
     
     return token
 
+def encode_access_token(token_id: str, client_id: str, scopes: List[str], user: Optional[UserModel],
+                        expires_at: datetime) -> str:
+    """Sign a self-contained access token; jti is the OAuth2TokenModel id"""
+    claims = {
+        "typ": JWT_TOKEN_TYPE,
+        "jti": token_id,
+        "client_id": client_id,
+        "scope": " ".join(scopes),
+        "exp": int(expires_at.timestamp()),
+        "iat": int(datetime.now(timezone.utc).timestamp()),
+    }
+    if user:
+        claims["sub"] = user.username
+        claims["user_id"] = user.id
+    return jwt.encode(claims, JWT_SECRET, algorithm=ALGORITHM)
+
+class RevocationList:
+    """
+    In-memory set of revoked JWT access token ids (jti) that are not yet
+    expired. Local revocations are added immediately; revocations made by
+    other processes are picked up incrementally by polling revoked_at.
+    """
+    def __init__(self, refresh_seconds: float = REVOCATION_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._revoked: Dict[str, int] = {}
+        self._watermark: Optional[datetime] = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, token_id: str, exp: int) -> None:
+        with self._lock:
+            self._revoked[token_id] = exp
+
+    def is_revoked(self, db: Session, token_id: str) -> bool:
+        if time.monotonic() >= self._next_refresh:
+            self.refresh(db)
+        return token_id in self._revoked
+
+    def refresh(self, db: Session) -> None:
+        with self._lock:
+            watermark = self._watermark
+            self._next_refresh = time.monotonic() + self.refresh_seconds
+        started = datetime.now(timezone.utc)
+        
+        query = db.query(
+            OAuth2TokenModel.id, OAuth2TokenModel.expires_at, OAuth2TokenModel.revoked_at
+        ).filter(OAuth2TokenModel.revoked == True)
+        if watermark is None:
+            # First load: every revoked token that has not expired yet
+            query = query.filter(OAuth2TokenModel.expires_at > datetime.now(timezone.utc))
+        else:
+            # Overlap the window for revocations committed late; re-adding an id is harmless
+            query = query.filter(OAuth2TokenModel.revoked_at >= watermark - REVOCATION_WATERMARK_OVERLAP)
+        rows = query.all()
+        
+        now = int(time.time())
+        with self._lock:
+            for token_id, expires_at, revoked_at in rows:
+                if expires_at.tzinfo is None:
+                    expires_at = expires_at.replace(tzinfo=timezone.utc)
+                self._revoked[token_id] = int(expires_at.timestamp())
+                if revoked_at and revoked_at.tzinfo is None:
+                    revoked_at = revoked_at.replace(tzinfo=timezone.utc)
+                if revoked_at and (self._watermark is None or revoked_at > self._watermark):
+                    self._watermark = revoked_at
+            if self._watermark is None:
+                self._watermark = started
+            # Expired tokens fail validation anyway
+            for token_id in [t for t, exp in self._revoked.items() if exp < now]:
+                del self._revoked[token_id]
+
+revocation_list = RevocationList()
+
+def validate_jwt_access_token(db: Session, token: str) -> Optional[Dict]:
+    """Validate a signed access token locally; only the revocation list may hit the database"""
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if claims.get("typ") != JWT_TOKEN_TYPE or not claims.get("jti") or revocation_list.is_revoked(db, claims["jti"]):
+        return None
+    
+    scopes = claims.get("scope", "").split()
+    return {
+        "active": True,
+        "scope": claims.get("scope", ""),
+        "client_id": claims.get("client_id"),
+        "username": claims.get("sub"),
+        "user_id": claims.get("user_id"),
+        "exp": claims.get("exp"),
+        "scopes": scopes
+    }
+
 def validate_token(db: Session, token: str) -> Optional[Dict]:
     """
     Validate an OAuth2 access token
     Returns: Dict with token info or None if invalid
     """
+    # Signed tokens are three dot-separated segments; opaque ones never are
+    if JWT_ACCESS_TOKENS and token.count(".") == 2:
+        return validate_jwt_access_token(db, token)
+    
     token_model = db.query(OAuth2TokenModel).filter(
         OAuth2TokenModel.access_token == token,
         OAuth2TokenModel.revoked == False
@@ -245,6 +420,8 @@ def validate_token(db: Session, token: str) -> Optional[Dict]:
     user = None
     if token_model.user_id:
         user = db.query(UserModel).filter(UserModel.id == token_model.user_id).first()
+        if not user or not user.is_active:
+            return None
     
     return {
         "active": True,
@@ -268,9 +445,33 @@ def revoke_token(db: Session, token: str) -> bool:
     token_model.revoked = True
     token_model.revoked_at = datetime.now(timezone.utc)
     db.commit()
+    mark_revoked(token_model)
     
     return True
 
+def revoke_user_tokens(db: Session, user_id: str) -> List[OAuth2TokenModel]:
+    """
+    Revoke every outstanding token of a user, so signed tokens stop
+    validating as well. The caller commits, then passes the tokens to
+    mark_revoked.
+    """
+    now = datetime.now(timezone.utc)
+    tokens = db.query(OAuth2TokenModel).filter(
+        OAuth2TokenModel.user_id == user_id,
+        OAuth2TokenModel.revoked == False
+    ).all()
+    for token in tokens:
+        token.revoked = True
+        token.revoked_at = now
+    return tokens
+
+def mark_revoked(token_model: OAuth2TokenModel) -> None:
+    """Propagate a committed revocation to this process' revocation list"""
+    expires_at = token_model.expires_at
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    revocation_list.add(token_model.id, int(expires_at.timestamp()))
+
 def check_scope_permission(required_scope: str, granted_scopes: List[str]) -> bool:
     """
     Check if granted scopes include required scope
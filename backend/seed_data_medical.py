@@ -3,7 +3,8 @@ Seed realistic medical terminology data: ICD-9-CM, ICD-10-CM, SNOMED CT
 """
 import sys
 sys.path.append('/app/backend')
-from database import SessionLocal, CodeSystemModel, ValueSetModel, ConceptMapModel
+from database import SessionLocal, CodeSystemModel, ConceptModel, ValueSetModel, ConceptMapModel
+from services import concept_store
 from datetime import datetime
 import uuid
 import json
@@ -224,24 +225,31 @@ def seed_medical_data():
         
         # Clear existing data
         print("Clearing existing data...")
+        db.query(ConceptModel).delete()
         db.query(CodeSystemModel).delete()
         db.query(ValueSetModel).delete()
         db.query(ConceptMapModel).delete()
         
         # Insert ICD-9-CM
         print("Inserting ICD-9-CM...")
-        icd9 = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in ICD9_DATA.items()})
+        icd9 = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in ICD9_DATA.items() if k != "concept"})
         db.add(icd9)
+        db.flush()
+        icd9.count = concept_store.replace_concepts(db, icd9.id, ICD9_DATA["concept"])
         
         # Insert ICD-10-CM
         print("Inserting ICD-10-CM...")
-        icd10 = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in ICD10_DATA.items()})
+        icd10 = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in ICD10_DATA.items() if k != "concept"})
         db.add(icd10)
+        db.flush()
+        icd10.count = concept_store.replace_concepts(db, icd10.id, ICD10_DATA["concept"])
         
         # Insert SNOMED CT
         print("Inserting SNOMED CT...")
-        snomed = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in SNOMED_DATA.items()})
+        snomed = CodeSystemModel(**{k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in SNOMED_DATA.items() if k != "concept"})
         db.add(snomed)
+        db.flush()
+        snomed.count = concept_store.replace_concepts(db, snomed.id, SNOMED_DATA["concept"])
         
         # Create example ValueSets
         print("Creating ValueSets...")
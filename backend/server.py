@@ -1,17 +1,28 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, UploadFile, File, Form
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+import anyio
 import os
 import logging
 from pathlib import Path
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
 from sqlalchemy.orm import Session
+from sqlalchemy import func
 import csv
 import io
+import base64
+import gzip
+import hashlib
 import json
+import re
+import shutil
+import tempfile
+import zlib
 
 from models.fhir_models import (
     CodeSystem,
@@ -20,23 +31,28 @@ from models.fhir_models import (
     ValueSetCreate,
     ConceptMap,
     ConceptMapCreate,
-    Parameters,
-    Parameter,
     PublicationStatus,
 )
-from database import get_db, CodeSystemModel, ValueSetModel, ConceptMapModel, UserModel, AuditLogModel, OAuth2ClientModel, OAuth2TokenModel
+from database import get_db, SessionLocal, CodeSystemModel, ConceptModel, ValueSetModel, ConceptMapModel, UserModel, AuditLogModel, OAuth2ClientModel, OAuth2TokenModel, JobModel
 from services.terminology_service_sql import TerminologyServiceSQL
+from services import concept_store
+from services.audit_writer import audit_writer
+from services import audit_partitions
+from services.compression import CompressionMiddleware, negotiate, compress, precompressed_cache, COMPRESSION_MIN_SIZE
+from services.fhir_json import FHIRJSONResponse, parameter, parameters, coding, dumps
+from services.jobs import job_runner, JobContext, delete_job, job_files_dir, JOB_OUTPUT_DIR
 from auth import (
     User, UserCreate, UserLogin, Token,
     authenticate_user, create_user, create_access_token,
-    get_current_user, get_current_user_optional, create_audit_log,
+    get_current_user, get_current_user_optional, create_audit_log, user_cache,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from oauth2_service import (
     OAuth2ClientCreate, OAuth2ClientResponse, OAuth2TokenResponse, TokenInfo,
     create_oauth2_client, authenticate_client, create_oauth2_token,
     validate_token, revoke_token, check_scope_permission,
-    get_smart_configuration, FHIR_SCOPES, generate_client_secret
+    get_smart_configuration, FHIR_SCOPES, generate_client_secret, verified_secret_cache,
+    mark_revoked, revoke_user_tokens
 )
 
 ROOT_DIR = Path(__file__).parent
@@ -45,18 +61,38 @@ load_dotenv(ROOT_DIR / '.env')
 # Initialize terminology service
 terminology_service = TerminologyServiceSQL()
 
-# Create the main app with increased file upload limit (20MB)
+# Create the main app
 app = FastAPI(
     title="FHIR Terminology Service", 
     version="1.0.0",
-    # Increase max request body size to 20MB (20 * 1024 * 1024 bytes)
-    # This allows large CSV file imports
     swagger_ui_parameters={"persistAuthorization": True}
 )
 
-# Configure Starlette's MultipartForm max file size
-from starlette.datastructures import UploadFile as StarletteUploadFile
-StarletteUploadFile.spool_max_size = 20 * 1024 * 1024  # 20MB
+# Routes are plain functions so FastAPI runs them, and the blocking database
+# and terminology work they do, in AnyIO's worker threads instead of on the
+# event loop. Bound that pool to match the database connection pool.
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "40"))
+
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("startup")
+def start_audit_log_maintenance():
+    audit_partitions.start_maintenance()
+
+@app.on_event("startup")
+def start_jobs():
+    job_runner.start()
+
+@app.on_event("shutdown")
+def stop_jobs():
+    job_runner.shutdown()
+
+@app.on_event("shutdown")
+def flush_audit_log():
+    audit_partitions.stop_maintenance()
+    audit_writer.close()
 
 api_router = APIRouter(prefix="/api")
 
@@ -66,12 +102,12 @@ async def root():
 
 # Authentication endpoints
 @api_router.post("/auth/register", response_model=User, status_code=201)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+def register(user: UserCreate, db: Session = Depends(get_db)):
     """Register a new user"""
     return create_user(db, user)
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(user_login: UserLogin, db: Session = Depends(get_db)):
+def login(user_login: UserLogin, db: Session = Depends(get_db)):
     """Login and get access token"""
     user = authenticate_user(db, user_login.username, user_login.password)
     if not user:
@@ -94,7 +130,7 @@ async def login(user_login: UserLogin, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @api_router.get("/auth/me", response_model=User)
-async def get_me(current_user: UserModel = Depends(get_current_user)):
+def get_me(current_user: UserModel = Depends(get_current_user)):
     """Get current user info"""
     return current_user
 
@@ -109,7 +145,7 @@ async def smart_configuration():
     return get_smart_configuration()
 
 @api_router.post("/oauth2/clients", status_code=201)
-async def create_client(
+def create_client(
     client_data: OAuth2ClientCreate,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -129,7 +165,7 @@ async def create_client(
     }
 
 @api_router.get("/oauth2/clients")
-async def list_clients(
+def list_clients(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
@@ -149,7 +185,7 @@ async def list_clients(
     }
 
 @api_router.get("/oauth2/clients/{client_id}")
-async def get_client(
+def get_client(
     client_id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -165,7 +201,7 @@ async def get_client(
     return OAuth2ClientResponse.model_validate(client)
 
 @api_router.put("/oauth2/clients/{client_id}")
-async def update_client(
+def update_client(
     client_id: str,
     client_data: OAuth2ClientCreate,
     db: Session = Depends(get_db),
@@ -192,11 +228,12 @@ async def update_client(
     
     db.commit()
     db.refresh(client)
+    verified_secret_cache.invalidate(client_id)
     
     return OAuth2ClientResponse.model_validate(client)
 
 @api_router.delete("/oauth2/clients/{client_id}", status_code=204)
-async def delete_client(
+def delete_client(
     client_id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -210,10 +247,23 @@ async def delete_client(
         raise HTTPException(status_code=404, detail="Client not found")
     
     client.is_active = False
+    
+    # Revoke outstanding tokens so signed tokens stop validating as well
+    now = datetime.now(timezone.utc)
+    tokens = db.query(OAuth2TokenModel).filter(
+        OAuth2TokenModel.client_id == client_id,
+        OAuth2TokenModel.revoked == False
+    ).all()
+    for token in tokens:
+        token.revoked = True
+        token.revoked_at = now
     db.commit()
+    verified_secret_cache.invalidate(client_id)
+    for token in tokens:
+        mark_revoked(token)
 
 @api_router.post("/oauth2/clients/{client_id}/reset-secret")
-async def reset_client_secret(
+def reset_client_secret(
     client_id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -230,6 +280,7 @@ async def reset_client_secret(
     new_secret = generate_client_secret()
     client.client_secret_hash = hash_secret(new_secret)
     db.commit()
+    verified_secret_cache.invalidate(client_id)
     
     return {
         "client_id": client_id,
@@ -238,7 +289,7 @@ async def reset_client_secret(
     }
 
 @api_router.post("/oauth2/token")
-async def oauth2_token(
+def oauth2_token(
     grant_type: str = Form(...),
     client_id: str = Form(...),
     client_secret: str = Form(...),
@@ -314,7 +365,9 @@ async def oauth2_token(
         
         # Revoke old token
         token_model.revoked = True
+        token_model.revoked_at = datetime.now(timezone.utc)
         db.commit()
+        mark_revoked(token_model)
         
         return OAuth2TokenResponse(
             access_token=new_token.access_token,
@@ -328,7 +381,7 @@ async def oauth2_token(
         raise HTTPException(status_code=400, detail="Unsupported grant type")
 
 @api_router.post("/oauth2/introspect")
-async def introspect_token(
+def introspect_token(
     token: str = Form(...),
     client_id: str = Form(...),
     client_secret: str = Form(...),
@@ -349,7 +402,7 @@ async def introspect_token(
     return TokenInfo(**token_info)
 
 @api_router.post("/oauth2/revoke")
-async def revoke_oauth2_token(
+def revoke_oauth2_token(
     token: str = Form(...),
     client_id: str = Form(...),
     client_secret: str = Form(...),
@@ -365,7 +418,7 @@ async def revoke_oauth2_token(
     return {"status": "revoked"}
 
 @api_router.get("/oauth2/tokens")
-async def list_active_tokens(
+def list_active_tokens(
     client_id: Optional[str] = None,
     user_id: Optional[str] = None,
     skip: int = 0,
@@ -418,7 +471,7 @@ async def list_active_tokens(
     }
 
 @api_router.delete("/oauth2/tokens/{token_id}")
-async def revoke_token_by_id(
+def revoke_token_by_id(
     token_id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -434,6 +487,7 @@ async def revoke_token_by_id(
     token.revoked = True
     token.revoked_at = datetime.now(timezone.utc)
     db.commit()
+    mark_revoked(token)
     
     return {"status": "revoked"}
 
@@ -449,7 +503,7 @@ async def list_available_scopes():
 
 # Admin - User Management
 @api_router.get("/admin/users")
-async def list_users(
+def list_users(
     skip: int = 0,
     limit: int = 100,
     role: Optional[str] = None,
@@ -490,7 +544,7 @@ async def list_users(
     }
 
 @api_router.put("/admin/users/{user_id}/role")
-async def update_user_role(
+def update_user_role(
     user_id: str,
     role: str,
     db: Session = Depends(get_db),
@@ -511,11 +565,12 @@ async def update_user_role(
     user.role = role
     user.is_admin = (role == "admin")
     db.commit()
+    user_cache.invalidate(user.username)
     
     return {"status": "updated", "user_id": user_id, "new_role": role}
 
 @api_router.delete("/admin/users/{user_id}")
-async def deactivate_user(
+def deactivate_user(
     user_id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -532,12 +587,16 @@ async def deactivate_user(
         raise HTTPException(status_code=400, detail="Cannot deactivate yourself")
     
     user.is_active = False
+    tokens = revoke_user_tokens(db, user.id)
     db.commit()
+    user_cache.invalidate(user.username)
+    for token in tokens:
+        mark_revoked(token)
     
     return {"status": "deactivated"}
 
 @api_router.get("/admin/dashboard")
-async def admin_dashboard(
+def admin_dashboard(
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
 ):
@@ -572,7 +631,8 @@ async def admin_dashboard(
             "code_systems_active": db.query(CodeSystemModel).filter(CodeSystemModel.active == True).count()
         },
         "audit_logs": {
-            "total": db.query(AuditLogModel).count(),
+            "total": db.query(audit_partitions.audit_log_entity(db)).count(),
+            # Bounded by timestamp, so only the newest partition is read
             "last_24h": db.query(AuditLogModel).filter(
                 AuditLogModel.timestamp > datetime.now(timezone.utc) - timedelta(days=1)
             ).count()
@@ -587,29 +647,41 @@ async def admin_dashboard(
 
 # Audit Log endpoints
 @api_router.get("/audit-logs")
-async def get_audit_logs(
+def get_audit_logs(
     resource_type: Optional[str] = None,
     resource_id: Optional[str] = None,
     action: Optional[str] = None,
     user_id: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Earliest timestamp (default: start of the hot window)"),
+    until: Optional[datetime] = Query(None, description="Latest timestamp (exclusive)"),
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
 ):
-    """Get audit logs with optional filters"""
-    query = db.query(AuditLogModel)
-    
+    """
+    Get audit logs with optional filters. Without since only the hot window
+    (AUDIT_LOG_HOT_DAYS) is searched, so the query stays on the newest partition.
+    """
+    # Make entries queued by this process visible to the query
+    audit_writer.flush()
+    if since is None:
+        since = audit_partitions.hot_window_start()
+    log = audit_partitions.audit_log_entity(db, since, until)
+    query = db.query(log).filter(log.timestamp >= since)
+    
+    if until:
+        query = query.filter(log.timestamp < until)
     if resource_type:
-        query = query.filter(AuditLogModel.resource_type == resource_type)
+        query = query.filter(log.resource_type == resource_type)
     if resource_id:
-        query = query.filter(AuditLogModel.resource_id == resource_id)
+        query = query.filter(log.resource_id == resource_id)
     if action:
-        query = query.filter(AuditLogModel.action == action)
+        query = query.filter(log.action == action)
     if user_id:
-        query = query.filter(AuditLogModel.user_id == user_id)
+        query = query.filter(log.user_id == user_id)
     
-    query = query.order_by(AuditLogModel.timestamp.desc())
+    query = query.order_by(log.timestamp.desc())
     total = query.count()
     logs = query.offset(skip).limit(limit).all()
     
@@ -631,69 +703,104 @@ async def get_audit_logs(
         ]
     }
 
+AUDIT_EXPORT_BATCH_SIZE = 1000
+
+def stream_audit_log_csv(filters: dict, since: Optional[datetime], until: Optional[datetime], compress: bool):
+    """
+    Yield the audit log CSV in chunks, reading rows through a server-side
+    cursor so memory stays flat whatever the size of the export.
+    """
+    db = SessionLocal()
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    try:
+        log = audit_partitions.audit_log_entity(db, since, until)
+        query = db.query(
+            log.timestamp, log.resource_type, log.resource_id, log.action,
+            log.username, log.changes, log.ip_address
+        )
+        if since:
+            query = query.filter(log.timestamp >= since)
+        if until:
+            query = query.filter(log.timestamp < until)
+        for name, value in filters.items():
+            if value:
+                query = query.filter(getattr(log, name) == value)
+        rows = query.order_by(log.timestamp.desc()).execution_options(yield_per=AUDIT_EXPORT_BATCH_SIZE)
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Timestamp', 'Resource Type', 'Resource ID', 'Action', 'User', 'Changes', 'IP Address'])
+        pending = 1
+        for timestamp, resource_type, resource_id, action, username, changes, ip_address in rows:
+            writer.writerow([
+                timestamp.isoformat(),
+                resource_type,
+                resource_id,
+                action,
+                username,
+                json.dumps(changes) if changes else '',
+                ip_address or ''
+            ])
+            pending += 1
+            if pending >= AUDIT_EXPORT_BATCH_SIZE:
+                chunk = buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+                yield compressor.compress(chunk) if compressor else chunk
+        
+        chunk = buffer.getvalue().encode("utf-8")
+        if compressor:
+            yield compressor.compress(chunk) + compressor.flush()
+        elif chunk:
+            yield chunk
+    finally:
+        db.close()
+
 @api_router.get("/audit-logs/export-csv")
-async def export_audit_logs_csv(
+def export_audit_logs_csv(
     resource_type: Optional[str] = None,
     resource_id: Optional[str] = None,
     action: Optional[str] = None,
     user_id: Optional[str] = None,
-    db: Session = Depends(get_db),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    compress: bool = Query(False, alias="gzip", description="Return the CSV gzip-compressed"),
     current_user: UserModel = Depends(get_current_user)
 ):
-    """Export audit logs as CSV"""
-    query = db.query(AuditLogModel)
-    
-    if resource_type:
-        query = query.filter(AuditLogModel.resource_type == resource_type)
-    if resource_id:
-        query = query.filter(AuditLogModel.resource_id == resource_id)
-    if action:
-        query = query.filter(AuditLogModel.action == action)
-    if user_id:
-        query = query.filter(AuditLogModel.user_id == user_id)
-    
-    logs = query.order_by(AuditLogModel.timestamp.desc()).all()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Timestamp', 'Resource Type', 'Resource ID', 'Action', 'User', 'Changes', 'IP Address'])
-    
-    for log in logs:
-        writer.writerow([
-            log.timestamp.isoformat(),
-            log.resource_type,
-            log.resource_id,
-            log.action,
-            log.username,
-            json.dumps(log.changes) if log.changes else '',
-            log.ip_address or ''
-        ])
-    
-    output.seek(0)
+    """
+    Export audit logs as CSV (all retained partitions unless since/until are
+    given). Rows are streamed as they are read.
+    """
+    audit_writer.flush()
+    filters = {"resource_type": resource_type, "resource_id": resource_id, "action": action, "user_id": user_id}
     return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=audit_logs.csv"}
+        stream_audit_log_csv(filters, since, until, compress),
+        media_type="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename=audit_logs.csv{'.gz' if compress else ''}"}
     )
 
 # Helper function to convert model to dict with JSON parsing
 def model_to_dict(model):
+    return columns_to_dict((c.name, getattr(model, c.name)) for c in model.__table__.columns)
+
+def columns_to_dict(columns):
+    """Build a FHIR resource dict from (column name, value) pairs"""
     result = {}
-    for c in model.__table__.columns:
-        value = getattr(model, c.name)
+    for name, value in columns:
         # Parse JSON strings and ensure arrays for collection fields
-        if c.name in ['concept', 'property', 'compose', 'expansion', 'group']:
+        if name in ['concept', 'property', 'compose', 'expansion', 'group']:
             if value is None:
-                result[c.name] = [] if c.name in ['concept', 'property'] else None
+                result[name] = [] if name in ['concept', 'property'] else None
             elif isinstance(value, str):
                 try:
-                    result[c.name] = json.loads(value)
+                    result[name] = json.loads(value)
                 except:
-                    result[c.name] = [] if c.name in ['concept', 'property'] else None
+                    result[name] = [] if name in ['concept', 'property'] else None
             else:
-                result[c.name] = value if value else ([] if c.name in ['concept', 'property'] else None)
+                result[name] = value if value else ([] if name in ['concept', 'property'] else None)
         else:
-            result[c.name] = value
+            result[name] = value
     
     # Convert to camelCase for FHIR compliance
     if 'resource_type' in result:
@@ -707,80 +814,711 @@ def model_to_dict(model):
     
     return result
 
+def code_system_to_dict(db: Session, cs: CodeSystemModel):
+    """model_to_dict for CodeSystems, with concepts rebuilt from the concepts table"""
+    result = model_to_dict(cs)
+    result['concept'] = concept_store.load_concept_tree(db, cs.id)
+    return result
+
+# List endpoints: _summary, _elements and paging
+BLOB_COLUMNS = {"concept", "property", "compose", "expansion", "group"}
+FHIR_ELEMENT_COLUMNS = {
+    "resourceType": "resource_type",
+    "caseSensitive": "case_sensitive",
+    "sourceCanonical": "source_canonical",
+    "targetCanonical": "target_canonical",
+}
+SUBSETTED_META = {"tag": [{"system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue", "code": "SUBSETTED"}]}
+
+def encode_page_token(last_id: str) -> str:
+    return base64.urlsafe_b64encode(last_id.encode()).decode().rstrip("=")
+
+def decode_page_token(token: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid _page_token")
+
+def list_resources(
+    request: Request,
+    response: Response,
+    db: Session,
+    model,
+    query,
+    summary: Optional[str],
+    elements: Optional[str],
+    count: Optional[int],
+    page_token: Optional[str]
+):
+    """
+    Shared implementation of the list endpoints. _summary=true and _elements
+    select only the needed columns (no concept or JSON blob loading);
+    _count pages by id, with the next page linked from a Link header.
+    """
+    if summary == "count":
+        return {"total": query.count()}
+    
+    names = None
+    requested = set()
+    if summary == "true":
+        names = [c.name for c in model.__table__.columns if c.name not in BLOB_COLUMNS]
+    elif elements:
+        requested = {FHIR_ELEMENT_COLUMNS.get(e.strip(), e.strip()) for e in elements.split(",") if e.strip()}
+        names = [c.name for c in model.__table__.columns if c.name in requested or c.name in ("id", "resource_type")]
+    with_concepts = model is CodeSystemModel and "concept" in requested
+    
+    if count is not None:
+        query = query.order_by(model.id)
+        if page_token:
+            query = query.filter(model.id > decode_page_token(page_token))
+        query = query.limit(count + 1)
+    
+    if names is None:
+        items = [code_system_to_dict(db, r) if model is CodeSystemModel else model_to_dict(r) for r in query.all()]
+    else:
+        # The legacy concept column is never read; concepts come from the concepts table
+        names = [name for name in names if not (model is CodeSystemModel and name == "concept")]
+        rows = query.with_entities(*[model.__table__.c[name] for name in names]).all()
+        items = []
+        for row in rows:
+            item = columns_to_dict(zip(names, row))
+            if with_concepts:
+                item["concept"] = concept_store.load_concept_tree(db, item["id"])
+            item["meta"] = SUBSETTED_META
+            items.append(item)
+    
+    if count is not None and len(items) > count:
+        items = items[:count]
+        next_url = request.url.include_query_params(_page_token=encode_page_token(items[-1]["id"]))
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return items
+
+# Conditional reads
+def as_utc(moment: Optional[datetime]) -> Optional[datetime]:
+    if moment is None:
+        return None
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+def make_etag(*parts) -> str:
+    """Strong ETag from the values a representation depends on"""
+    return '"' + hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:32] + '"'
+
+def validator_headers(etag: str, last_modified: Optional[datetime]) -> dict:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(as_utc(last_modified), usegmt=True)
+    return headers
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Evaluate If-None-Match (or, without it, If-Modified-Since) against the validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return as_utc(last_modified).replace(microsecond=0) <= as_utc(since)
+    return False
+
+def conditional_read(request: Request, db: Session, model, id: str, load):
+    """
+    Serve a resource read with ETag and Last-Modified. The validators come
+    from a query of id and updated_at only, so a matching conditional
+    request is answered with 304 before the resource is loaded or parsed.
+    Rows without updated_at get an ETag hashed from their content.
+    """
+    row = db.query(model.id, model.updated_at).filter(model.id == id).first()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"{model.__name__.replace('Model', '')} not found")
+    last_modified = as_utc(row.updated_at)
+    if last_modified:
+        etag = make_etag(model.__tablename__, row.id, last_modified.isoformat())
+        headers = vary_accept_encoding(validator_headers(etag, last_modified))
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        return encoded_json_response(request, etag, headers, lambda: dumps(load()))
+    
+    body = dumps(load())
+    etag = make_etag(model.__tablename__, hashlib.sha256(body).hexdigest())
+    headers = vary_accept_encoding(validator_headers(etag, None))
+    if is_not_modified(request, etag, None):
+        return Response(status_code=304, headers=headers)
+    return encoded_json_response(request, etag, headers, lambda: body)
+
+def vary_accept_encoding(headers: dict) -> dict:
+    """Add Accept-Encoding to Vary: the encoding of these responses is negotiated"""
+    vary = headers.get("Vary")
+    if vary and "accept-encoding" in vary.lower():
+        return headers
+    return {**headers, "Vary": f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"}
+
+def encoded_json_response(request: Request, etag: str, headers: dict, render) -> Response:
+    """
+    A JSON response identified by a strong ETag, compressed for the client's
+    Accept-Encoding. Compressed bodies are cached by ETag, so while the
+    resource is unchanged repeated reads skip both loading and compression.
+    """
+    headers = vary_accept_encoding(headers)
+    encoding = negotiate(request.headers.get("accept-encoding"))
+    body = precompressed_cache.get(etag, encoding) if encoding else None
+    if body is None:
+        body = render()
+        if encoding is None or len(body) < COMPRESSION_MIN_SIZE:
+            return Response(body, media_type="application/json", headers=headers)
+        body = compress(body, encoding)
+        precompressed_cache.put(etag, encoding, body)
+    return Response(body, media_type="application/json", headers={
+        **headers,
+        "ETag": f"W/{etag}",
+        "Content-Encoding": encoding,
+    })
+
+def expansion_validators(db: Session, url: str, variant) -> tuple:
+    """
+    ETag and Last-Modified of a $expand response: an expansion can change
+    with the ValueSet or any CodeSystem or ValueSet it draws from, so this
+    uses the latest update (and row count, to catch deletions) of both
+    tables together with the request parameters.
+    """
+    vs = db.query(ValueSetModel.id, ValueSetModel.updated_at).filter(ValueSetModel.url == url).first()
+    if not vs:
+        return None, None
+    systems = db.query(func.max(CodeSystemModel.updated_at), func.count(CodeSystemModel.id)).one()
+    valuesets = db.query(func.max(ValueSetModel.updated_at), func.count(ValueSetModel.id)).one()
+    last_modified = max([as_utc(t) for t in (vs.updated_at, systems[0], valuesets[0]) if t is not None], default=None)
+    etag = make_etag("expand", vs.id, last_modified, systems[1], valuesets[1], variant)
+    return etag, last_modified
+
+# Asynchronous request pattern
+def prefers_async(request: Request) -> bool:
+    """True if the client sent Prefer: respond-async"""
+    return "respond-async" in request.headers.get("prefer", "")
+
+def job_accepted(request: Request, job_id: str) -> Response:
+    """202 Accepted pointing at the status endpoint of a job"""
+    return Response(status_code=202, headers={"Content-Location": str(request.url_for("get_job", id=job_id))})
+
+def job_to_dict(job: JobModel) -> dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "message": job.message,
+        "error": job.error,
+        "createdAt": job.created_at.isoformat() if job.created_at else None,
+        "startedAt": job.started_at.isoformat() if job.started_at else None,
+        "finishedAt": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def check_job_access(db: Session, job_id: str, user: UserModel) -> None:
+    """Only the user who started a job, or an admin, may poll, download or cancel it"""
+    live, created_by = job_runner.live_created_by(job_id)
+    if not live:
+        job = db.query(JobModel.created_by).filter(JobModel.id == job_id).first()
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        created_by = job.created_by
+    if created_by != user.username and not user.is_admin and user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only the user who started the job or an admin can access it")
+
+@api_router.get("/jobs/{id}")
+def get_job(id: str, request: Request, db: Session = Depends(get_db),
+            current_user: UserModel = Depends(get_current_user)):
+    """
+    Poll a job. While it is queued or running this returns 202 with its
+    status (and an X-Progress header); once completed it returns the result.
+    """
+    check_job_access(db, id, current_user)
+    status = job_runner.live_status(id)
+    if status is None:
+        job = db.query(JobModel).filter(JobModel.id == id).first()
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job.status in ("queued", "running"):
+            status = job_to_dict(job)
+    if status is not None:
+        return JSONResponse(
+            status_code=202,
+            content=status,
+            headers={"X-Progress": f"{status['status']}: {status['message'] or status['progress']}", "Retry-After": "2"}
+        )
+    if job.status == "cancelled":
+        raise HTTPException(status_code=404, detail="Job was cancelled")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error or "Job failed")
+    if job.output_path:
+        return ranged_file_response(request, job.output_path, job.output_media_type, job.output_filename)
+    return job.result
+
+@api_router.delete("/jobs/{id}", status_code=202)
+def cancel_job(id: str, db: Session = Depends(get_db),
+               current_user: UserModel = Depends(get_current_user)):
+    """
+    Cancel a queued or running job, or delete a finished one and its output.
+    Only the user who started the job or an admin may do so.
+    """
+    check_job_access(db, id, current_user)
+    if not job_runner.cancel(id) and not delete_job(id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"message": "Job cancelled"}
+
+FILE_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def ranged_file_response(request: Request, path: str, media_type: Optional[str], filename: Optional[str] = None) -> Response:
+    """
+    Serve a file, honouring a single-range Range header with 206 Partial
+    Content so large downloads can be resumed. Other Range forms get the
+    whole file.
+    """
+    size = os.path.getsize(path)
+    headers = {"Accept-Ranges": "bytes"}
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    match = RANGE_RE.match(request.headers.get("range", "").strip())
+    if not match or not any(match.groups()):
+        return FileResponse(path, media_type=media_type, headers=headers)
+    
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    
+    def read_range():
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_range(), status_code=206, media_type=media_type, headers=headers)
+
+# Bulk Data $export
+EXPORT_TYPES = ("CodeSystem", "ValueSet", "ConceptMap")
+EXPORT_CONCEPT_TYPE = "Concept"
+FHIR_NDJSON_MEDIA_TYPE = "application/fhir+ndjson"
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def iter_export_resources(db: Session, resource_type: str, since: Optional[datetime]):
+    """Yield the resources of one type as dicts, one at a time"""
+    if resource_type == EXPORT_CONCEPT_TYPE:
+        query = db.query(ConceptModel, CodeSystemModel.url, CodeSystemModel.version).join(
+            CodeSystemModel, CodeSystemModel.id == ConceptModel.code_system_id
+        )
+        if since:
+            query = query.filter(CodeSystemModel.updated_at >= since)
+        for concept, system, version in query.order_by(ConceptModel.code_system_id, ConceptModel.sort_order).yield_per(CSV_EXPORT_BATCH_SIZE):
+            item = {"system": system, "version": version, **concept_store.concept_to_dict(concept), "parent": concept.parent_code}
+            yield {key: value for key, value in item.items() if value is not None}
+        return
+    
+    model = {"CodeSystem": CodeSystemModel, "ValueSet": ValueSetModel, "ConceptMap": ConceptMapModel}[resource_type]
+    query = db.query(model.id)
+    if since:
+        query = query.filter(model.updated_at >= since)
+    # One resource (and, for CodeSystems, its concept tree) in memory at a time
+    for (resource_id,) in query.order_by(model.id).all():
+        resource = db.query(model).filter(model.id == resource_id).first()
+        if resource is not None:
+            yield code_system_to_dict(db, resource) if model is CodeSystemModel else model_to_dict(resource)
+        db.expunge_all()
+
+def run_export_job(ctx: JobContext, params: dict) -> dict:
+    since = datetime.fromisoformat(params["since"]) if params.get("since") else None
+    directory = ctx.output_dir()
+    output = []
+    total = 0
+    for resource_type in params["types"]:
+        filename = f"{resource_type}.ndjson" + (".gz" if params["gzip"] else "")
+        path = directory / filename
+        count = 0
+        with (gzip.open(path, "wt", encoding="utf-8") if params["gzip"] else open(path, "w", encoding="utf-8")) as out:
+            for resource in iter_export_resources(ctx.db, resource_type, since):
+                out.write(json.dumps(resource, default=json_default) + "\n")
+                count += 1
+                if count % CSV_EXPORT_BATCH_SIZE == 0:
+                    ctx.progress(total + count, f"Exporting {resource_type}")
+        total += count
+        ctx.progress(total, f"Exported {resource_type}")
+        if count:
+            output.append({"type": resource_type, "url": f"{params['base_url']}jobs/{ctx.job_id}/files/{filename}", "count": count})
+        else:
+            path.unlink()
+    return {
+        "transactionTime": params["transaction_time"],
+        "request": params["request"],
+        "requiresAccessToken": True,
+        "output": output,
+        "error": []
+    }
+
+job_runner.register("export", run_export_job)
+
+@api_router.get("/$export")
+def bulk_export(
+    request: Request,
+    resource_types: Optional[str] = Query(None, alias="_type", description="Comma-separated resource types; Concept exports one line per concept"),
+    since: Optional[datetime] = Query(None, alias="_since"),
+    compress: bool = Query(False, alias="gzip", description="Write gzip-compressed NDJSON files"),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """
+    FHIR Bulk Data system-level $export of the terminology resources as
+    NDJSON files, one per resource type. Always asynchronous: returns 202
+    with a Content-Location to poll; the completed job returns the manifest
+    listing the files.
+    """
+    if not prefers_async(request):
+        raise HTTPException(status_code=400, detail="$export requires the Prefer: respond-async header")
+    types = [t.strip() for t in resource_types.split(",") if t.strip()] if resource_types else list(EXPORT_TYPES)
+    unknown = [t for t in types if t not in EXPORT_TYPES + (EXPORT_CONCEPT_TYPE,)]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unsupported _type: {', '.join(unknown)}")
+    
+    job_id = job_runner.submit("export", {
+        "types": types,
+        "since": since.isoformat() if since else None,
+        "gzip": compress,
+        "request": str(request.url),
+        "transaction_time": datetime.now(timezone.utc).isoformat(),
+        "base_url": str(request.url_for("root")),
+    }, created_by=current_user.username)
+    return job_accepted(request, job_id)
+
+@api_router.get("/jobs/{id}/files/{filename}")
+def get_job_file(id: str, filename: str, request: Request, db: Session = Depends(get_db),
+                 current_user: UserModel = Depends(get_current_user)):
+    """Download an output file of a completed job; supports Range requests"""
+    check_job_access(db, id, current_user)
+    job = db.query(JobModel).filter(JobModel.id == id).first()
+    if not job or job.status != "completed":
+        raise HTTPException(status_code=404, detail="Job not found")
+    path = job_files_dir(job.id) / filename
+    if "/" in filename or filename.startswith(".") or not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    media_type = "application/gzip" if filename.endswith(".gz") else FHIR_NDJSON_MEDIA_TYPE
+    return ranged_file_response(request, str(path), media_type)
+
 # CSV Import/Export endpoints
+def import_csv_file(db: Session, lines, filename: str, progress=None) -> dict:
+    """Create a draft CodeSystem from CSV lines. Does not commit."""
+    cs_id = str(uuid.uuid4())
+    cs = CodeSystemModel(
+        id=cs_id,
+        url=f"http://example.org/fhir/CodeSystem/{cs_id}",
+        name=filename.replace('.csv', '').replace(' ', ''),
+        title=f"Imported from {filename}",
+        status="draft",
+        date=datetime.utcnow()
+    )
+    db.add(cs)
+    db.flush()
+    cs.count = concept_store.import_csv(db, cs_id, lines, progress=progress)
+    return {"message": f"Imported {cs.count} concepts", "id": cs_id}
+
+def run_import_csv_job(ctx: JobContext, params: dict) -> dict:
+    try:
+        with open(params["path"], encoding='utf-8-sig', newline='') as lines:
+            result = import_csv_file(ctx.db, lines, params["filename"], progress=ctx.progress)
+        ctx.db.commit()
+        return result
+    finally:
+        Path(params["path"]).unlink(missing_ok=True)
+
+job_runner.register("import-csv", run_import_csv_job)
+
 @api_router.post("/CodeSystem/import-csv")
-async def import_codesystem_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    """Import CodeSystem from CSV"""
+def import_codesystem_csv(request: Request, file: UploadFile = File(...), db: Session = Depends(get_db),
+                          current_user: Optional[UserModel] = Depends(get_current_user_optional)):
+    """
+    Import CodeSystem from CSV. The upload (spooled to disk by the multipart
+    parser) is parsed and inserted in batches, so file size is not bounded
+    by memory. With Prefer: respond-async the import runs as a job.
+    """
+    if prefers_async(request):
+        Path(JOB_OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+        upload_path = Path(JOB_OUTPUT_DIR) / f"upload-{uuid.uuid4()}.csv"
+        with open(upload_path, "wb") as out:
+            shutil.copyfileobj(file.file, out)
+        return job_accepted(request, job_runner.submit(
+            "import-csv", {"path": str(upload_path), "filename": file.filename},
+            created_by=current_user.username if current_user else None
+        ))
+    
     try:
-        content = await file.read()
-        csv_file = io.StringIO(content.decode('utf-8'))
-        reader = csv.DictReader(csv_file)
-        
-        concepts = []
-        for row in reader:
-            concepts.append({
-                "code": row.get("code", ""),
-                "display": row.get("display", ""),
-                "definition": row.get("definition", "")
-            })
-        
-        cs_id = str(uuid.uuid4())
-        cs = CodeSystemModel(
-            id=cs_id,
-            url=f"http://example.org/fhir/CodeSystem/{cs_id}",
-            name=file.filename.replace('.csv', '').replace(' ', ''),
-            title=f"Imported from {file.filename}",
-            status="draft",
-            date=datetime.utcnow(),
-            concept=json.dumps(concepts),
-            count=len(concepts)
+        lines = io.TextIOWrapper(file.file, encoding='utf-8-sig', newline='')
+        result = import_csv_file(
+            db, lines, file.filename,
+            progress=lambda total: logger.info("Importing %s: %d concepts", file.filename, total)
         )
-        db.add(cs)
+        lines.detach()
         db.commit()
         
-        return {"message": f"Imported {len(concepts)} concepts", "id": cs_id}
+        return result
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
+CSV_EXPORT_BATCH_SIZE = 1000
+
+def iter_codesystem_csv(db: Session, cs_id: str, progress=None):
+    """
+    Yield a CodeSystem's concepts as CSV text chunks, in hierarchy
+    (pre-order) order with parent_code and depth columns. Rows are read
+    through a server-side cursor, so memory does not grow with the size
+    of the CodeSystem.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["code", "display", "definition", "parent_code", "depth"])
+    rows = db.query(
+        ConceptModel.code, ConceptModel.display, ConceptModel.definition,
+        ConceptModel.parent_code, ConceptModel.depth
+    ).filter(
+        ConceptModel.code_system_id == cs_id
+    ).order_by(ConceptModel.sort_order).execution_options(yield_per=CSV_EXPORT_BATCH_SIZE)
+    
+    count = 0
+    for code, display, definition, parent_code, depth in rows:
+        writer.writerow([code, display or "", definition or "", parent_code or "", depth or 0])
+        count += 1
+        if count % CSV_EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if progress:
+                progress(count)
+    yield buffer.getvalue()
+    if progress:
+        progress(count)
+
+def stream_codesystem_csv(cs_id: str):
+    """iter_codesystem_csv with its own session, for use in a StreamingResponse"""
+    db = SessionLocal()
+    try:
+        yield from iter_codesystem_csv(db, cs_id)
+    finally:
+        db.close()
+
+def run_export_csv_job(ctx: JobContext, params: dict) -> None:
+    cs = ctx.db.query(CodeSystemModel).filter(CodeSystemModel.id == params["id"]).first()
+    if not cs:
+        raise ValueError("CodeSystem not found")
+    with open(ctx.output_file(f"{cs.name}.csv", "text/csv"), "w", encoding="utf-8", newline='') as out:
+        for chunk in iter_codesystem_csv(ctx.db, cs.id, progress=ctx.progress):
+            out.write(chunk)
+
+job_runner.register("export-csv", run_export_csv_job)
+
 @api_router.get("/CodeSystem/{id}/export-csv")
-async def export_codesystem_csv(id: str, db: Session = Depends(get_db)):
-    """Export CodeSystem to CSV"""
+def export_codesystem_csv(id: str, request: Request, db: Session = Depends(get_db),
+                          current_user: Optional[UserModel] = Depends(get_current_user_optional)):
+    """
+    Export CodeSystem to CSV, including nested concepts (with their parent
+    code and depth), streamed as it is read. With Prefer: respond-async the
+    export runs as a job.
+    """
     cs = db.query(CodeSystemModel).filter(CodeSystemModel.id == id).first()
     if not cs:
         raise HTTPException(status_code=404, detail="CodeSystem not found")
+    if prefers_async(request):
+        return job_accepted(request, job_runner.submit(
+            "export-csv", {"id": cs.id}, created_by=current_user.username if current_user else None
+        ))
     
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=["code", "display", "definition"])
-    writer.writeheader()
-    
-    concepts = json.loads(cs.concept) if cs.concept and isinstance(cs.concept, str) else (cs.concept or [])
-    for concept in concepts:
-        writer.writerow({
-            "code": concept.get("code", ""),
-            "display": concept.get("display", ""),
-            "definition": concept.get("definition", "")
-        })
-    
-    output.seek(0)
     return StreamingResponse(
-        iter([output.getvalue()]),
+        stream_codesystem_csv(cs.id),
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename={cs.name}.csv"}
     )
 
+# Batch operation helpers
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_BATCH_SIZE = 1000
+NDJSON_SPOOL_MAX_SIZE = 1024 * 1024
+
+def parameters_to_coding(parameters: dict) -> dict:
+    """Flatten a single-code operation Parameters resource into a coding dict"""
+    coding = {}
+    for p in parameters.get("parameter", []):
+        name = p.get("name")
+        if name == "coding" and p.get("valueCoding"):
+            coding.update(p["valueCoding"])
+        elif name in ("url", "system", "code", "version", "display"):
+            for key in ("valueUri", "valueCode", "valueString", "valueCanonical"):
+                if p.get(key) is not None:
+                    coding[name] = p[key]
+                    break
+    return coding
+
+def parse_batch_codings(body: dict) -> tuple[List[dict], Optional[str]]:
+    """
+    Read codings from a batch request: a Bundle of single-code Parameters, or
+    one Parameters with repeating "coding" and optional shared url/system/version.
+    Returns (codings, shared ValueSet url).
+    """
+    resource_type = body.get("resourceType") if isinstance(body, dict) else None
+    if resource_type == "Bundle":
+        return [parameters_to_coding(e.get("resource") or {}) for e in body.get("entry", [])], None
+    if resource_type != "Parameters":
+        raise HTTPException(status_code=400, detail="Expected a Parameters or Bundle resource")
+    
+    shared = parameters_to_coding({"parameter": [p for p in body.get("parameter", []) if p.get("name") != "coding"]})
+    codings = []
+    for p in body.get("parameter", []):
+        if p.get("name") == "coding" and p.get("valueCoding"):
+            coding = dict(p["valueCoding"])
+            for key in ("system", "version"):
+                if not coding.get(key) and shared.get(key):
+                    coding[key] = shared[key]
+            codings.append(coding)
+    return codings, shared.get("url")
+
+def parse_batch_properties(body: dict) -> Optional[List[str]]:
+    """Read the repeating "property" parameters of a batch $lookup"""
+    if body.get("resourceType") != "Parameters":
+        return None
+    properties = [
+        p.get("valueCode") or p.get("valueString")
+        for p in body.get("parameter", []) if p.get("name") == "property"
+    ]
+    return [p for p in properties if p] or None
+
+def batch_response(body: dict, codings: List[dict], results: List[dict], part_name: str = "validation") -> FHIRJSONResponse:
+    """Build the batch reply in the same shape as the request"""
+    if body.get("resourceType") == "Bundle":
+        return FHIRJSONResponse({
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [
+                {"resource": result, "response": {"status": "200 OK"}}
+                for result in results
+            ]
+        })
+    return FHIRJSONResponse(parameters([
+        parameter(part_name, part=[parameter("coding", valueCoding=coding(**coding_fields))] + result["parameter"])
+        for coding_fields, result in zip(codings, results)
+    ]))
+
+def parameters_to_flat(result: dict) -> dict:
+    """Collapse a flat Parameters result into {name: value} for NDJSON output"""
+    flat = {}
+    for p in result["parameter"]:
+        for key in ("valueBoolean", "valueString", "valueCode", "valueUri", "valueInteger", "valueDecimal"):
+            value = p.get(key)
+            if value is not None:
+                flat[p["name"]] = value
+                break
+    return flat
+
+async def spool_request_body(request: Request):
+    """Copy the request body into a temporary file without holding it in memory"""
+    spool = tempfile.SpooledTemporaryFile(max_size=NDJSON_SPOOL_MAX_SIZE)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def ndjson_line_error(line_number: int, message: str) -> dict:
+    """OperationOutcome output line for an NDJSON input line that is not a coding"""
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": "invalid", "diagnostics": f"Line {line_number}: {message}"}]
+    }
+
+def stream_ndjson_validation(spool, validate):
+    """
+    Validate NDJSON codings in batches, one output line per input line.
+    validate(db, codings) returns one Parameters per coding. A line that is
+    not a JSON object gets an OperationOutcome line instead.
+    """
+    def validate_batch(batch):
+        # batch holds (coding, None) or (None, OperationOutcome) per input line
+        results = iter(validate(db, [coding for coding, outcome in batch if outcome is None]))
+        return b"".join(
+            dumps(outcome if outcome is not None else {**coding, **parameters_to_flat(next(results))}) + b"\n"
+            for coding, outcome in batch
+        )
+
+    db = SessionLocal()
+    try:
+        batch = []
+        for line_number, line in enumerate(spool, 1):
+            if not line.strip():
+                continue
+            try:
+                coding = json.loads(line)
+            except ValueError as e:
+                batch.append((None, ndjson_line_error(line_number, f"invalid JSON: {e}")))
+            else:
+                if isinstance(coding, dict):
+                    batch.append((coding, None))
+                else:
+                    batch.append((None, ndjson_line_error(line_number, "expected a JSON object")))
+            if len(batch) >= NDJSON_BATCH_SIZE:
+                yield validate_batch(batch)
+                batch = []
+        if batch:
+            yield validate_batch(batch)
+    finally:
+        db.close()
+        spool.close()
+
+def stream_ndjson_items(items):
+    """Serialize an iterator of dicts as NDJSON, one chunk per batch of lines"""
+    batch = []
+    for item in items:
+        batch.append(dumps(item))
+        if len(batch) >= NDJSON_BATCH_SIZE:
+            yield b"\n".join(batch) + b"\n"
+            batch = []
+    if batch:
+        yield b"\n".join(batch) + b"\n"
+
 # FHIR Operations - MUST come before {id} routes to avoid route conflicts
 @api_router.get("/CodeSystem/$lookup")
-async def codesystem_lookup(
+def codesystem_lookup(
     system: str = Query(...),
     code: str = Query(...),
     version: Optional[str] = Query(None),
+    property: Optional[List[str]] = Query(None),
     db: Session = Depends(get_db)
 ):
-    result = terminology_service.lookup(db, system, code, version)
-    return result.model_dump()
+    result = terminology_service.lookup(db, system, code, version, property)
+    return FHIRJSONResponse(result)
+
+@api_router.post("/CodeSystem/$lookup")
+async def codesystem_lookup_batch(request: Request, db: Session = Depends(get_db)):
+    """
+    Batch $lookup: accepts a Parameters with repeating "coding" (and optional
+    repeating "property") or a Bundle of single-code Parameters. Codes of the
+    same system are resolved against one loaded CodeSystem.
+    """
+    body = await request.json()
+    codings, _ = parse_batch_codings(body)
+    results = await run_in_threadpool(terminology_service.lookup_codes, db, codings, parse_batch_properties(body))
+    return batch_response(body, codings, results, part_name="lookup")
 
 @api_router.get("/CodeSystem/$validate-code")
-async def codesystem_validate(
+def codesystem_validate(
     system: str = Query(...),
     code: str = Query(...),
     version: Optional[str] = Query(None),
@@ -788,10 +1526,28 @@ async def codesystem_validate(
     db: Session = Depends(get_db)
 ):
     result = terminology_service.validate_code(db, system, code, version, display)
-    return result.model_dump()
+    return FHIRJSONResponse(result)
+
+@api_router.post("/CodeSystem/$validate-code")
+async def codesystem_validate_batch(request: Request, db: Session = Depends(get_db)):
+    """
+    Batch $validate-code: accepts a Parameters with repeating "coding" or a
+    Bundle of single-code Parameters. With Content-Type application/x-ndjson
+    each line is a coding and results are streamed back as NDJSON.
+    """
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        return StreamingResponse(
+            stream_ndjson_validation(await spool_request_body(request), terminology_service.validate_codes),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+    
+    body = await request.json()
+    codings, _ = parse_batch_codings(body)
+    results = await run_in_threadpool(terminology_service.validate_codes, db, codings)
+    return batch_response(body, codings, results)
 
 @api_router.get("/CodeSystem/$subsumes")
-async def codesystem_subsumes(
+def codesystem_subsumes(
     system: str = Query(...),
     codeA: str = Query(...),
     codeB: str = Query(...),
@@ -802,14 +1558,15 @@ async def codesystem_subsumes(
     Test the subsumption relationship between code A and code B
     """
     result = terminology_service.subsumes(db, system, codeA, codeB, version)
-    return result.model_dump()
+    return FHIRJSONResponse(result)
 
 @api_router.get("/CodeSystem/$find-matches")
-async def codesystem_find_matches(
+def codesystem_find_matches(
     system: Optional[str] = Query(None, description="CodeSystem URL to search in"),
     property: Optional[str] = Query(None, description="Property name to search (display, code, definition)"),
     value: Optional[str] = Query(None, description="Value to search for"),
     exact: bool = Query(False, description="Exact match vs partial match"),
+    count: int = Query(100, ge=1, le=1000, description="Maximum number of matches"),
     db: Session = Depends(get_db)
 ):
     """
@@ -823,22 +1580,78 @@ async def codesystem_find_matches(
         system=system,
         property_name=property,
         property_value=value,
-        exact=exact
+        exact=exact,
+        count=count
     )
-    return result.model_dump()
+    return FHIRJSONResponse(result)
+
+def run_expand_job(ctx: JobContext, params: dict) -> None:
+    if params["ndjson"]:
+        items = terminology_service.stream_expansion(ctx.db, url=params["url"], filter_text=params["filter"])
+        with open(ctx.output_file("expansion.ndjson", NDJSON_MEDIA_TYPE), "w", encoding="utf-8") as out:
+            for count, item in enumerate(items, 1):
+                out.write(json.dumps(item) + "\n")
+                if count % NDJSON_BATCH_SIZE == 0:
+                    ctx.progress(count)
+        return
+    result = terminology_service.expand_valueset(
+        ctx.db, url=params["url"], filter_text=params["filter"], hierarchical=params.get("hierarchical", False)
+    )
+    with open(ctx.output_file("expansion.json", "application/fhir+json"), "w", encoding="utf-8") as out:
+        json.dump(result, out, default=str)
+
+job_runner.register("expand", run_expand_job)
 
 @api_router.get("/ValueSet/$expand")
-async def valueset_expand(
+def valueset_expand(
+    request: Request,
     url: str = Query(...),
     filter: Optional[str] = Query(None),
     offset: int = Query(0),
     count: Optional[int] = Query(None),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Continuation cursor from a previous page"),
+    format: Optional[str] = Query(None, alias="_format"),
+    exclude_nested: bool = Query(True, alias="excludeNested", description="false returns a hierarchical contains"),
+    db: Session = Depends(get_db),
+    current_user: Optional[UserModel] = Depends(get_current_user_optional)
 ):
-    return terminology_service.expand_valueset(db, url=url, filter_text=filter, offset=offset, count=count)
+    """
+    Expand a ValueSet. Paged by offset/count or by the "next" cursor of the
+    previous page. With _format=ndjson (or Accept: application/x-ndjson) the
+    concepts are streamed one per line instead of as a contains array. With
+    excludeNested=false concepts are nested under their closest ancestor in
+    the expansion. With Prefer: respond-async the full expansion is produced
+    by a job.
+    """
+    try:
+        ndjson = format == "ndjson" or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+        hierarchical = not exclude_nested
+        if hierarchical and ndjson:
+            raise ValueError("A hierarchical expansion cannot be returned as NDJSON")
+        if prefers_async(request):
+            if offset or count is not None or cursor:
+                raise ValueError("Asynchronous expansion returns the full expansion; offset, count and cursor are not supported")
+            return job_accepted(request, job_runner.submit("expand", {
+                "url": url, "filter": filter, "ndjson": ndjson, "hierarchical": hierarchical
+            }, created_by=current_user.username if current_user else None))
+        etag, last_modified = expansion_validators(db, url, (filter, offset, count, cursor, ndjson, hierarchical))
+        headers = {**validator_headers(etag, last_modified), "Vary": "Accept, Accept-Encoding"} if etag else {}
+        if etag and is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        if ndjson:
+            items = terminology_service.stream_expansion(db, url=url, filter_text=filter, cursor=cursor)
+            return StreamingResponse(stream_ndjson_items(items), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+        expand = lambda: terminology_service.expand_valueset(
+            db, url=url, filter_text=filter, offset=offset, count=count, cursor=cursor, hierarchical=hierarchical
+        )
+        if etag:
+            return encoded_json_response(request, etag, headers, lambda: dumps(expand()))
+        return FHIRJSONResponse(expand())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/ValueSet/$validate-code")
-async def valueset_validate_code(
+def valueset_validate_code(
     url: str = Query(...),
     code: str = Query(...),
     system: Optional[str] = Query(None),
@@ -850,10 +1663,34 @@ async def valueset_validate_code(
     Validate a code against a ValueSet
     """
     result = terminology_service.validate_code_in_valueset(db, url, code, system, display, version)
-    return result.model_dump()
+    return FHIRJSONResponse(result)
+
+@api_router.post("/ValueSet/$validate-code")
+async def valueset_validate_batch(
+    request: Request,
+    url: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Batch ValueSet $validate-code, in the same formats as the CodeSystem
+    batch. Each coding may name its ValueSet in "url"; otherwise the url
+    parameter (or query parameter) applies to all of them.
+    """
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        return StreamingResponse(
+            stream_ndjson_validation(
+                await spool_request_body(request), lambda session, codings: terminology_service.validate_codes_in_valueset(session, codings, url)
+            ),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+    
+    body = await request.json()
+    codings, shared_url = parse_batch_codings(body)
+    results = await run_in_threadpool(terminology_service.validate_codes_in_valueset, db, codings, shared_url or url)
+    return batch_response(body, codings, results)
 
 @api_router.post("/ValueSet/$compose")
-async def valueset_compose(
+def valueset_compose(
     include: List[str] = Query(..., description="List of CodeSystem URLs to include"),
     exclude: Optional[List[str]] = Query(None, description="List of CodeSystem URLs to exclude"),
     filter: Optional[str] = Query(None, description="Filter text for concepts"),
@@ -871,14 +1708,15 @@ async def valueset_compose(
         exclude_systems=exclude, 
         filter_text=filter
     )
-    return result
+    return FHIRJSONResponse(result)
 
 @api_router.get("/ValueSet/$find-matches")
-async def valueset_find_matches(
+def valueset_find_matches(
     url: Optional[str] = Query(None, description="ValueSet URL to search in"),
     property: Optional[str] = Query(None, description="Property name to search (display, code, definition)"),
     value: Optional[str] = Query(None, description="Value to search for"),
     exact: bool = Query(False, description="Exact match vs partial match"),
+    count: int = Query(100, ge=1, le=1000, description="Maximum number of matches"),
     db: Session = Depends(get_db)
 ):
     """
@@ -892,12 +1730,13 @@ async def valueset_find_matches(
         system=None,
         property_name=property,
         property_value=value,
-        exact=exact
+        exact=exact,
+        count=count
     )
-    return result.model_dump()
+    return FHIRJSONResponse(result)
 
 @api_router.get("/ConceptMap/$translate")
-async def conceptmap_translate(
+def conceptmap_translate(
     url: Optional[str] = Query(None),
     conceptMapId: Optional[str] = Query(None),
     code: Optional[str] = Query(None),
@@ -913,15 +1752,26 @@ async def conceptmap_translate(
         db, url=url, conceptmap_id=conceptMapId, 
         code=code, system=system, source=source, target=target
     )
-    return result.model_dump()
+    return FHIRJSONResponse(result)
 
 # CodeSystem CRUD
+SUMMARY_QUERY = Query(None, alias="_summary", pattern="^(true|false|count)$")
+ELEMENTS_QUERY = Query(None, alias="_elements", description="Comma-separated elements to return")
+COUNT_QUERY = Query(None, alias="_count", ge=1, le=1000, description="Page size")
+PAGE_TOKEN_QUERY = Query(None, alias="_page_token", description="Token from the next Link of the previous page")
+
 @api_router.get("/CodeSystem")
-async def list_code_systems(
+def list_code_systems(
+    request: Request,
+    response: Response,
     url: Optional[str] = Query(None),
     name: Optional[str] = Query(None),
     status: Optional[str] = Query(None),
     include_inactive: bool = Query(False),
+    summary: Optional[str] = SUMMARY_QUERY,
+    elements: Optional[str] = ELEMENTS_QUERY,
+    count: Optional[int] = COUNT_QUERY,
+    page_token: Optional[str] = PAGE_TOKEN_QUERY,
     db: Session = Depends(get_db)
 ):
     query = db.query(CodeSystemModel)
@@ -937,18 +1787,17 @@ async def list_code_systems(
     if status:
         query = query.filter(CodeSystemModel.status == status)
     
-    results = query.all()
-    return [model_to_dict(r) for r in results]
+    return list_resources(request, response, db, CodeSystemModel, query, summary, elements, count, page_token)
 
 @api_router.get("/CodeSystem/{id}")
-async def get_code_system(id: str, db: Session = Depends(get_db)):
-    cs = db.query(CodeSystemModel).filter(CodeSystemModel.id == id).first()
-    if not cs:
-        raise HTTPException(status_code=404, detail="CodeSystem not found")
-    return model_to_dict(cs)
+def get_code_system(id: str, request: Request, db: Session = Depends(get_db)):
+    return conditional_read(
+        request, db, CodeSystemModel, id,
+        lambda: code_system_to_dict(db, db.query(CodeSystemModel).filter(CodeSystemModel.id == id).first())
+    )
 
 @api_router.post("/CodeSystem", status_code=201)
-async def create_code_system(
+def create_code_system(
     data: CodeSystemCreate,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -965,15 +1814,14 @@ async def create_code_system(
         case_sensitive=data.caseSensitive,
         content=data.content,
         property=json.dumps([p.model_dump() for p in data.property]) if data.property else None,
-        concept=json.dumps([c.model_dump() for c in data.concept]) if data.concept else None,
-        count=len(data.concept) if data.concept else 0,
         date=datetime.now(timezone.utc),
         created_by=current_user.username,
         created_at=datetime.now(timezone.utc),
         active=True
     )
     db.add(cs)
-    db.commit()
+    db.flush()
+    cs.count = concept_store.replace_concepts(db, cs.id, [c.model_dump() for c in data.concept or []])
     
     # Create audit log
     create_audit_log(
@@ -984,11 +1832,12 @@ async def create_code_system(
         user=current_user,
         changes={"name": cs.name, "url": cs.url}
     )
+    db.commit()
     
-    return model_to_dict(cs)
+    return code_system_to_dict(db, cs)
 
 @api_router.put("/CodeSystem/{id}")
-async def update_code_system(
+def update_code_system(
     id: str,
     data: CodeSystemCreate,
     db: Session = Depends(get_db),
@@ -1016,14 +1865,11 @@ async def update_code_system(
     cs.case_sensitive = data.caseSensitive
     cs.content = data.content
     cs.property = json.dumps([p.model_dump() for p in data.property]) if data.property else None
-    cs.concept = json.dumps([c.model_dump() for c in data.concept]) if data.concept else None
-    cs.count = len(data.concept) if data.concept else 0
+    cs.concept = None
+    cs.count = concept_store.replace_concepts(db, cs.id, [c.model_dump() for c in data.concept or []])
     cs.updated_at = datetime.now(timezone.utc)
     cs.updated_by = current_user.username
     
-    db.commit()
-    db.refresh(cs)
-    
     # Create audit log
     create_audit_log(
         db=db,
@@ -1033,11 +1879,13 @@ async def update_code_system(
         user=current_user,
         changes=changes
     )
+    db.commit()
+    db.refresh(cs)
     
-    return model_to_dict(cs)
+    return code_system_to_dict(db, cs)
 
 @api_router.post("/CodeSystem/{id}/deactivate")
-async def deactivate_code_system(
+def deactivate_code_system(
     id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -1050,7 +1898,7 @@ async def deactivate_code_system(
     cs.active = False
     cs.deleted_at = datetime.now(timezone.utc)
     cs.deleted_by = current_user.username
-    db.commit()
+    cs.updated_at = datetime.now(timezone.utc)
     
     # Create audit log
     create_audit_log(
@@ -1061,11 +1909,12 @@ async def deactivate_code_system(
         user=current_user,
         changes={"status": "deactivated"}
     )
+    db.commit()
     
     return {"message": "CodeSystem deactivated", "id": id}
 
 @api_router.post("/CodeSystem/{id}/activate")
-async def activate_code_system(
+def activate_code_system(
     id: str,
     db: Session = Depends(get_db),
     current_user: UserModel = Depends(get_current_user)
@@ -1078,7 +1927,7 @@ async def activate_code_system(
     cs.active = True
     cs.deleted_at = None
     cs.deleted_by = None
-    db.commit()
+    cs.updated_at = datetime.now(timezone.utc)
     
     # Create audit log
     create_audit_log(
@@ -1089,24 +1938,32 @@ async def activate_code_system(
         user=current_user,
         changes={"status": "activated"}
     )
+    db.commit()
     
     return {"message": "CodeSystem activated", "id": id}
 
 # ValueSet endpoints
 @api_router.get("/ValueSet")
-async def list_value_sets(db: Session = Depends(get_db)):
-    results = db.query(ValueSetModel).all()
-    return [model_to_dict(r) for r in results]
+def list_value_sets(
+    request: Request,
+    response: Response,
+    summary: Optional[str] = SUMMARY_QUERY,
+    elements: Optional[str] = ELEMENTS_QUERY,
+    count: Optional[int] = COUNT_QUERY,
+    page_token: Optional[str] = PAGE_TOKEN_QUERY,
+    db: Session = Depends(get_db)
+):
+    return list_resources(request, response, db, ValueSetModel, db.query(ValueSetModel), summary, elements, count, page_token)
 
 @api_router.get("/ValueSet/{id}")
-async def get_value_set(id: str, db: Session = Depends(get_db)):
-    vs = db.query(ValueSetModel).filter(ValueSetModel.id == id).first()
-    if not vs:
-        raise HTTPException(status_code=404, detail="Not found")
-    return model_to_dict(vs)
+def get_value_set(id: str, request: Request, db: Session = Depends(get_db)):
+    return conditional_read(
+        request, db, ValueSetModel, id,
+        lambda: model_to_dict(db.query(ValueSetModel).filter(ValueSetModel.id == id).first())
+    )
 
 @api_router.post("/ValueSet", status_code=201)
-async def create_value_set(data: ValueSetCreate, db: Session = Depends(get_db)):
+def create_value_set(data: ValueSetCreate, db: Session = Depends(get_db)):
     vs = ValueSetModel(
         id=str(uuid.uuid4()),
         url=data.url,
@@ -1124,7 +1981,7 @@ async def create_value_set(data: ValueSetCreate, db: Session = Depends(get_db)):
     return model_to_dict(vs)
 
 @api_router.put("/ValueSet/{id}")
-async def update_value_set(id: str, data: ValueSetCreate, db: Session = Depends(get_db)):
+def update_value_set(id: str, data: ValueSetCreate, db: Session = Depends(get_db)):
     vs = db.query(ValueSetModel).filter(ValueSetModel.id == id).first()
     if not vs:
         raise HTTPException(status_code=404, detail="ValueSet not found")
@@ -1138,13 +1995,14 @@ async def update_value_set(id: str, data: ValueSetCreate, db: Session = Depends(
     vs.description = data.description
     vs.compose = json.dumps(data.compose.model_dump()) if data.compose else None
     vs.date = datetime.utcnow()
+    vs.updated_at = datetime.now(timezone.utc)
     
     db.commit()
     db.refresh(vs)
     return model_to_dict(vs)
 
 @api_router.delete("/ValueSet/{id}", status_code=204)
-async def delete_value_set(id: str, db: Session = Depends(get_db)):
+def delete_value_set(id: str, db: Session = Depends(get_db)):
     vs = db.query(ValueSetModel).filter(ValueSetModel.id == id).first()
     if not vs:
         raise HTTPException(status_code=404, detail="Not found")
@@ -1153,19 +2011,26 @@ async def delete_value_set(id: str, db: Session = Depends(get_db)):
 
 # ConceptMap endpoints
 @api_router.get("/ConceptMap")
-async def list_concept_maps(db: Session = Depends(get_db)):
-    results = db.query(ConceptMapModel).all()
-    return [model_to_dict(r) for r in results]
+def list_concept_maps(
+    request: Request,
+    response: Response,
+    summary: Optional[str] = SUMMARY_QUERY,
+    elements: Optional[str] = ELEMENTS_QUERY,
+    count: Optional[int] = COUNT_QUERY,
+    page_token: Optional[str] = PAGE_TOKEN_QUERY,
+    db: Session = Depends(get_db)
+):
+    return list_resources(request, response, db, ConceptMapModel, db.query(ConceptMapModel), summary, elements, count, page_token)
 
 @api_router.get("/ConceptMap/{id}")
-async def get_concept_map(id: str, db: Session = Depends(get_db)):
-    cm = db.query(ConceptMapModel).filter(ConceptMapModel.id == id).first()
-    if not cm:
-        raise HTTPException(status_code=404, detail="Not found")
-    return model_to_dict(cm)
+def get_concept_map(id: str, request: Request, db: Session = Depends(get_db)):
+    return conditional_read(
+        request, db, ConceptMapModel, id,
+        lambda: model_to_dict(db.query(ConceptMapModel).filter(ConceptMapModel.id == id).first())
+    )
 
 @api_router.post("/ConceptMap", status_code=201)
-async def create_concept_map(data: ConceptMapCreate, db: Session = Depends(get_db)):
+def create_concept_map(data: ConceptMapCreate, db: Session = Depends(get_db)):
     cm = ConceptMapModel(
         id=str(uuid.uuid4()),
         url=data.url,
@@ -1185,7 +2050,7 @@ async def create_concept_map(data: ConceptMapCreate, db: Session = Depends(get_d
     return model_to_dict(cm)
 
 @api_router.put("/ConceptMap/{id}")
-async def update_concept_map(id: str, data: ConceptMapCreate, db: Session = Depends(get_db)):
+def update_concept_map(id: str, data: ConceptMapCreate, db: Session = Depends(get_db)):
     cm = db.query(ConceptMapModel).filter(ConceptMapModel.id == id).first()
     if not cm:
         raise HTTPException(status_code=404, detail="ConceptMap not found")
@@ -1201,13 +2066,14 @@ async def update_concept_map(id: str, data: ConceptMapCreate, db: Session = Depe
     cm.target_canonical = data.targetCanonical
     cm.group = json.dumps(data.group) if data.group else None
     cm.date = datetime.utcnow()
+    cm.updated_at = datetime.now(timezone.utc)
     
     db.commit()
     db.refresh(cm)
     return model_to_dict(cm)
 
 @api_router.delete("/ConceptMap/{id}", status_code=204)
-async def delete_concept_map(id: str, db: Session = Depends(get_db)):
+def delete_concept_map(id: str, db: Session = Depends(get_db)):
     cm = db.query(ConceptMapModel).filter(ConceptMapModel.id == id).first()
     if not cm:
         raise HTTPException(status_code=404, detail="Not found")
@@ -1401,5 +2267,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
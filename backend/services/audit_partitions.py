@@ -0,0 +1,270 @@
+"""
+Time-partitioned audit log storage
+
+Audit entries are partitioned by calendar month (UTC):
+
+- PostgreSQL: audit_log is a natively range-partitioned table (see
+  migrate_audit_partitions.py) with one audit_log_YYYY_MM partition per month,
+  so timestamp-bounded queries are pruned to the partitions they touch.
+  Partitions for the current and next month are created ahead of time;
+  entries that landed in audit_log_default before their month's partition
+  existed are moved into it.
+- Other databases (SQLite): audit_log is the hot table. Rows older than the
+  hot window are moved, one month at a time, into rolling audit_log_YYYY_MM
+  tables, and queries reaching past the hot window read them through a
+  UNION ALL.
+
+Months that fall entirely outside the retention period are written to
+AUDIT_LOG_ARCHIVE_DIR as gzip-compressed NDJSON and dropped.
+"""
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from sqlalchemy import MetaData, Table, Column, select, insert, delete, inspect, text, union_all
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, aliased
+from database import engine as default_engine, AuditLogModel
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+
+AUDIT_LOG_HOT_DAYS = int(os.environ.get("AUDIT_LOG_HOT_DAYS", "31"))
+AUDIT_LOG_RETENTION_DAYS = int(os.environ.get("AUDIT_LOG_RETENTION_DAYS", "365"))
+# Archives hold user activity: keep them in a data directory, not the source tree
+AUDIT_LOG_ARCHIVE_DIR = os.environ.get("AUDIT_LOG_ARCHIVE_DIR", str(
+    Path(os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share") / "terminology" / "audit_archive"
+))
+AUDIT_LOG_MAINTENANCE_INTERVAL = int(os.environ.get("AUDIT_LOG_MAINTENANCE_INTERVAL", "3600"))
+
+PARTITION_NAME_RE = re.compile(r"^audit_log_(\d{4})_(\d{2})$")
+
+logger = logging.getLogger(__name__)
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(start: datetime) -> datetime:
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start: datetime) -> str:
+    return f"audit_log_{start.year:04d}_{start.month:02d}"
+
+
+def hot_window_start(now: Optional[datetime] = None) -> datetime:
+    """Earliest timestamp served by default audit queries"""
+    return (now or datetime.now(timezone.utc)) - timedelta(days=AUDIT_LOG_HOT_DAYS)
+
+
+def is_postgres(bind: Engine) -> bool:
+    return bind.dialect.name == "postgresql"
+
+
+def list_partitions(bind: Engine) -> List[Tuple[datetime, str]]:
+    """Monthly partitions (PostgreSQL) or rolling tables (SQLite), oldest first"""
+    partitions = []
+    for name in inspect(bind).get_table_names():
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions.append((datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc), name))
+    return sorted(partitions)
+
+
+def _table(name: str) -> Table:
+    """A Table with the audit_log columns under another name"""
+    return Table(name, MetaData(), *[Column(c.name, c.type) for c in AuditLogModel.__table__.columns])
+
+
+def audit_log_entity(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """
+    Return something to query audit entries between since and until with.
+    On PostgreSQL that is AuditLogModel itself (the planner prunes partitions
+    from the timestamp filter); elsewhere the hot table is combined with the
+    rolling tables overlapping the range. Callers still filter on timestamp.
+    """
+    bind = db.get_bind()
+    if is_postgres(bind):
+        return AuditLogModel
+
+    # Timestamps from query strings are naive; they are UTC like the partitions
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if until is not None and until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    tables = [
+        _table(name) for start, name in list_partitions(bind)
+        if (until is None or start < until) and (since is None or next_month(start) > since)
+    ]
+    if not tables:
+        return AuditLogModel
+    columns = AuditLogModel.__table__.columns
+    selects = [select(*columns)] + [select(*[table.c[c.name] for c in columns]) for table in tables]
+    return aliased(AuditLogModel, union_all(*selects).subquery("audit_log_all"))
+
+
+def ensure_partitions(bind: Engine, months_ahead: int = 1) -> List[str]:
+    """Create the PostgreSQL partitions of the current and upcoming months"""
+    if not is_postgres(bind) or not _is_partitioned(bind):
+        return []
+    created = []
+    start = month_start(datetime.now(timezone.utc))
+    for _ in range(months_ahead + 1):
+        end = next_month(start)
+        name = partition_name(start)
+        try:
+            with bind.begin() as conn:
+                _create_partition(conn, name, start, end)
+            created.append(name)
+        except SQLAlchemyError:
+            logger.exception("Could not create audit log partition %s; its entries stay in audit_log_default", name)
+        start = end
+    return created
+
+
+def _create_partition(conn: Connection, name: str, start: datetime, end: datetime) -> None:
+    """
+    Create the partition of [start, end) if it does not exist. PostgreSQL
+    refuses to create it while audit_log_default holds rows in that range,
+    so those are moved: detach the default partition, create the new one,
+    move the rows through audit_log and attach the default partition again.
+    """
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    window = {"start": start, "end": end}
+    has_default = conn.execute(text("SELECT to_regclass('audit_log_default')")).scalar() is not None
+    if not has_default or conn.execute(text(
+        "SELECT 1 FROM audit_log_default WHERE timestamp >= :start AND timestamp < :end LIMIT 1"
+    ), window).first() is None:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF audit_log {bounds}"))
+        return
+
+    conn.execute(text("ALTER TABLE audit_log DETACH PARTITION audit_log_default"))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF audit_log {bounds}"))
+    moved = conn.execute(text(
+        "WITH moved AS (DELETE FROM audit_log_default WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+        "INSERT INTO audit_log SELECT * FROM moved"
+    ), window).rowcount
+    conn.execute(text("ALTER TABLE audit_log ATTACH PARTITION audit_log_default DEFAULT"))
+    logger.warning("Moved %d audit log entries from audit_log_default into %s", moved, name)
+
+
+def _is_partitioned(bind: Engine) -> bool:
+    with bind.connect() as conn:
+        return conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = 'audit_log'"
+        )).first() is not None
+
+
+def rotate(bind: Engine, now: Optional[datetime] = None) -> List[str]:
+    """
+    Move rows older than the hot window out of the SQLite hot table into
+    their monthly rolling tables. Whole months only: the hot table keeps
+    everything from the start of the month containing the window start.
+    """
+    if is_postgres(bind):
+        return []
+    cutoff = month_start(hot_window_start(now))
+    hot = AuditLogModel.__table__
+    with bind.connect() as conn:
+        oldest = conn.execute(select(hot.c.timestamp).order_by(hot.c.timestamp).limit(1)).scalar()
+    if oldest is None:
+        return []
+    if oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+
+    rotated = []
+    start = month_start(oldest)
+    while start < cutoff:
+        end = next_month(start)
+        name = partition_name(start)
+        window = (hot.c.timestamp >= start, hot.c.timestamp < end)
+        with bind.begin() as conn:
+            if conn.execute(select(hot.c.id).where(*window).limit(1)).first() is not None:
+                conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} AS SELECT * FROM audit_log WHERE 0"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{name}_timestamp ON {name} (timestamp)"))
+                conn.execute(insert(_table(name)).from_select(
+                    [c.name for c in hot.columns], select(*hot.columns).where(*window)
+                ))
+                conn.execute(delete(hot).where(*window))
+                rotated.append(name)
+        start = end
+    return rotated
+
+
+def archive_expired(bind: Engine, now: Optional[datetime] = None, archive_dir: str = AUDIT_LOG_ARCHIVE_DIR) -> List[str]:
+    """Archive and drop monthly partitions that ended before the retention period"""
+    if AUDIT_LOG_RETENTION_DAYS <= 0:
+        return []
+    limit = (now or datetime.now(timezone.utc)) - timedelta(days=AUDIT_LOG_RETENTION_DAYS)
+    archived = []
+    for start, name in list_partitions(bind):
+        if next_month(start) > limit:
+            break
+        path = archive_partition(bind, name, archive_dir)
+        with bind.begin() as conn:
+            if is_postgres(bind):
+                conn.execute(text(f"ALTER TABLE audit_log DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+        archived.append(path)
+    return archived
+
+
+def archive_partition(bind: Engine, name: str, archive_dir: str = AUDIT_LOG_ARCHIVE_DIR) -> str:
+    """Write every row of a partition to <archive_dir>/<name>.ndjson.gz"""
+    Path(archive_dir).mkdir(parents=True, exist_ok=True)
+    path = Path(archive_dir) / f"{name}.ndjson.gz"
+    partial = path.with_suffix(".gz.partial")
+    table = _table(name)
+    with bind.connect() as conn, gzip.open(partial, "wt", encoding="utf-8") as out:
+        result = conn.execution_options(stream_results=True, yield_per=1000).execute(
+            select(table).order_by(table.c.timestamp)
+        )
+        for row in result.mappings():
+            out.write(json.dumps({
+                key: value.isoformat() if isinstance(value, datetime) else value
+                for key, value in row.items()
+            }) + "\n")
+    # Only a complete archive replaces an earlier one
+    partial.replace(path)
+    return str(path)
+
+
+def run_maintenance(bind: Engine = default_engine) -> None:
+    """Create upcoming partitions, rotate the hot table and archive expired months"""
+    for name in ensure_partitions(bind):
+        logger.debug("Audit log partition %s ready", name)
+    for name in rotate(bind):
+        logger.info("Rotated audit log entries into %s", name)
+    for path in archive_expired(bind):
+        logger.info("Archived audit log partition to %s", path)
+
+
+_maintenance_stop = threading.Event()
+
+
+def start_maintenance(bind: Engine = default_engine, interval: int = AUDIT_LOG_MAINTENANCE_INTERVAL) -> None:
+    """Run maintenance now and then every interval seconds in a daemon thread"""
+    if interval <= 0:
+        return
+    _maintenance_stop.clear()
+
+    def loop():
+        while True:
+            try:
+                run_maintenance(bind)
+            except Exception:
+                logger.exception("Audit log maintenance failed")
+            if _maintenance_stop.wait(interval):
+                return
+
+    threading.Thread(target=loop, name="audit-log-maintenance", daemon=True).start()
+
+
+def stop_maintenance() -> None:
+    _maintenance_stop.set()
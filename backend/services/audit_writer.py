@@ -0,0 +1,145 @@
+"""
+Batched audit-log writer
+
+Audit entries are attached to the session of the change they describe and
+handled according to AUDIT_LOG_MODE:
+
+- "async" (default): when that session commits, the entries are queued and a
+  background thread inserts them in batches, in its own transactions. If the
+  bounded queue is full the entry is written synchronously instead of being
+  dropped. Entries of a rolled back session are discarded.
+- "transaction": entries are added to the session itself and committed
+  atomically with the change, for deployments that require it.
+"""
+from typing import List, Dict, Any, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database import SessionLocal, AuditLogModel
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+AUDIT_LOG_MODE = os.environ.get("AUDIT_LOG_MODE", "async")
+AUDIT_LOG_QUEUE_SIZE = int(os.environ.get("AUDIT_LOG_QUEUE_SIZE", "10000"))
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get("AUDIT_LOG_BATCH_SIZE", "500"))
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL", "1.0"))
+AUDIT_LOG_FLUSH_TIMEOUT = float(os.environ.get("AUDIT_LOG_FLUSH_TIMEOUT", "2.0"))
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLogWriter:
+    def __init__(self, max_queue: int = AUDIT_LOG_QUEUE_SIZE, batch_size: int = AUDIT_LOG_BATCH_SIZE,
+                 flush_interval: float = AUDIT_LOG_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def enqueue(self, entry: Dict[str, Any]) -> None:
+        self._start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # Apply backpressure to the caller rather than lose the entry
+            try:
+                self._write([entry])
+            except Exception:
+                logger.exception("Failed to write audit log entry")
+
+    def flush(self, timeout: Optional[float] = AUDIT_LOG_FLUSH_TIMEOUT) -> bool:
+        """
+        Wait until every queued entry has been written, for at most timeout
+        seconds (None waits indefinitely). Returns False if entries were still
+        pending when the timeout expired, so a read may miss the newest ones.
+        """
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning("Audit log flush timed out with %d entries pending", self._queue.unfinished_tasks)
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self) -> None:
+        """Write what is left in the queue and stop the background thread"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._stopping.clear()
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Failed to write %d audit log entries", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, entries: List[Dict[str, Any]]) -> None:
+        db = SessionLocal()
+        try:
+            db.bulk_insert_mappings(AuditLogModel, entries)
+            db.commit()
+        finally:
+            db.close()
+
+
+audit_writer = AuditLogWriter()
+atexit.register(audit_writer.close)
+
+
+def record(db: Session, audit_log: AuditLogModel) -> None:
+    """Attach an audit entry to the current transaction of db"""
+    if AUDIT_LOG_MODE == "transaction":
+        db.add(audit_log)
+    else:
+        entry = {column.name: getattr(audit_log, column.name) for column in AuditLogModel.__table__.columns}
+        db.info.setdefault("pending_audit_logs", []).append(entry)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _enqueue_committed(session):
+    for entry in session.info.pop("pending_audit_logs", ()):
+        audit_writer.enqueue(entry)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop("pending_audit_logs", None)
@@ -0,0 +1,106 @@
+"""
+Concept bitsets
+
+Concepts of a compiled CodeSystem have dense integer IDs: their pre-order
+positions in CompiledCodeSystem.flat, assigned per CodeSystem version. A
+PositionSet is a set of those IDs. With NumPy installed it is a bool array
+of the CodeSystem's size, so union, intersection, difference and batch
+membership are vectorized and a concept costs one byte whether or not it
+is a member; without NumPy it falls back to a Python set of ints.
+
+PositionSets are immutable: the operators return new sets.
+"""
+from typing import Iterable, Iterator, List, Optional
+from bisect import bisect_left
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - optional speedup
+    numpy = None
+
+# Members are converted to Python ints this many at a time when iterating
+ITER_CHUNK_SIZE = 4096
+
+
+class PositionSet:
+    __slots__ = ("size", "_bits", "_sorted")
+
+    def __init__(self, size: int, bits):
+        self.size = size
+        self._bits = bits
+        # Sorted members of the set fallback, built on first ordered access
+        self._sorted: Optional[List[int]] = None
+
+    @classmethod
+    def empty(cls, size: int) -> "PositionSet":
+        return cls(size, numpy.zeros(size, dtype=bool) if numpy is not None else set())
+
+    @classmethod
+    def full(cls, size: int) -> "PositionSet":
+        return cls.range(size, 0, size)
+
+    @classmethod
+    def range(cls, size: int, start: int, stop: int) -> "PositionSet":
+        if numpy is None:
+            return cls(size, set(range(start, stop)))
+        bits = numpy.zeros(size, dtype=bool)
+        bits[start:stop] = True
+        return cls(size, bits)
+
+    @classmethod
+    def of(cls, size: int, positions: Iterable[int]) -> "PositionSet":
+        if numpy is None:
+            return cls(size, set(positions))
+        bits = numpy.zeros(size, dtype=bool)
+        bits[numpy.fromiter(positions, dtype=numpy.int64)] = True
+        return cls(size, bits)
+
+    def __or__(self, other: "PositionSet") -> "PositionSet":
+        return PositionSet(self.size, self._bits | other._bits)
+
+    def __and__(self, other: "PositionSet") -> "PositionSet":
+        return PositionSet(self.size, self._bits & other._bits)
+
+    def __sub__(self, other: "PositionSet") -> "PositionSet":
+        if numpy is None:
+            return PositionSet(self.size, self._bits - other._bits)
+        return PositionSet(self.size, self._bits & ~other._bits)
+
+    def __contains__(self, position: int) -> bool:
+        if numpy is None:
+            return position in self._bits
+        return 0 <= position < self.size and bool(self._bits[position])
+
+    def __len__(self) -> int:
+        if numpy is None:
+            return len(self._bits)
+        return int(numpy.count_nonzero(self._bits))
+
+    def contains_many(self, positions: List[int]) -> List[bool]:
+        """Membership of each position, tested in one vectorized step"""
+        if numpy is None:
+            return [position in self._bits for position in positions]
+        return self._bits[numpy.asarray(positions, dtype=numpy.int64)].tolist()
+
+    def positions(self, start: int = 0) -> Iterator[int]:
+        """Members in ascending order, skipping the first start of them"""
+        if numpy is None:
+            return islice(self._sorted_members(), start, None)
+        return self._iter_members(numpy.flatnonzero(self._bits), start)
+
+    def rank(self, position: int) -> int:
+        """Number of members below position"""
+        if numpy is None:
+            return bisect_left(self._sorted_members(), position)
+        return int(numpy.count_nonzero(self._bits[:position]))
+
+    def _sorted_members(self) -> List[int]:
+        if self._sorted is None:
+            self._sorted = sorted(self._bits)
+        return self._sorted
+
+    @staticmethod
+    def _iter_members(members, start: int) -> Iterator[int]:
+        for chunk in range(start, len(members), ITER_CHUNK_SIZE):
+            yield from members[chunk:chunk + ITER_CHUNK_SIZE].tolist()
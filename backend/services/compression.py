@@ -0,0 +1,250 @@
+"""
+Negotiated response compression
+
+CompressionMiddleware compresses compressible responses (JSON, NDJSON,
+CSV, text) with the best encoding the client accepts: zstd, then brotli,
+then gzip. zstd and brotli are used only when the zstandard and brotli
+packages are installed. Streamed responses are compressed chunk by chunk.
+Responses that already carry a Content-Encoding, byte ranges and small
+bodies pass through untouched.
+
+Responses with a strong ETag are the same bytes for as long as the ETag
+holds, so their compressed bodies are kept in precompressed_cache, keyed
+by (ETag, encoding). Routes look them up before building the response,
+which turns a repeated download into a cache hit instead of a
+serialize-and-compress (see encoded_json_response in server.py).
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import gzip
+import os
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional encoder
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional encoder
+    zstandard = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_CACHE_MAX_BYTES = int(os.environ.get("COMPRESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "5"))
+ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+
+COMPRESSIBLE_TYPES = (
+    "application/json", "application/fhir+json", "application/x-ndjson",
+    "application/fhir+ndjson", "application/xml", "text/",
+)
+
+
+def available_encodings() -> List[str]:
+    """Supported encodings, most preferred first"""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+ENCODINGS = available_encodings()
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick an encoding from an Accept-Encoding header, honouring q-values"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best = None
+    for encoding in ENCODINGS:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Incremental compressor with compress(chunk) and flush()"""
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        if self.encoding == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class PrecompressedCache:
+    """LRU of compressed bodies keyed by (ETag, encoding), bounded in bytes"""
+    def __init__(self, max_bytes: int = COMPRESSION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, etag: str, encoding: str) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get((etag, encoding))
+            if body is not None:
+                self._entries.move_to_end((etag, encoding))
+            return body
+
+    def put(self, etag: str, encoding: str, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop((etag, encoding), None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[(etag, encoding)] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+precompressed_cache = PrecompressedCache()
+
+
+def _is_compressible(headers: Dict[str, str]) -> bool:
+    content_type = headers.get("content-type", "")
+    return (
+        "content-encoding" not in headers
+        and "content-range" not in headers
+        and "accept-ranges" not in headers
+        and any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+    )
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = next((v.decode("latin-1") for k, v in scope["headers"] if k.lower() == b"accept-encoding"), None)
+        encoding = negotiate(accept_encoding)
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in message.get("headers", [])}
+                if message["status"] < 200 or message["status"] in (204, 206, 304) or not _is_compressible(headers):
+                    passthrough = True
+                    await send(message)
+                elif encoding is None:
+                    # Sent as is, but another Accept-Encoding would get it compressed
+                    passthrough = True
+                    message["headers"] = _vary_accept_encoding(message.get("headers", []))
+                    await send(message)
+                else:
+                    start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if compressor is None:
+                if not more and len(body) < self.minimum_size:
+                    passthrough = True
+                    start["headers"] = _vary_accept_encoding(start.get("headers", []))
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = StreamCompressor(encoding)
+                start["headers"] = _compressed_headers(start.get("headers", []), encoding)
+                if not more:
+                    compressed = compress(body, encoding)
+                    start["headers"].append((b"content-length", str(len(compressed)).encode()))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                await send(start)
+            compressed = compressor.compress(body) if body else b""
+            if not more:
+                compressed += compressor.flush()
+            if compressed or not more:
+                await send({"type": "http.response.body", "body": compressed, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _compressed_headers(headers: List[Tuple[bytes, bytes]], encoding: str) -> List[Tuple[bytes, bytes]]:
+    """
+    Headers of the encoded representation. A strong ETag becomes weak (as
+    nginx does), since the bytes differ from the identity representation
+    while the content is the same; If-None-Match accepts either form.
+    """
+    result = []
+    for key, value in headers:
+        name = key.lower()
+        if name == b"content-length":
+            continue
+        if name == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        result.append((key, value))
+    result = _vary_accept_encoding(result)
+    result.append((b"content-encoding", encoding.encode()))
+    return result
+
+
+def _vary_accept_encoding(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    """Add Accept-Encoding to the Vary header, unless it is already listed"""
+    vary = [v for k, v in headers if k.lower() == b"vary"]
+    if any(b"accept-encoding" in v.lower() for v in vary):
+        return list(headers)
+    result = [(k, v) for k, v in headers if k.lower() != b"vary"]
+    result.append((b"vary", vary[0] + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+    return result
@@ -0,0 +1,199 @@
+"""
+Normalized concept storage
+
+Concepts of a CodeSystem live in the `concepts` table, one row per code, with
+a unique (code_system_id, code) index. The nested FHIR `concept` structure is
+exploded into rows on write and rebuilt from them on read.
+"""
+from typing import List, Optional, Dict, Any, Iterator, Iterable, Callable
+from sqlalchemy.orm import Session
+from database import ConceptModel
+import csv
+import json
+
+BULK_INSERT_SIZE = 5000
+
+
+def parse_concepts(value) -> List[Dict]:
+    """Parse a concept list that may be stored as a JSON string"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def flatten_concept_tree(concepts: List[Dict]) -> Iterator[Dict[str, Any]]:
+    """
+    Walk a nested concept list in pre-order and yield one row per code.
+    Codes that appear more than once keep their first position; children of
+    later occurrences are still visited.
+    """
+    seen = set()
+    position = 0
+    stack = [(concept, None, 0) for concept in reversed(concepts or [])]
+    while stack:
+        concept, parent_code, depth = stack.pop()
+        code = concept.get("code")
+        if code and code not in seen:
+            seen.add(code)
+            yield {
+                "code": code,
+                "display": concept.get("display"),
+                "definition": concept.get("definition"),
+                "parent_code": parent_code,
+                "depth": depth,
+                "sort_order": position,
+                "designation": concept.get("designation") or None,
+                "property": concept.get("property") or None,
+            }
+            position += 1
+        for child in reversed(concept.get("concept") or []):
+            stack.append((child, code, depth + 1))
+
+
+def replace_concepts(db: Session, code_system_id: str, concepts: List[Dict]) -> int:
+    """
+    Replace all concept rows of a CodeSystem with the given nested concept list.
+    Does not commit. Returns the number of stored concepts.
+    """
+    db.query(ConceptModel).filter(ConceptModel.code_system_id == code_system_id).delete(synchronize_session=False)
+
+    total = 0
+    batch = []
+    for row in flatten_concept_tree(concepts):
+        row["code_system_id"] = code_system_id
+        batch.append(row)
+        if len(batch) >= BULK_INSERT_SIZE:
+            db.bulk_insert_mappings(ConceptModel, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        db.bulk_insert_mappings(ConceptModel, batch)
+        total += len(batch)
+    return total
+
+
+def import_csv(db: Session, code_system_id: str, lines: Iterable[str],
+               progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Append concepts read from CSV lines (code, display, definition and an
+    optional parent or parent_code column) to a CodeSystem, inserting them in
+    batches as they are parsed. Rows keep their file order; if any row names
+    a parent the hierarchy is relabelled afterwards. Rows without a code and
+    repeated codes are skipped. Does not commit. Returns the number of stored
+    concepts; progress is called with the running total after each batch.
+    """
+    reader = csv.DictReader(lines)
+    seen = set()
+    total = 0
+    has_parents = False
+    batch = []
+    for row in reader:
+        code = (row.get("code") or "").strip()
+        if not code or code in seen:
+            continue
+        seen.add(code)
+        parent_code = (row.get("parent_code") or row.get("parent") or "").strip() or None
+        has_parents = has_parents or parent_code is not None
+        batch.append({
+            "code_system_id": code_system_id,
+            "code": code,
+            "display": row.get("display", ""),
+            "definition": row.get("definition", ""),
+            "parent_code": parent_code,
+            "depth": 0,
+            "sort_order": total + len(batch),
+        })
+        if len(batch) >= BULK_INSERT_SIZE:
+            db.bulk_insert_mappings(ConceptModel, batch)
+            total += len(batch)
+            batch = []
+            if progress:
+                progress(total)
+    if batch:
+        db.bulk_insert_mappings(ConceptModel, batch)
+        total += len(batch)
+        if progress:
+            progress(total)
+
+    if has_parents:
+        relabel_hierarchy(db, code_system_id)
+    return total
+
+
+def relabel_hierarchy(db: Session, code_system_id: str) -> int:
+    """
+    Recompute sort_order and depth of stored rows from their parent links.
+    Does not commit. Returns the number of relabelled concepts.
+    """
+    rows = db.query(
+        ConceptModel.id, ConceptModel.code, ConceptModel.parent_code
+    ).filter(
+        ConceptModel.code_system_id == code_system_id
+    ).order_by(ConceptModel.sort_order, ConceptModel.id).all()
+
+    codes = {code for _, code, _ in rows}
+    children = {}
+    for row_id, code, parent_code in rows:
+        key = parent_code if parent_code in codes else None
+        children.setdefault(key, []).append((row_id, code))
+
+    updates = []
+    stack = [(row_id, code, 0) for row_id, code in reversed(children.get(None, []))]
+    while stack:
+        row_id, code, depth = stack.pop()
+        updates.append({"id": row_id, "sort_order": len(updates), "depth": depth})
+        for child_id, child_code in reversed(children.get(code, [])):
+            stack.append((child_id, child_code, depth + 1))
+
+    # Rows on a parent cycle are unreachable from the roots; keep them as roots
+    reached = {update["id"] for update in updates}
+    for row_id, code, parent_code in rows:
+        if row_id not in reached:
+            updates.append({"id": row_id, "sort_order": len(updates), "depth": 0})
+
+    for start in range(0, len(updates), BULK_INSERT_SIZE):
+        db.bulk_update_mappings(ConceptModel, updates[start:start + BULK_INSERT_SIZE])
+    return len(updates)
+
+
+def get_concept(db: Session, code_system_id: str, code: str) -> Optional[ConceptModel]:
+    """Resolve a single code with one indexed query"""
+    return db.query(ConceptModel).filter(
+        ConceptModel.code_system_id == code_system_id,
+        ConceptModel.code == code
+    ).first()
+
+
+def concept_to_dict(row: ConceptModel) -> Dict[str, Any]:
+    """Convert a concept row to its FHIR representation (without children)"""
+    result = {
+        "code": row.code,
+        "display": row.display,
+        "definition": row.definition,
+    }
+    if row.designation:
+        result["designation"] = row.designation
+    if row.property:
+        result["property"] = row.property
+    return result
+
+
+def load_concept_tree(db: Session, code_system_id: str) -> List[Dict]:
+    """Rebuild the nested FHIR concept list of a CodeSystem"""
+    rows = db.query(ConceptModel).filter(
+        ConceptModel.code_system_id == code_system_id
+    ).order_by(ConceptModel.sort_order).all()
+
+    roots = []
+    by_code = {}
+    for row in rows:
+        concept = concept_to_dict(row)
+        by_code[row.code] = concept
+        parent = by_code.get(row.parent_code) if row.parent_code else None
+        if parent is None:
+            roots.append(concept)
+        else:
+            parent.setdefault("concept", []).append(concept)
+    return roots
@@ -0,0 +1,320 @@
+"""
+ValueSet expansion engine
+
+A compose is evaluated as set algebra over the concept IDs (pre-order
+positions) of compiled CodeSystems, held in bitsets (see services.bitset):
+every include and exclude becomes a ConceptSet, the includes are unioned
+and the excludes subtracted. Within an include, the concept list or filters and every imported ValueSet
+are intersected, as FHIR requires.
+
+Hierarchy filters are contiguous position ranges (a subtree is
+[position, subtree_end]); property filters look values up in a per
+CodeSystem property index built on first use. An intensional ValueSet over
+a large CodeSystem therefore costs a few set operations instead of a scan
+per filter.
+
+Filters on concept (or code) support =, is-a, descendent-of, is-not-a,
+generalizes, in, not-in, regex and exists. Filters on display, parent,
+child and concept properties support =, in, not-in, regex and exists.
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from itertools import chain
+import re
+import threading
+
+from services.bitset import PositionSet
+from services.terminology_cache import CompiledCodeSystem
+
+HIERARCHY_PROPERTIES = ("concept", "code")
+HIERARCHY_OPERATORS = ("is-a", "descendent-of", "is-not-a", "generalizes")
+FILTER_OPERATORS = HIERARCHY_OPERATORS + ("=", "in", "not-in", "regex", "exists")
+
+CodeSystemResolver = Callable[[str], Optional[CompiledCodeSystem]]
+
+
+class ConceptSet:
+    """
+    A set of concepts: a PositionSet per compiled CodeSystem, plus concepts
+    of systems that are not loaded here (enumerated codes of external
+    systems), kept as contains items. The set operations update self in
+    place; PositionSets are shared, never modified.
+    """
+    def __init__(self):
+        self.code_systems: Dict[str, CompiledCodeSystem] = {}
+        self.positions: Dict[str, PositionSet] = {}
+        self.external: Dict[Tuple[Optional[str], str], Dict] = {}
+        # Displays given in an enumerated include override the CodeSystem's
+        self.displays: Dict[Tuple[str, str], str] = {}
+
+    def copy(self) -> "ConceptSet":
+        result = ConceptSet()
+        result.code_systems = dict(self.code_systems)
+        result.positions = dict(self.positions)
+        result.external = dict(self.external)
+        result.displays = dict(self.displays)
+        return result
+
+    def add_positions(self, cs: CompiledCodeSystem, positions: PositionSet) -> "ConceptSet":
+        current = self.code_systems.setdefault(cs.url, cs)
+        positions = _align(current, cs, positions)
+        previous = self.positions.get(cs.url)
+        self.positions[cs.url] = positions if previous is None else previous | positions
+        return self
+
+    def add_items(self, items: Iterable[Dict], resolve: CodeSystemResolver) -> "ConceptSet":
+        """Add contains items (e.g. a stored expansion), mapped to concept IDs where possible"""
+        found: Dict[str, List[int]] = {}
+        resolved: Dict[str, Optional[CompiledCodeSystem]] = dict(self.code_systems)
+        for item in items:
+            system = item.get("system")
+            if system and system not in resolved:
+                resolved[system] = resolve(system)
+            cs = resolved.get(system) if system else None
+            position = cs.position.get(item["code"]) if cs else None
+            if position is None:
+                self.external.setdefault((system, item["code"]), item)
+                continue
+            self.code_systems.setdefault(system, cs)
+            found.setdefault(system, []).append(position)
+            if item.get("display") and item["display"] != cs.flat[position].get("display"):
+                self.displays[(system, item["code"])] = item["display"]
+        for system, positions in found.items():
+            cs = self.code_systems[system]
+            self.add_positions(cs, PositionSet.of(len(cs), positions))
+        return self
+
+    def union(self, other: "ConceptSet") -> "ConceptSet":
+        for url, positions in other.positions.items():
+            self.add_positions(other.code_systems[url], positions)
+        for key, item in other.external.items():
+            self.external.setdefault(key, item)
+        for key, display in other.displays.items():
+            self.displays.setdefault(key, display)
+        return self
+
+    def intersection(self, other: "ConceptSet") -> "ConceptSet":
+        for url in list(self.positions):
+            if url in other.positions:
+                self.positions[url] = self.positions[url] & _align(
+                    self.code_systems[url], other.code_systems[url], other.positions[url]
+                )
+            else:
+                del self.positions[url]
+        self.external = {key: item for key, item in self.external.items() if key in other.external}
+        return self
+
+    def difference(self, other: "ConceptSet") -> "ConceptSet":
+        for url, positions in other.positions.items():
+            if url in self.positions:
+                self.positions[url] = self.positions[url] - _align(
+                    self.code_systems[url], other.code_systems[url], positions
+                )
+        for key in other.external:
+            self.external.pop(key, None)
+        return self
+
+    def __len__(self) -> int:
+        return sum(len(positions) for positions in self.positions.values()) + len(self.external)
+
+    def item(self, system: str, position: int) -> Dict:
+        """The contains item of a concept given by its ID"""
+        concept = self.code_systems[system].flat[position]
+        return {
+            "system": system,
+            "code": concept["code"],
+            "display": self.displays.get((system, concept["code"]), concept.get("display"))
+        }
+
+    def items(self) -> List[Dict]:
+        """Contains items: each CodeSystem in hierarchy order, then external concepts"""
+        result = [self.item(url, position) for url, positions in self.positions.items() for position in positions.positions()]
+        for (system, code), item in self.external.items():
+            result.append({"system": system, "code": code, "display": item.get("display")})
+        return result
+
+
+def _align(target: CompiledCodeSystem, source: CompiledCodeSystem, positions: PositionSet) -> PositionSet:
+    """Translate concept IDs of source to those of target, another version of the same CodeSystem"""
+    if target.key == source.key:
+        return positions
+    codes = (source.flat[position]["code"] for position in positions.positions())
+    return PositionSet.of(len(target), (target.position[code] for code in codes if code in target.position))
+
+
+def all_positions(cs: CompiledCodeSystem) -> PositionSet:
+    return PositionSet.full(len(cs))
+
+
+def subtree(cs: CompiledCodeSystem, code: str, include_self: bool) -> PositionSet:
+    start = cs.position.get(code)
+    if start is None:
+        return PositionSet.empty(len(cs))
+    return PositionSet.range(len(cs), start if include_self else start + 1, cs.subtree_end[start] + 1)
+
+
+def ancestors(cs: CompiledCodeSystem, code: str) -> PositionSet:
+    """code and every concept above it (generalizes)"""
+    result = set()
+    while code is not None and code in cs.position and cs.position[code] not in result:
+        result.add(cs.position[code])
+        code = cs.parents.get(code)
+    return PositionSet.of(len(cs), result)
+
+
+class CodeValues:
+    """The code -> positions view of a CodeSystem that property filters expect"""
+    def __init__(self, cs: CompiledCodeSystem):
+        self.cs = cs
+
+    def get(self, code: str, default=()):
+        position = self.cs.position.get(code)
+        return default if position is None else (position,)
+
+    def items(self):
+        return ((code, (position,)) for code, position in self.cs.position.items())
+
+    def values(self):
+        return ((position,) for position in self.cs.position.values())
+
+
+def filter_positions(cs: CompiledCodeSystem, f: Dict) -> PositionSet:
+    """The concepts of cs matching one include.filter"""
+    prop, op, value = f.get("property"), f.get("op"), f.get("value")
+    if op not in FILTER_OPERATORS:
+        raise ValueError(f"Unsupported filter operator: {op}")
+    if value is None:
+        raise ValueError(f"Filter {prop} {op} requires a value")
+
+    if prop in HIERARCHY_PROPERTIES:
+        if op == "is-a":
+            return subtree(cs, value, True)
+        if op == "descendent-of":
+            return subtree(cs, value, False)
+        if op == "is-not-a":
+            return all_positions(cs) - subtree(cs, value, True)
+        if op == "generalizes":
+            return ancestors(cs, value)
+        values = CodeValues(cs)
+    elif op in HIERARCHY_OPERATORS:
+        raise ValueError(f"Filter operator {op} only applies to the concept property")
+    else:
+        values = get_property_index(cs).get(prop, {})
+
+    if op == "=":
+        return PositionSet.of(len(cs), values.get(value, ()))
+    if op in ("in", "not-in"):
+        matched = PositionSet.of(len(cs), chain.from_iterable(values.get(item.strip(), ()) for item in value.split(",")))
+        return matched if op == "in" else all_positions(cs) - matched
+    if op == "regex":
+        try:
+            pattern = re.compile(value)
+        except re.error as e:
+            raise ValueError(f"Invalid regex filter {value!r}: {e}")
+        return PositionSet.of(len(cs), chain.from_iterable(
+            positions for item, positions in values.items() if pattern.fullmatch(item)
+        ))
+    # exists
+    if value not in ("true", "false"):
+        raise ValueError("The exists filter takes true or false")
+    present = PositionSet.of(len(cs), chain.from_iterable(values.values()))
+    return present if value == "true" else all_positions(cs) - present
+
+
+def _property_value(prop: Dict) -> Optional[str]:
+    for key, value in prop.items():
+        if key.startswith("value") and value is not None:
+            if isinstance(value, bool):
+                return "true" if value else "false"
+            if isinstance(value, dict):
+                return value.get("code")
+            return str(value)
+    return None
+
+
+def build_property_index(cs: CompiledCodeSystem) -> Dict[str, Dict[str, List[int]]]:
+    """property -> value -> positions, for display, parent, child and concept properties"""
+    index: Dict[str, Dict[str, List[int]]] = {"display": {}, "parent": {}, "child": {}}
+    for position, concept in enumerate(cs.flat):
+        if concept.get("display"):
+            index["display"].setdefault(concept["display"], []).append(position)
+        parent = cs.parents.get(concept["code"])
+        if parent in cs.position:
+            index["parent"].setdefault(parent, []).append(position)
+            index["child"].setdefault(concept["code"], []).append(cs.position[parent])
+        for prop in concept.get("property") or []:
+            value = _property_value(prop)
+            if prop.get("code") and value is not None:
+                index.setdefault(prop["code"], {}).setdefault(value, []).append(position)
+    return index
+
+
+_build_lock = threading.Lock()
+
+
+def get_property_index(cs: CompiledCodeSystem) -> Dict[str, Dict[str, List[int]]]:
+    """Return the property index of a compiled CodeSystem, building it once"""
+    index = cs.property_index
+    if index is None:
+        with _build_lock:
+            index = cs.property_index
+            if index is None:
+                index = build_property_index(cs)
+                cs.property_index = index
+    return index
+
+
+def include_set(cs: Optional[CompiledCodeSystem], include: Dict) -> ConceptSet:
+    """
+    The concepts selected by the system part of an include (or exclude):
+    its enumerated concepts, or the intersection of its filters, or the
+    whole CodeSystem. Enumerated codes of a system that is not loaded are
+    kept as given.
+    """
+    system = include["system"]
+    result = ConceptSet()
+    if include.get("concept"):
+        positions = []
+        for concept in include["concept"]:
+            position = cs.position.get(concept["code"]) if cs else None
+            if position is None:
+                result.external.setdefault((system, concept["code"]), {
+                    "system": system, "code": concept["code"], "display": concept.get("display")
+                })
+                continue
+            positions.append(position)
+            if concept.get("display"):
+                result.displays[(system, concept["code"])] = concept["display"]
+        if positions:
+            result.add_positions(cs, PositionSet.of(len(cs), positions))
+        return result
+    if cs is None:
+        return result
+
+    positions = all_positions(cs)
+    for f in include.get("filter") or []:
+        positions = positions & filter_positions(cs, f)
+    return result.add_positions(cs, positions)
+
+
+def nest_contains(items: List[Dict], resolve: CodeSystemResolver) -> List[Dict]:
+    """
+    Hierarchical contains: every item is nested under its closest ancestor
+    in the expansion. Items of a CodeSystem must be in hierarchy order, as
+    ConceptSet.items() returns them.
+    """
+    roots: List[Dict] = []
+    stack: List[Tuple[Optional[str], int, Dict]] = []
+    code_systems: Dict[str, Optional[CompiledCodeSystem]] = {}
+    for item in items:
+        node = dict(item)
+        system = item.get("system")
+        if system and system not in code_systems:
+            code_systems[system] = resolve(system)
+        cs = code_systems.get(system) if system else None
+        position = cs.position.get(item["code"]) if cs else None
+        while stack and (stack[-1][0] != system or position is None or position > stack[-1][1]):
+            stack.pop()
+        (stack[-1][2].setdefault("contains", []) if stack else roots).append(node)
+        if position is not None:
+            stack.append((system, cs.subtree_end[position], node))
+    return roots
@@ -0,0 +1,58 @@
+"""
+Fast JSON output for FHIR operations
+
+Operation results are built as plain dicts with parameter()/parameters()
+and coding(), which leave out None values as FHIR requires, instead of
+Pydantic Parameter trees that then have to be dumped. FHIRJSONResponse
+renders them with orjson when it is installed (stdlib json otherwise).
+Routes return the response object itself, so FastAPI does not run
+jsonable_encoder over large payloads such as expansions.
+"""
+from typing import Any, Dict, List, Optional
+from datetime import date, datetime
+from fastapi.responses import JSONResponse
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+CODING_FIELDS = ("system", "version", "code", "display", "userSelected")
+
+
+def parameter(name: str, part: Optional[List[Dict]] = None, **value: Any) -> Dict[str, Any]:
+    """A Parameters.parameter entry, e.g. parameter("result", valueBoolean=True)"""
+    result = {"name": name}
+    for key, item in value.items():
+        if item is not None:
+            result[key] = item
+    if part is not None:
+        result["part"] = part
+    return result
+
+
+def parameters(params: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"resourceType": "Parameters", "parameter": params}
+
+
+def coding(**fields: Any) -> Dict[str, Any]:
+    """A Coding with only its known, non-empty fields"""
+    return {key: fields[key] for key in CODING_FIELDS if fields.get(key) is not None}
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FHIRJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
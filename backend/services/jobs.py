@@ -0,0 +1,368 @@
+"""
+Background jobs
+
+Long-running operations (CSV imports, full expansions, exports) can run as
+jobs instead of inside the request, following the FHIR asynchronous request
+pattern: the kick-off request returns 202 Accepted with a Content-Location
+to poll, and the job's result is served from there once it is complete.
+
+Jobs are persisted in the jobs table and executed by a thread pool of
+JOB_WORKERS threads in the server process. Each job handler receives a
+JobContext with its own database session, a progress callback and an
+output file to write its result to. Progress is kept in memory while the
+job runs, and polled from there, since a handler's open write transaction
+would block access to the jobs table on SQLite; it is stored when the job
+finishes. Cancellation is
+cooperative: handlers call check_cancelled() (progress() does it for them)
+and stop with JobCancelled once a cancel has been requested.
+
+Jobs do not survive the process running them. Each job records its owner
+(host, pid and runner instance), and the owner refreshes heartbeat_at on
+its queued and running jobs every HEARTBEAT_INTERVAL seconds. recover()
+runs at startup and with every heartbeat, and marks failed only the jobs
+whose heartbeat is older than HEARTBEAT_TIMEOUT, so the jobs of sibling
+worker processes are left alone.
+"""
+from typing import Any, Callable, Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from sqlalchemy import or_
+from sqlalchemy.exc import OperationalError
+from database import SessionLocal, JobModel
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+# Outside the source tree: outputs include full CodeSystem dumps
+JOB_OUTPUT_DIR = os.environ.get("JOB_OUTPUT_DIR", str(Path(tempfile.gettempdir()) / "terminology-jobs"))
+
+# How often a running job re-reads its cancel flag from the database, so a
+# cancel made through another server process is noticed too
+CANCEL_CHECK_INTERVAL = 1.0
+
+# How often a process refreshes the heartbeat of its jobs, and how old a
+# heartbeat gets before the job is taken to have lost its process
+HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", "30"))
+HEARTBEAT_TIMEOUT = timedelta(seconds=3 * HEARTBEAT_INTERVAL)
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+ACTIVE_STATUSES = ("queued", "running")
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    def __init__(self, job_id: str, kind: str, cancel_event: threading.Event):
+        self.job_id = job_id
+        self.kind = kind
+        self.started_at = datetime.utcnow()
+        self.count = 0
+        self.message: Optional[str] = None
+        self.db = SessionLocal()
+        self._cancel_event = cancel_event
+        self._last_cancel_check = time.monotonic()
+        self.output_path: Optional[str] = None
+        self.output_media_type: Optional[str] = None
+        self.output_filename: Optional[str] = None
+
+    def check_cancelled(self) -> None:
+        """Raise JobCancelled if the job has been cancelled"""
+        if not self._cancel_event.is_set() and time.monotonic() - self._last_cancel_check >= CANCEL_CHECK_INTERVAL:
+            self._last_cancel_check = time.monotonic()
+            try:
+                if _get_field(self.job_id, JobModel.cancel_requested):
+                    self._cancel_event.set()
+            except OperationalError:
+                # SQLite locks readers out while a large write is flushed; try again later
+                pass
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def progress(self, count: int, message: Optional[str] = None) -> None:
+        """Record how many items have been processed, then check for cancellation"""
+        self.count = count
+        self.message = message
+        self.check_cancelled()
+
+    def output_file(self, filename: str, media_type: str) -> str:
+        """Return the path the job's result file should be written to"""
+        Path(JOB_OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+        self.output_path = str(Path(JOB_OUTPUT_DIR) / f"{self.job_id}-{filename}")
+        self.output_media_type = media_type
+        self.output_filename = filename
+        return self.output_path
+
+    def output_dir(self) -> Path:
+        """Return a directory for jobs that produce several files (see job_files_dir)"""
+        path = job_files_dir(self.job_id)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+
+JobHandler = Callable[[JobContext, Dict[str, Any]], Any]
+
+
+class JobRunner:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._handlers: Dict[str, JobHandler] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: Dict[str, Future] = {}
+        self._cancel_events: Dict[str, threading.Event] = {}
+        self._contexts: Dict[str, JobContext] = {}
+        self._created_by: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._instance = uuid.uuid4().hex[:8]
+        self._heartbeat: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def owner(self) -> str:
+        # The pid is read on every call so a forked worker gets its own
+        return f"{socket.gethostname()}:{os.getpid()}:{self._instance}"
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    def start(self) -> None:
+        """Recover orphaned jobs and start the heartbeat; called at startup"""
+        self.recover()
+        with self._lock:
+            self._start_heartbeat()
+
+    def submit(self, kind: str, params: Dict[str, Any], created_by: Optional[str] = None) -> str:
+        """Persist a new job and queue it. Returns the job id."""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = str(uuid.uuid4())
+        db = SessionLocal()
+        try:
+            db.add(JobModel(
+                id=job_id, kind=kind, status="queued", params=params, created_by=created_by,
+                owner=self.owner, heartbeat_at=datetime.utcnow()
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            self._start_heartbeat()
+            self._cancel_events[job_id] = threading.Event()
+            self._created_by[job_id] = created_by
+            self._futures[job_id] = self._executor.submit(self._run, job_id, kind, params)
+        return job_id
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Request cancellation of a queued or running job. Returns False if
+        the job does not exist or has already finished.
+        """
+        with self._lock:
+            event = self._cancel_events.get(job_id)
+            future = self._futures.get(job_id)
+        if event is None:
+            # Not one of ours (or already finished); flag it for its process
+            db = SessionLocal()
+            try:
+                job = db.query(JobModel).filter(JobModel.id == job_id).first()
+                if job is None or job.status in FINISHED_STATUSES:
+                    return False
+                job.cancel_requested = True
+                db.commit()
+                return True
+            finally:
+                db.close()
+
+        event.set()
+        if future is not None and future.cancel():
+            # Never started; finish it here
+            _update(job_id, status="cancelled", finished_at=datetime.utcnow())
+            self._forget(job_id)
+        return True
+
+    def live_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Status of a job queued or running in this process, read from memory
+        so polling does not touch the jobs table. None for other jobs.
+        """
+        with self._lock:
+            if job_id not in self._cancel_events:
+                return None
+            context = self._contexts.get(job_id)
+        if context is None:
+            return {"id": job_id, "status": "queued", "progress": 0, "message": None}
+        return {
+            "id": job_id,
+            "kind": context.kind,
+            "status": "running",
+            "progress": context.count,
+            "message": context.message,
+            "startedAt": context.started_at.isoformat(),
+        }
+
+    def live_created_by(self, job_id: str) -> Tuple[bool, Optional[str]]:
+        """
+        (True, created_by) for a job queued or running in this process, read
+        from memory like live_status(); (False, None) for other jobs.
+        """
+        with self._lock:
+            if job_id not in self._created_by:
+                return False, None
+            return True, self._created_by[job_id]
+
+    def recover(self) -> int:
+        """
+        Mark as failed the queued or running jobs of other processes whose
+        heartbeat has stopped, i.e. whose process is gone
+        """
+        db = SessionLocal()
+        try:
+            stale = datetime.utcnow() - HEARTBEAT_TIMEOUT
+            count = db.query(JobModel).filter(
+                JobModel.status.in_(ACTIVE_STATUSES),
+                or_(JobModel.owner == None, JobModel.owner != self.owner),
+                or_(JobModel.heartbeat_at == None, JobModel.heartbeat_at < stale)
+            ).update({
+                JobModel.status: "failed",
+                JobModel.error: "Interrupted: the server process running the job stopped",
+                JobModel.finished_at: datetime.utcnow()
+            }, synchronize_session=False)
+            db.commit()
+            if count:
+                logger.warning("Marked %d orphaned jobs as failed", count)
+            return count
+        finally:
+            db.close()
+
+    def _start_heartbeat(self) -> None:
+        # Called with self._lock held
+        if self._heartbeat is None:
+            self._stopping.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self) -> None:
+        """Refresh the heartbeat of this process' jobs and recover orphaned ones"""
+        while not self._stopping.wait(HEARTBEAT_INTERVAL):
+            db = SessionLocal()
+            try:
+                db.query(JobModel).filter(
+                    JobModel.owner == self.owner, JobModel.status.in_(ACTIVE_STATUSES)
+                ).update({JobModel.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+                db.commit()
+                self.recover()
+            except OperationalError:
+                # SQLite may be locked by a job's write; the next beat retries
+                db.rollback()
+                logger.warning("Could not refresh the job heartbeat", exc_info=True)
+            finally:
+                db.close()
+
+    def shutdown(self) -> None:
+        """Cancel every job and wait for the running ones to stop"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            heartbeat, self._heartbeat = self._heartbeat, None
+            events = list(self._cancel_events.values())
+        self._stopping.set()
+        for event in events:
+            event.set()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if heartbeat is not None:
+            heartbeat.join()
+
+    def _run(self, job_id: str, kind: str, params: Dict[str, Any]) -> None:
+        context = JobContext(job_id, kind, self._cancel_events[job_id])
+        with self._lock:
+            self._contexts[job_id] = context
+        try:
+            context.check_cancelled()
+            _update(job_id, status="running", started_at=context.started_at)
+            result = self._handlers[kind](context, params)
+            context.check_cancelled()
+            _update(
+                job_id, status="completed", result=result, finished_at=datetime.utcnow(),
+                progress=context.count, message=context.message,
+                output_path=context.output_path, output_media_type=context.output_media_type,
+                output_filename=context.output_filename
+            )
+        except JobCancelled:
+            context.db.rollback()
+            _remove_outputs(job_id, context.output_path)
+            _update(job_id, status="cancelled", finished_at=datetime.utcnow(), progress=context.count)
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, kind)
+            context.db.rollback()
+            _remove_outputs(job_id, context.output_path)
+            _update(job_id, status="failed", error=str(e), finished_at=datetime.utcnow(), progress=context.count)
+        finally:
+            context.db.close()
+            self._forget(job_id)
+
+    def _forget(self, job_id: str) -> None:
+        with self._lock:
+            self._futures.pop(job_id, None)
+            self._cancel_events.pop(job_id, None)
+            self._contexts.pop(job_id, None)
+            self._created_by.pop(job_id, None)
+
+
+def _update(job_id: str, **values) -> None:
+    db = SessionLocal()
+    try:
+        db.query(JobModel).filter(JobModel.id == job_id).update(
+            {getattr(JobModel, name): value for name, value in values.items()}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _get_field(job_id: str, column):
+    db = SessionLocal()
+    try:
+        return db.query(column).filter(JobModel.id == job_id).scalar()
+    finally:
+        db.close()
+
+
+def job_files_dir(job_id: str) -> Path:
+    return Path(JOB_OUTPUT_DIR) / job_id
+
+
+def _remove_outputs(job_id: str, path: Optional[str]) -> None:
+    if path:
+        Path(path).unlink(missing_ok=True)
+    shutil.rmtree(job_files_dir(job_id), ignore_errors=True)
+
+
+def delete_job(job_id: str) -> bool:
+    """Delete a finished job and its output files"""
+    db = SessionLocal()
+    try:
+        job = db.query(JobModel).filter(JobModel.id == job_id).first()
+        if job is None or job.status not in FINISHED_STATUSES:
+            return False
+        _remove_outputs(job.id, job.output_path)
+        db.delete(job)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+job_runner = JobRunner()
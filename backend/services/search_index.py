@@ -0,0 +1,207 @@
+"""
+In-process search index for $find-matches
+
+Each compiled CodeSystem gets an inverted index built on first search: for
+every searchable field (display, code, definition and string/code concept
+properties) a token -> positions posting map, a sorted vocabulary for prefix
+lookups, exact-value maps and the lowercased values joined into one string,
+scanned for substring matches. Positions are pre-order indexes into
+CompiledCodeSystem.flat, so postings are sorted and whole-word results come
+back in hierarchy order.
+
+Results are ranked in tiers, evaluated in order and stopped as soon as the
+requested limit is reached:
+  0. the whole field equals the query (case-insensitive)
+  1. every query word is a whole word of the field
+  2. every query word is a prefix of a word of the field
+  3. the query occurs anywhere in the field (case-insensitive)
+Within a tier, fields are tried in order (display, code, definition, or the
+requested property).
+"""
+from typing import List, Optional, Dict, Tuple, Iterator
+from bisect import bisect_left, bisect_right
+from itertools import chain
+import re
+import threading
+
+DEFAULT_FIELDS = ("display", "code", "definition")
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Separates field values in FieldIndex.text
+SEPARATOR = "\x00"
+
+
+def tokenize(value: str) -> List[str]:
+    return _TOKEN_RE.findall(value.lower())
+
+
+class FieldIndex:
+    def __init__(self):
+        self.postings: Dict[str, List[int]] = {}
+        self.tokens: Dict[int, frozenset] = {}
+        self.exact: Dict[str, List[int]] = {}
+        self.exact_lower: Dict[str, List[int]] = {}
+        self.vocabulary: List[str] = []
+        # Lowercased values in position order, joined by SEPARATOR; value i
+        # starts at text_starts[i] and belongs to text_positions[i]
+        self.text = ""
+        self.text_starts: List[int] = []
+        self.text_positions: List[int] = []
+        self._values: List[str] = []
+
+    def add(self, position: int, value: str, whole_token: bool = False) -> None:
+        tokens = tokenize(value)
+        if whole_token:
+            tokens.append(value.lower())
+        self.exact.setdefault(value, []).append(position)
+        self.exact_lower.setdefault(value.lower(), []).append(position)
+        self._values.append(value.lower())
+        self.text_positions.append(position)
+        unique = frozenset(tokens)
+        previous = self.tokens.get(position)
+        self.tokens[position] = unique if previous is None else previous | unique
+        for token in unique:
+            self.postings.setdefault(token, []).append(position)
+
+    def finish(self) -> None:
+        self.vocabulary = sorted(self.postings)
+        start = 0
+        for value in self._values:
+            self.text_starts.append(start)
+            start += len(value) + len(SEPARATOR)
+        self.text = SEPARATOR.join(self._values)
+        self._values = []
+
+    def expand(self, prefix: str) -> List[str]:
+        """Vocabulary tokens starting with prefix"""
+        start = bisect_left(self.vocabulary, prefix)
+        end = bisect_left(self.vocabulary, prefix + "\U0010ffff", start)
+        return self.vocabulary[start:end]
+
+    def word_matches(self, words: List[str]) -> Iterator[int]:
+        """Lazily yield positions containing every word, in order"""
+        lists = [self.postings.get(word) for word in words]
+        if not all(lists):
+            return
+        driver = min(lists, key=len)
+        for position in driver:
+            tokens = self.tokens[position]
+            if all(word in tokens for word in words):
+                yield position
+
+    def prefix_matches(self, prefixes: List[str]) -> Iterator[int]:
+        """
+        Lazily yield positions where every prefix starts some word. Positions
+        come out grouped by matching word in vocabulary order, so short
+        prefixes with many expansions still stop early. May repeat positions.
+        """
+        expansions = [self.expand(prefix) for prefix in prefixes]
+        if not all(expansions):
+            return
+        # Drive from the most selective prefix, check the others per position
+        driver = min(range(len(prefixes)), key=lambda i: len(expansions[i]))
+        others = [prefix for i, prefix in enumerate(prefixes) if i != driver]
+        for position in chain.from_iterable(self.postings[t] for t in expansions[driver]):
+            tokens = self.tokens[position]
+            if all(any(t.startswith(prefix) for t in tokens) for prefix in others):
+                yield position
+
+    def substring_matches(self, text: str) -> Iterator[int]:
+        """
+        Lazily yield positions where text occurs anywhere in the field, in
+        order, scanning the joined values with str.find. May repeat positions.
+        """
+        if not text or SEPARATOR in text:
+            return
+        offset = self.text.find(text)
+        while offset != -1:
+            entry = bisect_right(self.text_starts, offset) - 1
+            yield self.text_positions[entry]
+            if entry + 1 == len(self.text_starts):
+                return
+            offset = self.text.find(text, self.text_starts[entry + 1])
+
+
+class SearchIndex:
+    def __init__(self, flat: List[Dict]):
+        self.fields: Dict[str, FieldIndex] = {}
+        for position, concept in enumerate(flat):
+            if concept.get("display"):
+                self._field("display").add(position, concept["display"])
+            if concept.get("code"):
+                self._field("code").add(position, concept["code"], whole_token=True)
+            if concept.get("definition"):
+                self._field("definition").add(position, concept["definition"])
+            for prop in concept.get("property") or []:
+                value = prop.get("valueString", prop.get("valueCode"))
+                if prop.get("code") and value is not None:
+                    self._field(prop["code"]).add(position, str(value))
+        for field in self.fields.values():
+            field.finish()
+
+    def _field(self, name: str) -> FieldIndex:
+        if name not in self.fields:
+            self.fields[name] = FieldIndex()
+        return self.fields[name]
+
+    def search(self, value: str, fields: Optional[List[str]] = None, exact: bool = False,
+               limit: int = 100) -> List[Tuple[Tuple[int, int], int]]:
+        """
+        Return up to limit (rank, position) pairs, best first. rank is
+        (tier, field priority) and can be merged across CodeSystems.
+        """
+        field_indexes = [
+            (priority, self.fields[name])
+            for priority, name in enumerate(fields or DEFAULT_FIELDS) if name in self.fields
+        ]
+        results = []
+        seen = set()
+
+        def collect(tier: int, priority: int, positions) -> bool:
+            for position in positions:
+                if position not in seen:
+                    seen.add(position)
+                    results.append(((tier, priority), position))
+                    if len(results) >= limit:
+                        return True
+            return False
+
+        if exact:
+            for priority, field in field_indexes:
+                if collect(0, priority, field.exact.get(value, ())):
+                    return results
+            return results
+
+        words = tokenize(value)
+        if not words:
+            return results
+        lowered = value.lower()
+        for priority, field in field_indexes:
+            if collect(0, priority, field.exact_lower.get(lowered, ())):
+                return results
+        for priority, field in field_indexes:
+            if collect(1, priority, field.word_matches(words)):
+                return results
+        for priority, field in field_indexes:
+            if collect(2, priority, field.prefix_matches(words)):
+                return results
+        for priority, field in field_indexes:
+            if collect(3, priority, field.substring_matches(lowered)):
+                return results
+        return results
+
+
+_build_lock = threading.Lock()
+
+
+def get_search_index(cs) -> SearchIndex:
+    """Return the search index of a compiled CodeSystem, building it once"""
+    index = getattr(cs, "search_index", None)
+    if index is None:
+        with _build_lock:
+            index = getattr(cs, "search_index", None)
+            if index is None:
+                index = SearchIndex(cs.flat)
+                cs.search_index = index
+    return index
@@ -0,0 +1,355 @@
+"""
+In-process caches of compiled CodeSystems and ValueSet expansions
+
+A compiled CodeSystem holds its concepts as a code -> concept dict, parent/child
+adjacency and a flattened pre-order list, so hot-path operations never touch
+the database. Entries are keyed by (url, version, updated_at), evicted LRU once
+the total number of cached concepts exceeds the configured bound, and dropped
+whenever a transaction that modified the CodeSystem row commits. Every hit is
+also checked against the row's updated_at, since another worker process may
+have changed it.
+
+Cached expansions hold bitsets of concept IDs (see services.bitset) rather
+than lists of contains items. They are keyed by ValueSet url and dropped when the ValueSet row,
+a ValueSet it imports (include.valueSet) or one of the CodeSystems they were
+expanded from changes.
+"""
+from typing import Iterator, List, Optional, Dict, Tuple
+from collections import OrderedDict
+from itertools import islice
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from database import SessionLocal, CodeSystemModel, ConceptModel, ValueSetModel
+from services import concept_store
+import os
+import threading
+
+CODESYSTEM_CACHE_MAX_CONCEPTS = int(os.environ.get("CODESYSTEM_CACHE_MAX_CONCEPTS", "1000000"))
+VALUESET_EXPANSION_CACHE_SIZE = int(os.environ.get("VALUESET_EXPANSION_CACHE_SIZE", "256"))
+
+
+class CompiledCodeSystem:
+    def __init__(self, cs: CodeSystemModel, rows: List[ConceptModel]):
+        self.id = cs.id
+        self.url = cs.url
+        self.version = cs.version
+        self.name = cs.name
+        self.updated_at = cs.updated_at
+        self.key = (cs.url, cs.version, cs.updated_at)
+        # Built on first $find-matches, see services.search_index
+        self.search_index = None
+        # Built on the first property filter, see services.expansion_engine
+        self.property_index = None
+
+        self.flat: List[Dict] = []
+        self.concepts: Dict[str, Dict] = {}
+        self.parents: Dict[str, Optional[str]] = {}
+        self.children: Dict[Optional[str], List[str]] = {}
+        for row in rows:
+            concept = concept_store.concept_to_dict(row)
+            self.concepts[row.code] = concept
+            self.parents[row.code] = row.parent_code
+        for row in rows:
+            parent = row.parent_code if row.parent_code in self.concepts else None
+            self.children.setdefault(parent, []).append(row.code)
+
+        # Ancestor index: pre-order positions with the position of the last
+        # descendant, so subsumption is a pair of integer comparisons. The
+        # positions double as dense concept IDs for this version.
+        self.position: Dict[str, int] = {}
+        self.subtree_end: List[int] = []
+        stack = [(code, False) for code in reversed(self.children.get(None, []))]
+        while stack:
+            code, closing = stack.pop()
+            if closing:
+                self.subtree_end[self.position[code]] = len(self.flat) - 1
+                continue
+            if code in self.position:
+                continue
+            self.position[code] = len(self.flat)
+            self.flat.append(self.concepts[code])
+            self.subtree_end.append(len(self.flat) - 1)
+            stack.append((code, True))
+            for child in reversed(self.children.get(code, [])):
+                stack.append((child, False))
+        # Concepts on a parent cycle are unreachable from the roots
+        for row in rows:
+            if row.code not in self.position:
+                self.position[row.code] = len(self.flat)
+                self.flat.append(self.concepts[row.code])
+                self.subtree_end.append(len(self.flat) - 1)
+
+    def __len__(self) -> int:
+        return len(self.flat)
+
+    def get(self, code: str) -> Optional[Dict]:
+        return self.concepts.get(code)
+
+    def is_descendant(self, ancestor_code: str, code: str) -> bool:
+        """Check if code is below ancestor_code"""
+        start = self.position.get(ancestor_code)
+        position = self.position.get(code)
+        if start is None or position is None:
+            return False
+        return start < position <= self.subtree_end[start]
+
+    def descendants(self, code: str, include_self: bool = False) -> List[Dict]:
+        """Concepts below code (is-a when include_self, descendent-of otherwise)"""
+        start = self.position.get(code)
+        if start is None:
+            return []
+        return self.flat[start if include_self else start + 1:self.subtree_end[start] + 1]
+
+
+class CodeSystemCache:
+    def __init__(self, max_concepts: int = CODESYSTEM_CACHE_MAX_CONCEPTS):
+        self.max_concepts = max_concepts
+        self._entries: "OrderedDict[Tuple, CompiledCodeSystem]" = OrderedDict()
+        self._by_url: Dict[str, Tuple] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, url: str, version: Optional[str] = None) -> Optional[CompiledCodeSystem]:
+        with self._lock:
+            key = self._by_url.get(url)
+            if key is None:
+                return None
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+        if version and entry.version != version:
+            return None
+        return entry
+
+    def put(self, entry: CompiledCodeSystem) -> List[str]:
+        """
+        Add entry, replacing any entry for the same url. Returns the urls of
+        the entries replaced or evicted, whose cached expansions must go too.
+        """
+        with self._lock:
+            dropped = [entry.url] if self._remove(entry.url) else []
+            self._entries[entry.key] = entry
+            self._by_url[entry.url] = entry.key
+            self._size += len(entry)
+            # Evict least recently used entries, always keeping the newest one
+            while self._size > self.max_concepts and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                del self._by_url[evicted.url]
+                self._size -= len(evicted)
+                dropped.append(evicted.url)
+            return dropped
+
+    def invalidate(self, url: str) -> None:
+        with self._lock:
+            self._remove(url)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_url.clear()
+            self._size = 0
+
+    def _remove(self, url: str) -> bool:
+        key = self._by_url.pop(url, None)
+        if key is None:
+            return False
+        self._size -= len(self._entries.pop(key))
+        return True
+
+
+code_system_cache = CodeSystemCache()
+
+
+def get_compiled_code_system(db: Session, url: str, version: Optional[str] = None) -> Optional[CompiledCodeSystem]:
+    """
+    Return the compiled CodeSystem for url, loading it on a cache miss. A
+    hit is checked against the row's id, version and updated_at (one small
+    query), so changes committed by another worker process are picked up.
+    """
+    query = db.query(
+        CodeSystemModel.id, CodeSystemModel.url, CodeSystemModel.version, CodeSystemModel.updated_at
+    ).filter(CodeSystemModel.url == url)
+    if version:
+        query = query.filter(CodeSystemModel.version == version)
+    row = query.first()
+    if not row:
+        return None
+
+    compiled = code_system_cache.get(url, version)
+    if compiled is not None and compiled.id == row.id and compiled.key == (row.url, row.version, row.updated_at):
+        return compiled
+
+    cs = db.query(CodeSystemModel).filter(CodeSystemModel.id == row.id).first()
+    if not cs:
+        return None
+
+    rows = db.query(ConceptModel).filter(
+        ConceptModel.code_system_id == cs.id
+    ).order_by(ConceptModel.sort_order).all()
+    compiled = CompiledCodeSystem(cs, rows)
+    # Expansions hold references to the compiled systems they draw from, so
+    # they are dropped with them to keep the cache bounded by max_concepts
+    for dropped in code_system_cache.put(compiled):
+        expansion_cache.invalidate_system(dropped)
+    return compiled
+
+
+class CachedExpansion:
+    """
+    An expansion held as a ConceptSet (see services.expansion_engine): a
+    bitset of concept IDs per CodeSystem rather than a list of contains
+    items, which are built as they are read. Positions in the expansion
+    follow ConceptSet.items(): each CodeSystem in hierarchy order, then
+    concepts of systems that are not loaded.
+    """
+    def __init__(self, vs: ValueSetModel, fingerprint: str, systems: List[str], concepts,
+                 valuesets: Optional[List[str]] = None):
+        self.id = vs.id
+        self.url = vs.url
+        self.name = vs.name
+        self.status = vs.status
+        self.fingerprint = fingerprint
+        self.systems = set(systems)
+        # Urls of the ValueSets imported, directly or not
+        self.valuesets = set(valuesets or ())
+        self.concepts = concepts
+
+        # Where each CodeSystem's block starts in the expansion
+        self.offsets: Dict[str, int] = {}
+        offset = 0
+        for url, positions in concepts.positions.items():
+            self.offsets[url] = offset
+            offset += len(positions)
+        self.external = list(concepts.external.values())
+        self.external_positions: Dict[Tuple[Optional[str], str], int] = {
+            key: offset + index for index, key in enumerate(concepts.external)
+        }
+        self.external_by_code: Dict[str, Dict] = {}
+        for item in self.external:
+            self.external_by_code.setdefault(item["code"], item)
+        self.total = offset + len(self.external)
+
+    def __len__(self) -> int:
+        return self.total
+
+    def iter_items(self, start: int = 0) -> Iterator[Dict]:
+        """Yield contains items from expansion position start"""
+        for url, positions in self.concepts.positions.items():
+            size = len(positions)
+            if start >= size:
+                start -= size
+                continue
+            for position in positions.positions(start):
+                yield self.concepts.item(url, position)
+            start = 0
+        for item in islice(self.external, start, None):
+            yield {"system": item.get("system"), "code": item["code"], "display": item.get("display")}
+
+    def find(self, code: str, system: Optional[str] = None) -> Optional[Dict]:
+        systems = [system] if system else list(self.concepts.positions)
+        for url in systems:
+            positions = self.concepts.positions.get(url)
+            position = self.concepts.code_systems[url].position.get(code) if positions is not None else None
+            if position is not None and position in positions:
+                return self.concepts.item(url, position)
+        if system:
+            return self.concepts.external.get((system, code))
+        return self.external_by_code.get(code)
+
+    def find_many(self, keys: List[Tuple[Optional[str], str]]) -> List[Optional[Dict]]:
+        """find() for many (system, code) pairs, testing membership with one bitset lookup per CodeSystem"""
+        results: List[Optional[Dict]] = [None] * len(keys)
+        lookups: Dict[str, List[Tuple[int, int]]] = {}
+        for index, (system, code) in enumerate(keys):
+            position = self.concepts.code_systems[system].position.get(code) if system in self.concepts.positions else None
+            if position is None:
+                results[index] = self.find(code, system)
+            else:
+                lookups.setdefault(system, []).append((index, position))
+        for system, pairs in lookups.items():
+            members = self.concepts.positions[system].contains_many([position for _, position in pairs])
+            for (index, position), member in zip(pairs, members):
+                if member:
+                    results[index] = self.concepts.item(system, position)
+        return results
+
+    def index(self, system: Optional[str], code: str) -> Optional[int]:
+        """Position of a concept in the expansion, for keyset paging"""
+        positions = self.concepts.positions.get(system)
+        position = self.concepts.code_systems[system].position.get(code) if positions is not None else None
+        if position is not None and position in positions:
+            return self.offsets[system] + positions.rank(position)
+        return self.external_positions.get((system, code))
+
+
+class ExpansionCache:
+    def __init__(self, max_entries: int = VALUESET_EXPANSION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedExpansion]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[CachedExpansion]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, entry: CachedExpansion) -> None:
+        with self._lock:
+            self._entries[entry.url] = entry
+            self._entries.move_to_end(entry.url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url: str) -> None:
+        """Drop the expansion of url and every expansion that imports it"""
+        with self._lock:
+            self._entries.pop(url, None)
+            for key in [key for key, entry in self._entries.items() if url in entry.valuesets]:
+                del self._entries[key]
+
+    def invalidate_system(self, system_url: str) -> None:
+        """Drop every expansion that draws concepts from system_url"""
+        with self._lock:
+            for url in [url for url, entry in self._entries.items() if system_url in entry.systems]:
+                del self._entries[url]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+expansion_cache = ExpansionCache()
+
+
+# Invalidate on commit of any transaction that touched a CodeSystem or ValueSet row
+def _changed_urls(session, model) -> set:
+    urls = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, model):
+            history = inspect(obj).attrs.url.history
+            urls.update(u for u in (history.deleted or ()) if u)
+            if obj.url:
+                urls.add(obj.url)
+    return urls
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_changes(session, flush_context):
+    session.info.setdefault("changed_code_system_urls", set()).update(_changed_urls(session, CodeSystemModel))
+    session.info.setdefault("changed_value_set_urls", set()).update(_changed_urls(session, ValueSetModel))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_changed(session):
+    for url in session.info.pop("changed_code_system_urls", ()):
+        code_system_cache.invalidate(url)
+        expansion_cache.invalidate_system(url)
+    for url in session.info.pop("changed_value_set_urls", ()):
+        expansion_cache.invalidate(url)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("changed_code_system_urls", None)
+    session.info.pop("changed_value_set_urls", None)
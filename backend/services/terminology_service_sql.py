@@ -1,152 +1,256 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Tuple
 from datetime import datetime, timezone
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, defer
 from sqlalchemy import or_
-from models.fhir_models import (
-    Parameters, Parameter, Coding, ValueSetExpansion, ValueSetExpansionContains
+from sqlalchemy.exc import SQLAlchemyError
+from models.fhir_models import ValueSetExpansion, ValueSetExpansionContains
+from database import SessionLocal, CodeSystemModel, ValueSetModel, ConceptMapModel
+from services.terminology_cache import (
+    CompiledCodeSystem, CachedExpansion, get_compiled_code_system, expansion_cache
 )
-from database import CodeSystemModel, ValueSetModel, ConceptMapModel
+from services.search_index import get_search_index
+from services.expansion_engine import ConceptSet, include_set, nest_contains
+from services.fhir_json import parameter, parameters, coding
+from itertools import islice
+import base64
+import hashlib
 import json
+import logging
 import uuid
 
+logger = logging.getLogger(__name__)
+
+
 class TerminologyServiceSQL:
     def __init__(self):
         pass
 
-    def lookup(self, db: Session, system: str, code: str, version: Optional[str] = None, properties: Optional[List[str]] = None) -> Parameters:
-        query = db.query(CodeSystemModel).filter(CodeSystemModel.url == system)
-        if version:
-            query = query.filter(CodeSystemModel.version == version)
-        
-        cs_model = query.first()
-        if not cs_model:
-            return Parameters(parameter=[Parameter(name="message", valueString=f"Code system {system} not found")])
+    def lookup(self, db: Session, system: str, code: str, version: Optional[str] = None, properties: Optional[List[str]] = None) -> Dict:
+        cs = get_compiled_code_system(db, system, version)
+        return self._lookup_in_code_system(cs, system, code, properties)
+
+    def lookup_codes(self, db: Session, codings: List[Dict[str, Any]], properties: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Batch $lookup: resolve many codings, loading each (system, version)
+        once. Returns one result per coding, in order.
+        """
+        systems = {}
+        results = []
+        for coding in codings:
+            key = (coding.get("system"), coding.get("version"))
+            if key not in systems:
+                systems[key] = get_compiled_code_system(db, key[0], key[1]) if key[0] else None
+            results.append(self._lookup_in_code_system(systems[key], key[0], coding.get("code"), properties))
+        return results
+
+    def _lookup_in_code_system(self, cs: Optional[CompiledCodeSystem], system: Optional[str], code: str, properties: Optional[List[str]] = None) -> Dict:
+        if not cs:
+            return parameters([parameter("message", valueString=f"Code system {system} not found")])
         
-        # Parse concepts from JSON string
-        concepts = json.loads(cs_model.concept) if cs_model.concept and isinstance(cs_model.concept, str) else (cs_model.concept or [])
-        concept = self._find_concept(concepts, code)
+        concept = cs.get(code)
         if not concept:
-            return Parameters(parameter=[Parameter(name="message", valueString=f"Code {code} not found")])
+            return parameters([parameter("message", valueString=f"Code {code} not found")])
         
         params = [
-            Parameter(name="name", valueString=cs_model.name),
-            Parameter(name="display", valueString=concept.get("display", "")),
+            parameter("name", valueString=cs.name),
+            parameter("display", valueString=concept.get("display") or ""),
         ]
-        if cs_model.version:
-            params.append(Parameter(name="version", valueString=cs_model.version))
+        if cs.version:
+            params.append(parameter("version", valueString=cs.version))
         if concept.get("definition"):
-            params.append(Parameter(name="definition", valueString=concept["definition"]))
-        
-        return Parameters(parameter=params)
+            params.append(parameter("definition", valueString=concept["definition"]))
+        
+        # Without an explicit property list, return designations and all stored properties
+        wanted = set(properties) if properties else None
+        if wanted is None or "designation" in wanted:
+            for designation in concept.get("designation") or []:
+                parts = []
+                if designation.get("language"):
+                    parts.append(parameter("language", valueCode=designation["language"]))
+                if designation.get("use"):
+                    parts.append(parameter("use", valueCoding=coding(**designation["use"])))
+                parts.append(parameter("value", valueString=designation.get("value")))
+                params.append(parameter("designation", part=parts))
+        
+        stored = set()
+        for prop in concept.get("property") or []:
+            stored.add(prop.get("code"))
+            if wanted is None or prop.get("code") in wanted:
+                params.append(self._property_parameter(prop))
+        
+        # parent/child come from the hierarchy when not stored as properties
+        if wanted:
+            if "parent" in wanted and "parent" not in stored and cs.parents.get(code) in cs.concepts:
+                params.append(self._property_parameter({"code": "parent", "valueCode": cs.parents[code]}))
+            if "child" in wanted and "child" not in stored:
+                for child in cs.children.get(code, []):
+                    params.append(self._property_parameter({"code": "child", "valueCode": child}))
+        
+        return parameters(params)
 
-    def validate_code(self, db: Session, system: str, code: str, version: Optional[str] = None, display: Optional[str] = None) -> Parameters:
-        query = db.query(CodeSystemModel).filter(CodeSystemModel.url == system)
-        if version:
-            query = query.filter(CodeSystemModel.version == version)
-        
-        cs = query.first()
+    def _property_parameter(self, prop: Dict[str, Any]) -> Dict:
+        parts = [parameter("code", valueCode=prop.get("code"))]
+        for key, value in prop.items():
+            if key.startswith("value") and value is not None:
+                if key == "valueCoding":
+                    value = coding(**value)
+                elif key == "valueDateTime":
+                    key = "valueString"
+                parts.append(parameter("value", **{key: value}))
+                break
+        return parameter("property", part=parts)
+
+    def validate_code(self, db: Session, system: str, code: str, version: Optional[str] = None, display: Optional[str] = None) -> Dict:
+        cs = get_compiled_code_system(db, system, version)
+        return self._validate_in_code_system(cs, code, display)
+
+    def validate_codes(self, db: Session, codings: List[Dict[str, Any]]) -> List[Dict]:
+        """
+        Batch $validate-code: validate many codings, loading each
+        (system, version) once. Returns one result per coding, in order.
+        """
+        systems = {}
+        results = []
+        for coding in codings:
+            key = (coding.get("system"), coding.get("version"))
+            if key not in systems:
+                systems[key] = get_compiled_code_system(db, key[0], key[1]) if key[0] else None
+            results.append(self._validate_in_code_system(systems[key], coding.get("code"), coding.get("display")))
+        return results
+
+    def _validate_in_code_system(self, cs: Optional[CompiledCodeSystem], code: str, display: Optional[str] = None) -> Dict:
         if not cs:
-            return Parameters(parameter=[
-                Parameter(name="result", valueBoolean=False),
-                Parameter(name="message", valueString=f"Code system not found")
+            return parameters([
+                parameter("result", valueBoolean=False),
+                parameter("message", valueString=f"Code system not found")
             ])
         
-        concepts = json.loads(cs.concept) if cs.concept and isinstance(cs.concept, str) else (cs.concept or [])
-        concept = self._find_concept(concepts, code)
+        concept = cs.get(code)
         if not concept:
-            return Parameters(parameter=[
-                Parameter(name="result", valueBoolean=False),
-                Parameter(name="message", valueString=f"Code not found")
+            return parameters([
+                parameter("result", valueBoolean=False),
+                parameter("message", valueString=f"Code not found")
             ])
         
-        params = [Parameter(name="result", valueBoolean=True)]
+        params = [parameter("result", valueBoolean=True)]
         if display and concept.get("display") and display != concept["display"]:
-            params.append(Parameter(name="message", valueString=f"Display incorrect. Expected: {concept['display']}"))
+            params.append(parameter("message", valueString=f"Display incorrect. Expected: {concept['display']}"))
         if concept.get("display"):
-            params.append(Parameter(name="display", valueString=concept["display"]))
+            params.append(parameter("display", valueString=concept["display"]))
         
-        return Parameters(parameter=params)
+        return parameters(params)
     
-    def subsumes(self, db: Session, system: str, codeA: str, codeB: str, version: Optional[str] = None) -> Parameters:
+    def subsumes(self, db: Session, system: str, codeA: str, codeB: str, version: Optional[str] = None) -> Dict:
         """
         Test the subsumption relationship between two codes
         Returns: equivalent | subsumes | subsumed-by | not-subsumed
         """
-        query = db.query(CodeSystemModel).filter(CodeSystemModel.url == system)
-        if version:
-            query = query.filter(CodeSystemModel.version == version)
-        
-        cs = query.first()
+        cs = get_compiled_code_system(db, system, version)
         if not cs:
-            return Parameters(parameter=[
-                Parameter(name="outcome", valueString="not-subsumed"),
-                Parameter(name="message", valueString=f"Code system not found")
+            return parameters([
+                parameter("outcome", valueString="not-subsumed"),
+                parameter("message", valueString=f"Code system not found")
             ])
         
-        concepts = json.loads(cs.concept) if cs.concept and isinstance(cs.concept, str) else (cs.concept or [])
-        
         # Check if codes exist
-        conceptA = self._find_concept(concepts, codeA)
-        conceptB = self._find_concept(concepts, codeB)
+        conceptA = cs.get(codeA)
+        conceptB = cs.get(codeB)
         
         if not conceptA or not conceptB:
-            return Parameters(parameter=[
-                Parameter(name="outcome", valueString="not-subsumed"),
-                Parameter(name="message", valueString="One or both codes not found")
+            return parameters([
+                parameter("outcome", valueString="not-subsumed"),
+                parameter("message", valueString="One or both codes not found")
             ])
         
         # If codes are the same, they're equivalent
         if codeA == codeB:
-            return Parameters(parameter=[Parameter(name="outcome", valueString="equivalent")])
+            return parameters([parameter("outcome", valueString="equivalent")])
         
         # Check if codeA subsumes codeB (codeB is a child of codeA)
-        if self._is_descendant(concepts, codeA, codeB):
-            return Parameters(parameter=[Parameter(name="outcome", valueString="subsumes")])
+        if cs.is_descendant(codeA, codeB):
+            return parameters([parameter("outcome", valueString="subsumes")])
         
         # Check if codeB subsumes codeA (codeA is a child of codeB)
-        if self._is_descendant(concepts, codeB, codeA):
-            return Parameters(parameter=[Parameter(name="outcome", valueString="subsumed-by")])
+        if cs.is_descendant(codeB, codeA):
+            return parameters([parameter("outcome", valueString="subsumed-by")])
         
-        return Parameters(parameter=[Parameter(name="outcome", valueString="not-subsumed")])
+        return parameters([parameter("outcome", valueString="not-subsumed")])
 
     def validate_code_in_valueset(self, db: Session, url: str, code: str, system: Optional[str] = None, 
-                                   display: Optional[str] = None, version: Optional[str] = None) -> Parameters:
+                                   display: Optional[str] = None, version: Optional[str] = None) -> Dict:
         """
         Validate a code against a ValueSet
         """
-        vs = db.query(ValueSetModel).filter(ValueSetModel.url == url).first()
-        if not vs:
-            return Parameters(parameter=[
-                Parameter(name="result", valueBoolean=False),
-                Parameter(name="message", valueString="ValueSet not found")
+        try:
+            expansion = self._find_expansion(db, url)
+        except ValueError as e:
+            return parameters([parameter("result", valueBoolean=False), parameter("message", valueString=str(e))])
+        return self._validate_in_expansion(expansion, code, system, display)
+
+    def validate_codes_in_valueset(self, db: Session, codings: List[Dict[str, Any]], url: Optional[str] = None) -> List[Dict]:
+        """
+        Batch ValueSet $validate-code: each coding is checked against its own
+        "url" or the shared url, expanding every ValueSet once.
+        """
+        by_url: Dict[Optional[str], List[int]] = {}
+        for index, coding in enumerate(codings):
+            by_url.setdefault(coding.get("url") or url, []).append(index)
+        
+        results: List[Optional[Dict]] = [None] * len(codings)
+        for vs_url, indexes in by_url.items():
+            try:
+                expansion = self._find_expansion(db, vs_url) if vs_url else None
+            except ValueError as e:
+                # e.g. a circular or missing ValueSet import
+                error = parameters([parameter("result", valueBoolean=False), parameter("message", valueString=str(e))])
+                for index in indexes:
+                    results[index] = error
+                continue
+            if expansion is None:
+                for index in indexes:
+                    results[index] = self._validate_in_expansion(None, codings[index].get("code"))
+                continue
+            # Membership of the whole group is tested against the expansion's bitsets at once
+            items = expansion.find_many([(codings[index].get("system"), codings[index].get("code")) for index in indexes])
+            for index, item in zip(indexes, items):
+                results[index] = self._validation_result(item, codings[index].get("display"))
+        return results
+
+    def _find_expansion(self, db: Session, url: str) -> Optional[CachedExpansion]:
+        # The stored expansion is only loaded if the cached one is stale
+        vs = db.query(ValueSetModel).options(defer(ValueSetModel.expansion)).filter(ValueSetModel.url == url).first()
+        return self._get_expansion(db, vs) if vs else None
+
+    def _validate_in_expansion(self, expansion: Optional[CachedExpansion], code: str, system: Optional[str] = None,
+                               display: Optional[str] = None) -> Dict:
+        if expansion is None:
+            return parameters([
+                parameter("result", valueBoolean=False),
+                parameter("message", valueString="ValueSet not found")
             ])
         
-        # Expand the valueset
-        expanded = self._perform_expansion(db, vs.compose or {}, None)
-        
-        # Check if code exists in expansion
-        for item in expanded:
-            if item["code"] == code:
-                if system and item.get("system") != system:
-                    continue
-                if display and item.get("display") and display != item["display"]:
-                    return Parameters(parameter=[
-                        Parameter(name="result", valueBoolean=True),
-                        Parameter(name="message", valueString=f"Display incorrect. Expected: {item['display']}")
-                    ])
-                return Parameters(parameter=[
-                    Parameter(name="result", valueBoolean=True),
-                    Parameter(name="display", valueString=item.get("display", ""))
+        return self._validation_result(expansion.find(code, system), display)
+
+    def _validation_result(self, item: Optional[Dict], display: Optional[str] = None) -> Dict:
+        if item:
+            if display and item.get("display") and display != item["display"]:
+                return parameters([
+                    parameter("result", valueBoolean=True),
+                    parameter("message", valueString=f"Display incorrect. Expected: {item['display']}")
                 ])
+            return parameters([
+                parameter("result", valueBoolean=True),
+                parameter("display", valueString=item.get("display", ""))
+            ])
         
-        return Parameters(parameter=[
-            Parameter(name="result", valueBoolean=False),
-            Parameter(name="message", valueString="Code not found in ValueSet")
+        return parameters([
+            parameter("result", valueBoolean=False),
+            parameter("message", valueString="Code not found in ValueSet")
         ])
 
     def translate(self, db: Session, url: Optional[str] = None, conceptmap_id: Optional[str] = None,
                   code: Optional[str] = None, system: Optional[str] = None, 
-                  source: Optional[str] = None, target: Optional[str] = None) -> Parameters:
+                  source: Optional[str] = None, target: Optional[str] = None) -> Dict:
         """
         Translate a code from one value set to another using a ConceptMap
         """
@@ -156,15 +260,15 @@ class TerminologyServiceSQL:
         elif url:
             cm = db.query(ConceptMapModel).filter(ConceptMapModel.url == url).first()
         else:
-            return Parameters(parameter=[
-                Parameter(name="result", valueBoolean=False),
-                Parameter(name="message", valueString="ConceptMap url or id required")
+            return parameters([
+                parameter("result", valueBoolean=False),
+                parameter("message", valueString="ConceptMap url or id required")
             ])
         
         if not cm:
-            return Parameters(parameter=[
-                Parameter(name="result", valueBoolean=False),
-                Parameter(name="message", valueString="ConceptMap not found")
+            return parameters([
+                parameter("result", valueBoolean=False),
+                parameter("message", valueString="ConceptMap not found")
             ])
         
         # Parse group from JSON
@@ -183,9 +287,9 @@ class TerminologyServiceSQL:
                     if targets:
                         # Return first match
                         matched = targets[0]
-                        return Parameters(parameter=[
-                            Parameter(name="result", valueBoolean=True),
-                            Parameter(name="match", valueString=json.dumps({
+                        return parameters([
+                            parameter("result", valueBoolean=True),
+                            parameter("match", valueString=json.dumps({
                                 "equivalence": matched.get("equivalence", "equivalent"),
                                 "concept": {
                                     "system": group.get("target"),
@@ -195,112 +299,238 @@ class TerminologyServiceSQL:
                             }))
                         ])
         
-        return Parameters(parameter=[
-            Parameter(name="result", valueBoolean=False),
-            Parameter(name="message", valueString="No translation found")
+        return parameters([
+            parameter("result", valueBoolean=False),
+            parameter("message", valueString="No translation found")
         ])
 
     def expand_valueset(self, db: Session, url: Optional[str] = None, valueset_id: Optional[str] = None,
-                       filter_text: Optional[str] = None, offset: int = 0, count: Optional[int] = None) -> Dict:
+                       filter_text: Optional[str] = None, offset: int = 0, count: Optional[int] = None,
+                       cursor: Optional[str] = None, hierarchical: bool = False) -> Dict:
+        """
+        Expand a ValueSet. Pages can be addressed by offset or, for large
+        expansions, by the continuation cursor returned in the "next"
+        expansion parameter, which resumes right after the last returned
+        concept without rescanning earlier pages. A hierarchical expansion
+        nests each concept under its closest ancestor in the expansion and
+        is never paged.
+        """
+        if hierarchical and (offset or count or cursor):
+            raise ValueError("A hierarchical expansion cannot be paged")
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+        expansion = self._resolve_expansion(db, url, valueset_id)
+        if cursor:
+            start = self._decode_cursor(expansion, cursor, filter_text)
+        elif not filter_text:
+            # Unfiltered, an offset is a position in the expansion
+            start = offset
+        else:
+            start = 0
+        
+        items = self.iter_expansion(expansion, filter_text, start)
+        if offset and filter_text and not cursor:
+            items = islice(items, offset, None)
+        paginated = list(islice(items, count + 1)) if count else list(items)
+        
+        has_more = bool(count) and len(paginated) > count
+        paginated = paginated[:count] if count else paginated
+        if hierarchical:
+            paginated = nest_contains(paginated, lambda system: get_compiled_code_system(db, system))
+        
+        # Counting filtered matches means a full scan; cursor paging skips it
+        if not filter_text:
+            total = len(expansion)
+        elif not cursor:
+            total = sum(1 for _ in self.iter_expansion(expansion, filter_text))
+        else:
+            total = None
+        
+        result = {
+            "id": str(uuid.uuid4()),
+            "url": expansion.url,
+            "name": expansion.name,
+            "status": expansion.status,
+            "expansion": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "total": total,
+                "offset": offset if offset > 0 and not cursor else None,
+                "contains": paginated
+            }
+        }
+        if has_more:
+            result["expansion"]["parameter"] = [
+                {"name": "next", "valueString": self._encode_cursor(paginated[-1], filter_text)}
+            ]
+        return result
+
+    def stream_expansion(self, db: Session, url: Optional[str] = None, valueset_id: Optional[str] = None,
+                         filter_text: Optional[str] = None, cursor: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Resolve the expansion eagerly (so lookup errors surface before any
+        output) and return a lazy iterator over its concepts.
+        """
+        expansion = self._resolve_expansion(db, url, valueset_id)
+        start = self._decode_cursor(expansion, cursor, filter_text) if cursor else 0
+        return self.iter_expansion(expansion, filter_text, start)
+
+    def iter_expansion(self, expansion: CachedExpansion, filter_text: Optional[str] = None, start: int = 0) -> Iterator[Dict]:
+        """Yield the concepts of an expansion from position start, in expansion order"""
+        needle = filter_text.lower() if filter_text else None
+        for item in expansion.iter_items(start):
+            if needle and needle not in item["code"].lower() and needle not in (item.get("display") or "").lower():
+                continue
+            yield item
+
+    def _resolve_expansion(self, db: Session, url: Optional[str], valueset_id: Optional[str]) -> CachedExpansion:
         if valueset_id:
             vs = db.query(ValueSetModel).filter(ValueSetModel.id == valueset_id).first()
+            expansion = self._get_expansion(db, vs) if vs else None
         elif url:
-            vs = db.query(ValueSetModel).filter(ValueSetModel.url == url).first()
+            expansion = self._find_expansion(db, url)
         else:
             raise ValueError("Either url or valueset_id required")
         
-        if not vs:
+        if expansion is None:
             raise ValueError("ValueSet not found")
+        return expansion
+
+    def _encode_cursor(self, item: Dict, filter_text: Optional[str]) -> str:
+        # Keyset cursor: the (system, code) of the last returned concept
+        token = json.dumps({"s": item.get("system"), "c": item["code"], "f": filter_text or ""}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii").rstrip("=")
+
+    def _decode_cursor(self, expansion: CachedExpansion, cursor: str, filter_text: Optional[str]) -> int:
+        """Return the expansion position following the cursor's concept"""
+        try:
+            token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            system, code = token["s"], token["c"]
+            cursor_filter = token.get("f") or ""
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("Invalid cursor")
+        if cursor_filter != (filter_text or ""):
+            raise ValueError("Cursor was issued for a different filter")
+        position = expansion.index(system, code)
+        if position is None:
+            raise ValueError("Cursor concept is no longer in the expansion")
+        return position + 1
+
+    def _get_expansion(self, db: Session, vs: ValueSetModel, importing: Tuple[str, ...] = ()) -> CachedExpansion:
+        """
+        Return the expansion of a ValueSet, reusing the in-process cache or the
+        expansion persisted in ValueSetModel.expansion while its fingerprint
+        (the ValueSet's own version plus those of the CodeSystems and
+        ValueSets it draws from) matches. importing holds the urls of the ValueSets whose
+        expansion imports this one, to detect import cycles.
+        """
+        compose = self._load_compose(vs)
+        fingerprint, systems, valuesets = self._expansion_dependencies(db, vs, importing)
         
-        compose_data = json.loads(vs.compose) if vs.compose and isinstance(vs.compose, str) else (vs.compose or {})
-        expanded = self._perform_expansion(db, compose_data, filter_text)
+        cached = expansion_cache.get(vs.url)
+        if cached is not None and cached.fingerprint == fingerprint:
+            return cached
         
-        total = len(expanded)
-        if count:
-            paginated = expanded[offset:offset + count]
+        stored = json.loads(vs.expansion) if vs.expansion and isinstance(vs.expansion, str) else vs.expansion
+        if stored and stored.get("identifier") == fingerprint:
+            concepts = ConceptSet().add_items(stored.get("contains") or [], lambda system: get_compiled_code_system(db, system))
         else:
-            paginated = expanded[offset:]
-        
-        return {
-            "id": str(uuid.uuid4()),
-            "url": vs.url,
-            "name": vs.name,
-            "status": vs.status,
-            "expansion": {
+            concepts = self._perform_expansion(db, compose, importing + (vs.url,))
+            contains = concepts.items()
+            self._store_expansion(vs.id, {
+                "identifier": fingerprint,
                 "timestamp": datetime.now(timezone.utc).isoformat(),
-                "total": total,
-                "offset": offset if offset > 0 else None,
-                "contains": paginated
-            }
-        }
+                "total": len(contains),
+                "contains": contains
+            })
+        
+        cached = CachedExpansion(vs, fingerprint, systems, concepts, valuesets)
+        expansion_cache.put(cached)
+        return cached
 
-    def _find_concept(self, concepts: List[Dict], code: str) -> Optional[Dict]:
-        for concept in concepts:
-            if concept.get("code") == code:
-                return concept
-            if concept.get("concept"):
-                nested = self._find_concept(concept["concept"], code)
-                if nested:
-                    return nested
-        return None
-    
-    def _is_descendant(self, concepts: List[Dict], parent_code: str, child_code: str) -> bool:
+    def _store_expansion(self, valueset_id: str, expansion: Dict) -> None:
         """
-        Check if child_code is a descendant of parent_code in the concept hierarchy
+        Persist an expansion in a session of its own, so that read paths do
+        not commit the caller's session. The stored expansion only saves
+        recomputing it, so a failed write is logged and ignored.
         """
-        parent = self._find_concept(concepts, parent_code)
-        if not parent:
-            return False
-        
-        # Check direct children
-        if parent.get("concept"):
-            for child in parent["concept"]:
-                if child.get("code") == child_code:
-                    return True
-                # Recursively check descendants
-                if self._is_descendant(parent["concept"], child["code"], child_code):
-                    return True
-        
-        return False
-
-    def _perform_expansion(self, db: Session, compose: Dict, filter_text: Optional[str] = None) -> List[Dict]:
-        expanded = []
+        session = SessionLocal()
+        try:
+            session.query(ValueSetModel).filter(ValueSetModel.id == valueset_id).update(
+                {ValueSetModel.expansion: expansion}, synchronize_session=False
+            )
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            logger.warning("Could not store the expansion of ValueSet %s", valueset_id, exc_info=True)
+        finally:
+            session.close()
+
+    def _load_compose(self, vs: ValueSetModel) -> Dict:
+        return json.loads(vs.compose) if vs.compose and isinstance(vs.compose, str) else (vs.compose or {})
+
+    def _expansion_dependencies(self, db: Session, vs: ValueSetModel,
+                                importing: Tuple[str, ...] = ()) -> Tuple[str, List[str], List[str]]:
+        """
+        Fingerprint an expansion from the compose and updated_at of the
+        ValueSet, the versions of the CodeSystems it includes or excludes and the fingerprints of the
+        ValueSets it imports. Also returns the urls of every CodeSystem and
+        ValueSet it depends on, through imports too.
+        """
+        if vs.url in importing:
+            raise ValueError("Circular ValueSet import: " + " -> ".join(importing + (vs.url,)))
+        compose = self._load_compose(vs)
+        parts = compose.get("include", []) + (compose.get("exclude") or [])
+        systems = {part["system"] for part in parts if part.get("system")}
+        imports = sorted({url for part in parts for url in part.get("valueSet") or []})
+        
+        rows = db.query(
+            CodeSystemModel.url, CodeSystemModel.version, CodeSystemModel.updated_at
+        ).filter(CodeSystemModel.url.in_(systems)).order_by(CodeSystemModel.url).all() if systems else []
+        digest = hashlib.sha256(json.dumps(compose, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(f"|{vs.id}|{vs.updated_at.isoformat() if vs.updated_at else ''}".encode("utf-8"))
+        for url, version, updated_at in rows:
+            digest.update(f"|{url}|{version}|{updated_at.isoformat() if updated_at else ''}".encode("utf-8"))
+        
+        valuesets = set(imports)
+        for url in imports:
+            fingerprint, imported_systems, imported_valuesets = self._expansion_dependencies(
+                db, self._imported_valueset(db, url), importing + (vs.url,)
+            )
+            digest.update(f"|{url}|{fingerprint}".encode("utf-8"))
+            systems.update(imported_systems)
+            valuesets.update(imported_valuesets)
+        return f"urn:sha256:{digest.hexdigest()}", sorted(systems), sorted(valuesets)
+
+    def _imported_valueset(self, db: Session, url: str) -> ValueSetModel:
+        vs = db.query(ValueSetModel).options(defer(ValueSetModel.expansion)).filter(ValueSetModel.url == url).first()
+        if vs is None:
+            raise ValueError(f"Imported ValueSet not found: {url}")
+        return vs
+
+    def _perform_expansion(self, db: Session, compose: Dict, importing: Tuple[str, ...] = ()) -> ConceptSet:
+        """
+        Evaluate a compose with the expansion engine: the union of the
+        includes minus the union of the excludes
+        """
+        result = ConceptSet()
         for include in compose.get("include", []):
-            system = include.get("system")
-            if include.get("concept"):
-                for concept in include["concept"]:
-                    if filter_text and filter_text.lower() not in concept.get("code", "").lower() and \
-                       filter_text.lower() not in concept.get("display", "").lower():
-                        continue
-                    expanded.append({
-                        "system": system,
-                        "code": concept["code"],
-                        "display": concept.get("display")
-                    })
-            elif system:
-                cs = db.query(CodeSystemModel).filter(CodeSystemModel.url == system).first()
-                if cs and cs.concept:
-                    concepts = json.loads(cs.concept) if isinstance(cs.concept, str) else cs.concept
-                    all_concepts = self._flatten_concepts(concepts)
-                    for concept in all_concepts:
-                        if filter_text and filter_text.lower() not in concept.get("code", "").lower() and \
-                           filter_text.lower() not in concept.get("display", "").lower():
-                            continue
-                        expanded.append({
-                            "system": system,
-                            "code": concept["code"],
-                            "display": concept.get("display")
-                        })
-        return expanded
-
-    def _flatten_concepts(self, concepts: List[Dict]) -> List[Dict]:
-        result = []
-        for concept in concepts:
-            result.append(concept)
-            if concept.get("concept"):
-                result.extend(self._flatten_concepts(concept["concept"]))
+            result.union(self._include_set(db, include, importing))
+        for exclude in compose.get("exclude") or []:
+            result.difference(self._include_set(db, exclude, importing))
         return result
 
+    def _include_set(self, db: Session, include: Dict, importing: Tuple[str, ...]) -> ConceptSet:
+        """The concepts of one include or exclude: its system part intersected with each imported ValueSet"""
+        selected = None
+        if include.get("system"):
+            cs = get_compiled_code_system(db, include["system"], include.get("version"))
+            selected = include_set(cs, include)
+        for url in include.get("valueSet") or []:
+            expansion = self._get_expansion(db, self._imported_valueset(db, url), importing)
+            imported = expansion.concepts.copy()
+            selected = imported if selected is None else selected.intersection(imported)
+        return selected if selected is not None else ConceptSet()
+
     def compose(self, db: Session, include_systems: List[str], exclude_systems: Optional[List[str]] = None, 
                 filter_text: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -310,44 +540,32 @@ class TerminologyServiceSQL:
         This operation composes a ValueSet by including concepts from specified CodeSystems
         and optionally excluding concepts from other systems.
         """
-        composed_concepts = []
-        
-        # Include concepts from specified systems
+        # Included minus excluded systems, as bitsets of concept IDs
+        concepts = ConceptSet()
         for system_url in include_systems:
-            cs = db.query(CodeSystemModel).filter(CodeSystemModel.url == system_url).first()
-            if cs and cs.concept:
-                concepts = json.loads(cs.concept) if isinstance(cs.concept, str) else cs.concept
-                all_concepts = self._flatten_concepts(concepts)
-                
-                for concept in all_concepts:
-                    # Apply filter if specified
-                    if filter_text and filter_text.lower() not in concept.get("code", "").lower() and \
-                       filter_text.lower() not in concept.get("display", "").lower():
-                        continue
-                    
-                    composed_concepts.append({
-                        "system": system_url,
-                        "code": concept["code"],
-                        "display": concept.get("display"),
-                        "definition": concept.get("definition")
-                    })
-        
-        # Exclude concepts from specified systems if provided
-        if exclude_systems:
-            exclude_codes = set()
-            for system_url in exclude_systems:
-                cs = db.query(CodeSystemModel).filter(CodeSystemModel.url == system_url).first()
-                if cs and cs.concept:
-                    concepts = json.loads(cs.concept) if isinstance(cs.concept, str) else cs.concept
-                    all_concepts = self._flatten_concepts(concepts)
-                    for concept in all_concepts:
-                        exclude_codes.add((system_url, concept["code"]))
-            
-            # Filter out excluded concepts
-            composed_concepts = [
-                c for c in composed_concepts 
-                if (c["system"], c["code"]) not in exclude_codes
-            ]
+            cs = get_compiled_code_system(db, system_url)
+            if cs:
+                concepts.union(include_set(cs, {"system": system_url}))
+        for system_url in exclude_systems or []:
+            cs = get_compiled_code_system(db, system_url)
+            if cs:
+                concepts.difference(include_set(cs, {"system": system_url}))
+        
+        composed_concepts = []
+        needle = filter_text.lower() if filter_text else None
+        for system_url, positions in concepts.positions.items():
+            flat = concepts.code_systems[system_url].flat
+            for position in positions.positions():
+                concept = flat[position]
+                # Apply filter if specified
+                if needle and needle not in concept["code"].lower() and needle not in (concept.get("display") or "").lower():
+                    continue
+                composed_concepts.append({
+                    "system": system_url,
+                    "code": concept["code"],
+                    "display": concept.get("display"),
+                    "definition": concept.get("definition")
+                })
         
         # Create ValueSet structure
         valueset_id = str(uuid.uuid4())
@@ -375,101 +593,66 @@ class TerminologyServiceSQL:
         return valueset
 
     def find_matches(self, db: Session, system: Optional[str] = None, property_name: Optional[str] = None,
-                    property_value: Optional[str] = None, exact: bool = False) -> Parameters:
+                    property_value: Optional[str] = None, exact: bool = False, count: int = 100) -> Dict:
         """
         $find-matches operation - Search for codes matching supplied properties
         https://build.fhir.org/codesystem-operation-find-matches.html
         
         This operation searches for codes that match the provided search criteria.
         Can search by:
-        - display text (default)
+        - display text (default, together with code and definition)
         - code
         - any other property
+        
+        Partial matches (whole words, word prefixes, then substrings) are
+        ranked by the search index and at most count matches are returned.
+        The search stops at that limit, so the total number of matches is
+        not known: count is the number of matches returned, and truncated
+        is true when more matches were left out.
         """
         matches = []
+        fields = [property_name] if property_name else None
         
-        # Query CodeSystems
-        query = db.query(CodeSystemModel)
+        # Resolve CodeSystems
         if system:
-            query = query.filter(CodeSystemModel.url == system)
+            system_urls = [system]
+        else:
+            system_urls = [url for (url,) in db.query(CodeSystemModel.url).all()]
         
-        code_systems = query.all()
+        if property_value:
+            for system_url in system_urls:
+                cs = get_compiled_code_system(db, system_url)
+                if not cs:
+                    continue
+                # One more than count tells whether the result is truncated
+                for rank, position in get_search_index(cs).search(property_value, fields, exact, count + 1):
+                    matches.append((rank, cs.url, cs.flat[position]))
         
-        for cs in code_systems:
-            if not cs.concept:
-                continue
-            
-            concepts = json.loads(cs.concept) if isinstance(cs.concept, str) else cs.concept
-            all_concepts = self._flatten_concepts(concepts)
-            
-            for concept in all_concepts:
-                match_found = False
-                
-                # If no property specified, search in display and code
-                if not property_name or property_name == "display":
-                    display = concept.get("display", "")
-                    if property_value:
-                        if exact:
-                            match_found = display == property_value
-                        else:
-                            match_found = property_value.lower() in display.lower()
-                
-                if not match_found and (not property_name or property_name == "code"):
-                    code = concept.get("code", "")
-                    if property_value:
-                        if exact:
-                            match_found = code == property_value
-                        else:
-                            match_found = property_value.lower() in code.lower()
-                
-                # Search in definition
-                if not match_found and (not property_name or property_name == "definition"):
-                    definition = concept.get("definition", "")
-                    if property_value and definition:
-                        if exact:
-                            match_found = definition == property_value
-                        else:
-                            match_found = property_value.lower() in definition.lower()
-                
-                # Search in custom properties
-                if not match_found and property_name and property_name not in ["display", "code", "definition"]:
-                    properties = concept.get("property", [])
-                    for prop in properties:
-                        if prop.get("code") == property_name:
-                            prop_value = prop.get("valueString", prop.get("valueCode", ""))
-                            if property_value:
-                                if exact:
-                                    match_found = prop_value == property_value
-                                else:
-                                    match_found = property_value.lower() in str(prop_value).lower()
-                
-                if match_found:
-                    matches.append({
-                        "system": cs.url,
-                        "code": concept.get("code"),
-                        "display": concept.get("display"),
-                        "definition": concept.get("definition")
-                    })
+        # Each system returns its best matches; keep the best overall
+        matches.sort(key=lambda match: match[0])
+        truncated = len(matches) > count
+        matches = matches[:count]
         
         # Build Parameters response
         params = [
-            Parameter(name="count", valueInteger=len(matches))
+            parameter("count", valueInteger=len(matches)),
+            parameter("truncated", valueBoolean=truncated)
         ]
         
-        for match in matches[:100]:  # Limit to 100 results
+        for _, system_url, concept in matches:
             params.append(
-                Parameter(
-                    name="match",
+                parameter(
+                    "match",
                     part=[
-                        Parameter(name="code", valueCoding=Coding(
-                            system=match["system"],
-                            code=match["code"],
-                            display=match.get("display")
+                        parameter("code", valueCoding=coding(
+                            system=system_url,
+                            code=concept.get("code"),
+                            display=concept.get("display")
                         )),
-                        Parameter(name="display", valueString=match.get("display", "")),
+                        parameter("display", valueString=concept.get("display") or ""),
                     ]
                 )
             )
         
-        return Parameters(parameter=params)
+        return parameters(params)
 
@@ -0,0 +1,69 @@
+"""
+Shared fixtures. The backend is imported against a throwaway SQLite
+database, so DATABASE_URL has to be set before the first import of it.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_db_dir = tempfile.mkdtemp(prefix="terminology-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_db_dir) / 'test.db'}"
+os.environ.setdefault("JOB_OUTPUT_DIR", str(Path(_db_dir) / "jobs"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+CODE_SYSTEM = {
+    "url": "http://example.org/cs",
+    "version": "1",
+    "name": "Example",
+    "status": "active",
+    "concept": [
+        {"code": "A", "display": "Alpha", "concept": [
+            {"code": "A1", "display": "Alpha one", "concept": [
+                {"code": "A1a", "display": "Alpha one a"},
+            ]},
+            {"code": "A2", "display": "Alpha two"},
+        ]},
+        {"code": "B", "display": "Beta", "definition": "The second letter"},
+    ],
+}
+
+VALUE_SET = {
+    "url": "http://example.org/vs",
+    "name": "ExampleAll",
+    "status": "active",
+    "compose": {"include": [{"system": "http://example.org/cs"}]},
+}
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import server
+    return TestClient(server.app)
+
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    from auth import create_user, UserCreate
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        user = create_user(db, UserCreate(username="admin", email="admin@example.org", password="admin-password"))
+        user.is_admin = True
+        user.role = "admin"
+        db.commit()
+    finally:
+        db.close()
+    response = client.post("/api/auth/login", json={"username": "admin", "password": "admin-password"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="session")
+def value_set(client, admin_headers):
+    """The example CodeSystem and a ValueSet including all of it"""
+    assert client.post("/api/CodeSystem", json=CODE_SYSTEM, headers=admin_headers).status_code == 201
+    assert client.post("/api/ValueSet", json=VALUE_SET, headers=admin_headers).status_code == 201
+    return VALUE_SET["url"]
@@ -0,0 +1,87 @@
+import gzip
+import json
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine, func, inspect, select
+from sqlalchemy.orm import Session
+
+from database import AuditLogModel
+from services import audit_partitions
+
+NOW = datetime(2025, 6, 15, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'audit.db'}")
+    AuditLogModel.__table__.create(engine)
+    yield engine
+    engine.dispose()
+
+
+def add_entries(engine, *timestamps):
+    with Session(engine) as db:
+        for index, timestamp in enumerate(timestamps):
+            db.add(AuditLogModel(
+                id=f"{timestamp:%Y%m%d}-{index}", resource_type="CodeSystem", resource_id="cs",
+                action="update", user_id="u", username="user", timestamp=timestamp
+            ))
+        db.commit()
+
+
+def hot_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(AuditLogModel.__table__)).scalar()
+
+
+def test_rotate_moves_whole_months_out_of_the_hot_table(engine, monkeypatch):
+    monkeypatch.setattr(audit_partitions, "AUDIT_LOG_HOT_DAYS", 31)
+    add_entries(engine, datetime(2025, 3, 2), datetime(2025, 3, 30), datetime(2025, 4, 10),
+                datetime(2025, 5, 3), datetime(2025, 6, 14))
+
+    # The hot window starts on May 15th, so May stays in the hot table
+    assert audit_partitions.rotate(engine, now=NOW) == ["audit_log_2025_03", "audit_log_2025_04"]
+    assert hot_count(engine) == 2
+    assert [name for _, name in audit_partitions.list_partitions(engine)] == ["audit_log_2025_03", "audit_log_2025_04"]
+    assert audit_partitions.rotate(engine, now=NOW) == []
+
+
+def test_rotated_entries_stay_queryable(engine, monkeypatch):
+    monkeypatch.setattr(audit_partitions, "AUDIT_LOG_HOT_DAYS", 31)
+    add_entries(engine, datetime(2025, 3, 2), datetime(2025, 6, 14))
+    audit_partitions.rotate(engine, now=NOW)
+
+    with Session(engine) as db:
+        since = datetime(2025, 1, 1)
+        log = audit_partitions.audit_log_entity(db, since=since)
+        assert db.query(log).filter(log.timestamp >= since).count() == 2
+        hot_only = audit_partitions.audit_log_entity(db, since=datetime(2025, 6, 1))
+        assert hot_only is AuditLogModel
+
+
+def test_archive_expired_writes_and_drops_old_months(engine, monkeypatch, tmp_path):
+    monkeypatch.setattr(audit_partitions, "AUDIT_LOG_HOT_DAYS", 31)
+    monkeypatch.setattr(audit_partitions, "AUDIT_LOG_RETENTION_DAYS", 90)
+    add_entries(engine, datetime(2025, 1, 5), datetime(2025, 1, 20), datetime(2025, 3, 10), datetime(2025, 6, 1))
+    audit_partitions.rotate(engine, now=NOW)
+
+    # Retention reaches back to March 17th: January has ended, March has not
+    archive_dir = tmp_path / "archive"
+    archived = audit_partitions.archive_expired(engine, now=NOW, archive_dir=str(archive_dir))
+    assert archived == [str(archive_dir / "audit_log_2025_01.ndjson.gz")]
+    assert "audit_log_2025_01" not in inspect(engine).get_table_names()
+    assert [name for _, name in audit_partitions.list_partitions(engine)] == ["audit_log_2025_03"]
+
+    with gzip.open(archived[0], "rt", encoding="utf-8") as archive:
+        rows = [json.loads(line) for line in archive]
+    assert [row["timestamp"] for row in rows] == ["2025-01-05T00:00:00", "2025-01-20T00:00:00"]
+    assert not list(archive_dir.glob("*.partial"))
+
+
+def test_archive_expired_is_disabled_without_retention(engine, monkeypatch, tmp_path):
+    monkeypatch.setattr(audit_partitions, "AUDIT_LOG_RETENTION_DAYS", 0)
+    add_entries(engine, datetime(2020, 1, 5))
+    audit_partitions.rotate(engine, now=NOW)
+    assert audit_partitions.archive_expired(engine, now=NOW, archive_dir=str(tmp_path)) == []
+    assert len(audit_partitions.list_partitions(engine)) == 1
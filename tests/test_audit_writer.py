@@ -0,0 +1,29 @@
+import threading
+
+from services.audit_writer import AuditLogWriter
+
+
+def test_flush_waits_for_queued_entries():
+    writer = AuditLogWriter(flush_interval=0.05)
+    written = []
+    writer._write = written.extend
+    writer.enqueue({"id": "1"})
+    writer.enqueue({"id": "2"})
+    assert writer.flush(timeout=5)
+    assert written == [{"id": "1"}, {"id": "2"}]
+    writer.close()
+
+
+def test_flush_gives_up_after_the_timeout():
+    writer = AuditLogWriter(flush_interval=0.05)
+    release = threading.Event()
+    writer._write = lambda entries: release.wait()
+    writer.enqueue({"id": "1"})
+    assert not writer.flush(timeout=0.1)
+    release.set()
+    assert writer.flush(timeout=5)
+    writer.close()
+
+
+def test_flush_without_a_writer_thread_returns_at_once():
+    assert AuditLogWriter().flush(timeout=0)
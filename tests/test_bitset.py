@@ -0,0 +1,62 @@
+import pytest
+
+from services import bitset
+from services.bitset import PositionSet
+
+
+@pytest.fixture(params=["numpy", "fallback"], autouse=True)
+def backend(request, monkeypatch):
+    """Run every test with NumPy bool arrays and with the Python set fallback"""
+    if request.param == "numpy":
+        if bitset.numpy is None:
+            pytest.skip("NumPy is not installed")
+    else:
+        monkeypatch.setattr(bitset, "numpy", None)
+    return request.param
+
+
+def members(positions: PositionSet):
+    return list(positions.positions())
+
+
+def test_constructors():
+    assert members(PositionSet.empty(5)) == []
+    assert members(PositionSet.full(5)) == [0, 1, 2, 3, 4]
+    assert members(PositionSet.range(10, 3, 6)) == [3, 4, 5]
+    assert members(PositionSet.of(10, [7, 2, 2, 5])) == [2, 5, 7]
+
+
+def test_set_operations():
+    a = PositionSet.of(10, [1, 2, 3, 8])
+    b = PositionSet.of(10, [2, 3, 4])
+    assert members(a | b) == [1, 2, 3, 4, 8]
+    assert members(a & b) == [2, 3]
+    assert members(a - b) == [1, 8]
+    assert members(b - a) == [4]
+    # Operators return new sets
+    assert members(a) == [1, 2, 3, 8]
+
+
+def test_membership_and_size():
+    a = PositionSet.of(10, [0, 4, 9])
+    assert len(a) == 3
+    assert 4 in a
+    assert 5 not in a
+    assert -1 not in a
+    assert 10 not in a
+    assert a.contains_many([9, 1, 0]) == [True, False, True]
+
+
+def test_positions_from_start_and_rank():
+    a = PositionSet.of(100, [5, 20, 21, 60, 99])
+    assert list(a.positions(2)) == [21, 60, 99]
+    assert list(a.positions(5)) == []
+    assert a.rank(5) == 0
+    assert a.rank(21) == 2
+    assert a.rank(100) == 5
+
+
+def test_iteration_crosses_chunks(monkeypatch):
+    monkeypatch.setattr(bitset, "ITER_CHUNK_SIZE", 3)
+    a = PositionSet.range(20, 2, 12)
+    assert list(a.positions(4)) == list(range(6, 12))
@@ -0,0 +1,59 @@
+import json
+
+ALL_CODES = ["A", "A1", "A1a", "A2", "B"]
+
+
+def expand(client, **params):
+    response = client.get("/api/ValueSet/$expand", params=params)
+    assert response.status_code == 200, response.text
+    return response.json()["expansion"]
+
+
+def next_cursor(expansion):
+    for parameter in expansion.get("parameter") or []:
+        if parameter["name"] == "next":
+            return parameter["valueString"]
+    return None
+
+
+def test_cursor_pages_cover_the_expansion_once(client, value_set):
+    codes = []
+    page = expand(client, url=value_set, count=2)
+    assert page["total"] == 5
+    while True:
+        codes += [item["code"] for item in page["contains"]]
+        cursor = next_cursor(page)
+        if cursor is None:
+            break
+        page = expand(client, url=value_set, count=2, cursor=cursor)
+    assert codes == ALL_CODES
+
+
+def test_cursor_resumes_a_filtered_expansion(client, value_set):
+    page = expand(client, url=value_set, filter="alpha", count=1)
+    assert [item["code"] for item in page["contains"]] == ["A"]
+    page = expand(client, url=value_set, filter="alpha", count=2, cursor=next_cursor(page))
+    assert [item["code"] for item in page["contains"]] == ["A1", "A1a"]
+    assert page["total"] is None
+    page = expand(client, url=value_set, filter="alpha", count=2, cursor=next_cursor(page))
+    assert [item["code"] for item in page["contains"]] == ["A2"]
+    assert next_cursor(page) is None
+
+
+def test_offset_paging(client, value_set):
+    page = expand(client, url=value_set, offset=3, count=5)
+    assert page["offset"] == 3
+    assert [item["code"] for item in page["contains"]] == ["A2", "B"]
+
+
+def test_ndjson_stream_resumes_from_a_cursor(client, value_set):
+    cursor = next_cursor(expand(client, url=value_set, count=3))
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set, "_format": "ndjson", "cursor": cursor})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["code"] for line in response.text.splitlines()] == ["A2", "B"]
+
+
+def test_invalid_cursor_is_rejected(client, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set, "count": 2, "cursor": "not-a-cursor"})
+    assert response.status_code == 400
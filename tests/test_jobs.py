@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+ASYNC = {"Prefer": "respond-async"}
+
+
+def wait(client, location, headers):
+    for _ in range(100):
+        response = client.get(location, headers=headers)
+        if response.status_code != 202:
+            return response
+        time.sleep(0.05)
+    raise AssertionError(f"{location} did not finish")
+
+
+@pytest.fixture(scope="module")
+def user_headers(client):
+    from auth import create_user, UserCreate
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        create_user(db, UserCreate(username="reader", email="reader@example.org", password="reader-password"))
+    finally:
+        db.close()
+    response = client.post("/api/auth/login", json={"username": "reader", "password": "reader-password"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_async_expand_returns_the_full_expansion(client, admin_headers, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set}, headers={**admin_headers, **ASYNC})
+    assert response.status_code == 202
+    result = wait(client, response.headers["content-location"], admin_headers)
+    assert result.status_code == 200
+    assert result.json()["expansion"]["total"] == 5
+
+
+def test_async_expand_rejects_paging(client, admin_headers, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set, "count": 2},
+                          headers={**admin_headers, **ASYNC})
+    assert response.status_code == 400
+
+
+def test_failed_job_reports_its_error(client, admin_headers, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": "http://example.org/missing"},
+                          headers={**admin_headers, **ASYNC})
+    result = wait(client, response.headers["content-location"], admin_headers)
+    assert result.status_code == 500
+    assert result.json()["detail"] == "ValueSet not found"
+
+
+def test_jobs_are_limited_to_their_creator_and_admins(client, admin_headers, user_headers, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set}, headers={**user_headers, **ASYNC})
+    location = response.headers["content-location"]
+    assert wait(client, location, user_headers).status_code == 200
+    assert wait(client, location, admin_headers).status_code == 200
+
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set}, headers={**admin_headers, **ASYNC})
+    location = response.headers["content-location"]
+    assert client.get(location, headers=user_headers).status_code == 403
+    assert client.delete(location, headers=user_headers).status_code == 403
+    assert client.get(location).status_code == 403
+
+
+def test_deleting_a_finished_job_forgets_it(client, admin_headers, value_set):
+    response = client.get("/api/ValueSet/$expand", params={"url": value_set}, headers={**admin_headers, **ASYNC})
+    location = response.headers["content-location"]
+    wait(client, location, admin_headers)
+    assert client.delete(location, headers=admin_headers).status_code == 202
+    assert client.get(location, headers=admin_headers).status_code == 404
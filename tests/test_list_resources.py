@@ -0,0 +1,29 @@
+def test_summary_count_returns_the_total(client, value_set):
+    response = client.get("/api/ValueSet", params={"_summary": "count"})
+    assert response.status_code == 200
+    assert response.json() == {"total": len(client.get("/api/ValueSet").json())}
+
+
+def test_count_pages_through_a_link_header(client, admin_headers, value_set):
+    for name in ("PagedOne", "PagedTwo"):
+        code_system = {"url": f"http://example.org/{name}", "name": name, "status": "active", "concept": [{"code": "X"}]}
+        assert client.post("/api/CodeSystem", json=code_system, headers=admin_headers).status_code == 201
+    expected = [resource["id"] for resource in client.get("/api/CodeSystem").json()]
+    ids = []
+    url, params = "/api/CodeSystem", {"_count": 1, "_elements": "url"}
+    while url:
+        response = client.get(url, params=params)
+        page = response.json()
+        assert len(page) <= 1
+        ids += [resource["id"] for resource in page]
+        link = response.headers.get("link")
+        url = link[link.index("<") + 1:link.index(">")] if link else None
+        params = None
+    assert len(ids) >= 3
+    assert sorted(ids) == sorted(expected)
+
+
+def test_summary_true_leaves_out_concepts(client, value_set):
+    resources = client.get("/api/CodeSystem", params={"_summary": "true"}).json()
+    assert resources
+    assert all("concept" not in resource for resource in resources)
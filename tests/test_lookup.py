@@ -0,0 +1,59 @@
+from tests.conftest import CODE_SYSTEM
+
+SYSTEM = CODE_SYSTEM["url"]
+
+
+def parts(parameter):
+    return {part["name"]: part for part in parameter["part"]}
+
+
+def property_values(parameters, code):
+    return [
+        next(part for part in p["part"] if part["name"] == "value")["valueCode"]
+        for p in parameters if p["name"] == "property"
+        and next(part for part in p["part"] if part["name"] == "code")["valueCode"] == code
+    ]
+
+
+def test_lookup_derives_parent_and_child(client, value_set):
+    response = client.get("/api/CodeSystem/$lookup", params={"system": SYSTEM, "code": "A", "property": ["child"]})
+    parameters = response.json()["parameter"]
+    assert property_values(parameters, "child") == ["A1", "A2"]
+    assert property_values(parameters, "parent") == []
+
+    response = client.get("/api/CodeSystem/$lookup", params={"system": SYSTEM, "code": "A1a", "property": ["parent"]})
+    assert property_values(response.json()["parameter"], "parent") == ["A1"]
+
+
+def test_batch_lookup_with_parameters(client, value_set):
+    body = {"resourceType": "Parameters", "parameter": [
+        {"name": "coding", "valueCoding": {"system": SYSTEM, "code": "A1"}},
+        {"name": "coding", "valueCoding": {"system": SYSTEM, "code": "missing"}},
+        {"name": "property", "valueCode": "parent"},
+    ]}
+    results = client.post("/api/CodeSystem/$lookup", json=body).json()["parameter"]
+    assert [result["name"] for result in results] == ["lookup", "lookup"]
+
+    found = parts(results[0])
+    assert found["coding"]["valueCoding"]["code"] == "A1"
+    assert found["display"]["valueString"] == "Alpha one"
+    assert property_values(results[0]["part"], "parent") == ["A"]
+
+    missing = parts(results[1])
+    assert missing["message"]["valueString"] == "Code missing not found"
+    assert "display" not in missing
+
+
+def test_batch_lookup_with_bundle(client, value_set):
+    body = {"resourceType": "Bundle", "type": "batch", "entry": [
+        {"resource": {"resourceType": "Parameters", "parameter": [
+            {"name": "system", "valueUri": SYSTEM}, {"name": "code", "valueCode": code}
+        ]}} for code in ("B", "A2")
+    ]}
+    response = client.post("/api/CodeSystem/$lookup", json=body).json()
+    assert response["type"] == "batch-response"
+    displays = [
+        next(p["valueString"] for p in entry["resource"]["parameter"] if p["name"] == "display")
+        for entry in response["entry"]
+    ]
+    assert displays == ["Beta", "Alpha two"]
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+
+from jose import jwt
+
+import auth
+import oauth2_service
+from oauth2_service import VerifiedSecretCache
+
+
+def test_verified_secret_cache_matches_secret_and_hash():
+    cache = VerifiedSecretCache(ttl=60)
+    assert not cache.check("client", "secret", "hash-1")
+    cache.remember("client", "secret", "hash-1")
+    assert cache.check("client", "secret", "hash-1")
+    assert not cache.check("client", "other-secret", "hash-1")
+    # A secret rotated elsewhere changes the stored hash
+    assert not cache.check("client", "secret", "hash-2")
+    assert not cache.check("client", "secret", "hash-1")
+
+
+def test_verified_secret_cache_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(oauth2_service.time, "monotonic", lambda: now[0])
+    cache = VerifiedSecretCache(ttl=60)
+    cache.remember("client", "secret", "hash")
+    now[0] += 59
+    assert cache.check("client", "secret", "hash")
+    now[0] += 2
+    assert not cache.check("client", "secret", "hash")
+
+
+def test_verified_secret_cache_disabled_without_ttl():
+    cache = VerifiedSecretCache(ttl=0)
+    cache.remember("client", "secret", "hash")
+    assert not cache.check("client", "secret", "hash")
+
+
+def test_authenticate_client_skips_bcrypt_once_verified(client, admin_headers, monkeypatch):
+    from database import SessionLocal
+    from oauth2_service import OAuth2ClientCreate, authenticate_client, create_oauth2_client
+
+    db = SessionLocal()
+    try:
+        model, secret = create_oauth2_client(db, OAuth2ClientCreate(
+            client_name="cache-test", redirect_uris=[], grant_types=["client_credentials"], scopes=["system/*.read"]
+        ), created_by="admin")
+        calls = []
+        verify = oauth2_service.verify_client_secret
+        monkeypatch.setattr(oauth2_service, "verify_client_secret", lambda *args: calls.append(args) or verify(*args))
+
+        assert authenticate_client(db, model.client_id, secret) is not None
+        assert authenticate_client(db, model.client_id, secret) is not None
+        assert len(calls) == 1
+        assert authenticate_client(db, model.client_id, "wrong") is None
+        assert len(calls) == 2
+    finally:
+        db.close()
+
+
+def test_login_tokens_reject_other_token_types():
+    login = auth.create_access_token({"sub": "admin"})
+    assert auth.decode_access_token(login).username == "admin"
+
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    other = jwt.encode({"sub": "admin", "typ": oauth2_service.JWT_TOKEN_TYPE, "exp": expires},
+                       auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+    assert auth.decode_access_token(other) is None
@@ -0,0 +1,61 @@
+from services.search_index import SearchIndex, tokenize
+
+FLAT = [
+    {"code": "HEART", "display": "Heart disease"},
+    {"code": "HEARTBURN", "display": "Heartburn"},
+    {"code": "CARDIO", "display": "Cardiomyopathy", "definition": "Disease of the heart muscle"},
+    {"code": "KIDNEY", "display": "Chronic kidney disease",
+     "property": [{"code": "organ", "valueString": "Kidney"}]},
+]
+
+
+def codes(index, value, **kwargs):
+    return [FLAT[position]["code"] for _, position in index.search(value, **kwargs)]
+
+
+def test_tokenize_lowercases_words():
+    assert tokenize("Chronic kidney-disease (CKD)") == ["chronic", "kidney", "disease", "ckd"]
+
+
+def test_tiers_rank_exact_then_words_then_prefixes_then_substrings():
+    index = SearchIndex(FLAT)
+    assert codes(index, "heartburn") == ["HEARTBURN"]
+    # Exact code, then a whole word of a definition, then a display prefix
+    assert codes(index, "heart") == ["HEART", "CARDIO", "HEARTBURN"]
+    assert [rank for rank, _ in index.search("heart")] == [(0, 1), (1, 2), (2, 0)]
+
+
+def test_substring_matches_inside_words():
+    index = SearchIndex(FLAT)
+    assert codes(index, "myopath") == ["CARDIO"]
+    assert codes(index, "art dis") == ["HEART"]
+    assert codes(index, "idney dis") == ["KIDNEY"]
+
+
+def test_substring_matches_do_not_span_values():
+    index = SearchIndex(FLAT)
+    # "Heart disease" is followed by "Heartburn" in the joined display text
+    assert codes(index, "diseaseheart") == []
+
+
+def test_exact_and_property_search():
+    index = SearchIndex(FLAT)
+    assert codes(index, "Heartburn", exact=True) == ["HEARTBURN"]
+    assert codes(index, "heartburn", exact=True) == []
+    assert codes(index, "kidney", fields=["organ"]) == ["KIDNEY"]
+
+
+def test_limit_stops_early():
+    index = SearchIndex(FLAT)
+    assert codes(index, "dis", limit=2) == ["HEART", "KIDNEY"]
+
+
+def test_find_matches_endpoint_reports_truncation(client, value_set):
+    response = client.get("/api/CodeSystem/$find-matches", params={"value": "alpha", "count": 2})
+    parameters = response.json()["parameter"]
+    assert [p["valueInteger"] for p in parameters if p["name"] == "count"] == [2]
+    assert [p["valueBoolean"] for p in parameters if p["name"] == "truncated"] == [True]
+
+    response = client.get("/api/CodeSystem/$find-matches", params={"value": "one a"})
+    parameters = response.json()["parameter"]
+    assert [p["valueBoolean"] for p in parameters if p["name"] == "truncated"] == [False]
@@ -0,0 +1,77 @@
+from tests.conftest import CODE_SYSTEM
+
+
+def test_subsumption_uses_preorder_intervals(client, value_set):
+    def outcome(code_a, code_b):
+        response = client.get("/api/CodeSystem/$subsumes", params={
+            "system": CODE_SYSTEM["url"], "codeA": code_a, "codeB": code_b
+        })
+        return response.json()["parameter"][0]["valueString"]
+
+    assert outcome("A", "A1a") == "subsumes"
+    assert outcome("A1a", "A") == "subsumed-by"
+    assert outcome("A", "A") == "equivalent"
+    assert outcome("A2", "A1a") == "not-subsumed"
+    assert outcome("A", "B") == "not-subsumed"
+
+
+def test_compiled_code_system_intervals(value_set):
+    from database import SessionLocal
+    from services.terminology_cache import get_compiled_code_system
+
+    db = SessionLocal()
+    try:
+        cs = get_compiled_code_system(db, CODE_SYSTEM["url"])
+    finally:
+        db.close()
+    assert [concept["code"] for concept in cs.flat] == ["A", "A1", "A1a", "A2", "B"]
+    assert [concept["code"] for concept in cs.descendants("A", include_self=False)] == ["A1", "A1a", "A2"]
+    assert cs.descendants("B", include_self=False) == []
+
+
+def test_evicted_code_system_takes_its_expansions_along(client, admin_headers, value_set):
+    from database import SessionLocal
+    from services.terminology_cache import code_system_cache, expansion_cache, get_compiled_code_system
+
+    other = {"url": "http://example.org/other", "name": "Other", "status": "active", "concept": [{"code": "Z"}]}
+    assert client.post("/api/CodeSystem", json=other, headers=admin_headers).status_code == 201
+    assert client.get("/api/ValueSet/$expand", params={"url": value_set}).status_code == 200
+    assert expansion_cache.get(value_set) is not None
+
+    max_concepts = code_system_cache.max_concepts
+    code_system_cache.max_concepts = 1
+    db = SessionLocal()
+    try:
+        get_compiled_code_system(db, other["url"])
+    finally:
+        db.close()
+        code_system_cache.max_concepts = max_concepts
+
+    assert code_system_cache.get(CODE_SYSTEM["url"]) is None
+    assert expansion_cache.get(value_set) is None
+
+
+def test_cached_expansion_follows_value_set_and_code_system_updates(client, admin_headers):
+    from services.terminology_cache import expansion_cache
+
+    cs = {"url": "http://example.org/colors", "name": "Colors", "status": "active",
+          "concept": [{"code": "red"}, {"code": "green"}]}
+    vs = {"url": "http://example.org/colors-vs", "name": "ColorsVS", "status": "active",
+          "compose": {"include": [{"system": cs["url"]}]}}
+    cs_id = client.post("/api/CodeSystem", json=cs, headers=admin_headers).json()["id"]
+    vs_id = client.post("/api/ValueSet", json=vs, headers=admin_headers).json()["id"]
+
+    def codes():
+        response = client.get("/api/ValueSet/$expand", params={"url": vs["url"]})
+        return [item["code"] for item in response.json()["expansion"]["contains"]]
+
+    assert codes() == ["red", "green"]
+    assert expansion_cache.get(vs["url"]) is not None
+
+    cs["concept"].append({"code": "blue"})
+    assert client.put(f"/api/CodeSystem/{cs_id}", json=cs, headers=admin_headers).status_code == 200
+    assert codes() == ["red", "green", "blue"]
+
+    vs["compose"]["include"][0]["concept"] = [{"code": "blue"}]
+    assert client.put(f"/api/ValueSet/{vs_id}", json=vs, headers=admin_headers).status_code == 200
+    assert codes() == ["blue"]